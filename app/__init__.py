@@ -76,25 +76,31 @@ def create_app():
     app.register_blueprint(debug_blueprint)
     from .reviews import reviews_bp
     app.register_blueprint(reviews_bp)
+    from .events import events as events_blueprint
+    app.register_blueprint(events_blueprint)
 
     # Register custom filters
     from .template_filters import url_or_local
     app.jinja_env.filters['url_or_local'] = url_or_local
 
+    # Contatori ordini in attesa mantenuti sulle scritture degli ordini
+    from . import orders  # noqa: F401
+
     # Context processor for pending orders count
     @app.context_processor
     def inject_pending_orders_count():
         from flask_login import current_user
-        from .models import OrderRequest
         count = 0
         if current_user.is_authenticated and current_user.is_farmer:
-            count = OrderRequest.query.filter_by(farmer_id=current_user.id, status='pending').count()
+            # Contatore denormalizzato sull'utente (già in cache): nessuna query
+            count = max(current_user.pending_orders_count or 0, 0)
         return dict(pending_orders_count=count)
 
     @login_manager.user_loader
     def load_user(user_id):
-        from .models import User
-        return User.query.get(int(user_id))
+        # Identità slim in cache: l'User completo si carica solo se una pagina lo usa
+        from .principal import load_principal
+        return load_principal(int(user_id))
 
     @app.errorhandler(404)
     def not_found(error):
@@ -139,7 +145,8 @@ def create_app():
                             ('is_scraped', 'BOOLEAN DEFAULT FALSE'),
                             ('claim_token', 'VARCHAR(64)'),
                             ('verified_at', 'TIMESTAMP'),
-                            ('data_source', 'VARCHAR(100)')
+                            ('data_source', 'VARCHAR(100)'),
+                            ('pending_orders_count', 'INTEGER NOT NULL DEFAULT 0')
                         ]
                         for col_name, col_type in additions_user:
                             if col_name not in user_cols:
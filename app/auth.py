@@ -1,6 +1,6 @@
 import os
 from flask import Blueprint, render_template, redirect, url_for, flash, request
-from flask_login import login_user, logout_user, login_required
+from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash
 from sqlalchemy import or_
 from sqlalchemy.exc import IntegrityError
@@ -8,6 +8,7 @@ from . import db
 from .models import User
 from .forms import RegistrationForm, LoginForm
 from .email_utils import send_email
+from .principal import forget_principal
 
 auth = Blueprint('auth', __name__)
 
@@ -74,6 +75,7 @@ def login():
 @auth.route('/logout')
 @login_required
 def logout():
+    forget_principal(current_user.id)
     logout_user()
     flash('✓ Logout effettuato con successo. A presto!', 'info')
     return redirect(url_for('main.index'))
@@ -0,0 +1,54 @@
+import threading
+import time
+
+
+class TTLCache:
+    """Piccola cache in memoria con scadenza per chiave (thread-safe).
+
+    Pensata per il singolo worker gunicorn: ogni processo ha la sua copia.
+    """
+
+    def __init__(self, ttl=60, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at < time.time():
+            self._data.pop(key, None)
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            if len(self._data) >= self.max_entries:
+                self._evict()
+            self._data[key] = (value, time.time() + (self.ttl if ttl is None else ttl))
+        return value
+
+    def get_or_set(self, key, factory, ttl=None):
+        value = self.get(key)
+        if value is None:
+            value = self.set(key, factory(), ttl)
+        return value
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _evict(self):
+        now = time.time()
+        for key in [k for k, (_, exp) in self._data.items() if exp < now]:
+            del self._data[key]
+        # Ancora piena: scarta le voci più vecchie
+        if len(self._data) >= self.max_entries:
+            for key in sorted(self._data, key=lambda k: self._data[k][1])[:len(self._data) // 4 or 1]:
+                del self._data[key]
@@ -1,18 +1,20 @@
-from flask import Blueprint, session, redirect, url_for, request, flash, render_template
+from flask import Blueprint, session, redirect, url_for, request, flash, render_template, jsonify
 from flask_login import login_required, current_user
 from . import db
-from .models import Product, Message, User, OrderRequest
-from .email_utils import send_email
+from .models import Product, Message, User, OrderRequest, OrderItem
+from .outbox import enqueue_email
+from .cart_store import get_cart, save_cart
+from .orders import TRANSITIONS, bulk_transition, item_values, existing_product_ids, parse_day
 from urllib.parse import quote
 import json
+from datetime import datetime, timedelta
 
 cart = Blueprint('cart', __name__)
 
-def _get_cart():
-    return session.setdefault('cart', {})
-
-def _save_session():
-    session.modified = True
+@cart.app_context_processor
+def inject_cart():
+    # Funzione e non valore: lo store viene letto solo dalle pagine che mostrano il carrello
+    return dict(current_cart=get_cart)
 
 
 def _profile_url_for_farmer(farmer):
@@ -38,7 +40,7 @@ def add_to_cart(product_id):
         farmer = User.query.get(farmer_id)
         return redirect(_profile_url_for_farmer(farmer))
     
-    c = _get_cart()
+    c = get_cart()
     farmer_cart = c.setdefault(str(farmer_id), {})
     item = farmer_cart.setdefault(str(product_id), {
         'name': product.name,
@@ -48,7 +50,7 @@ def add_to_cart(product_id):
         'min_qty': min_qty
     })
     item['qty'] += qty
-    _save_session()
+    save_cart()
     flash('✓ Prodotto aggiunto al carrello', 'success')
     farmer = User.query.get(farmer_id)
     return redirect(_profile_url_for_farmer(farmer))
@@ -57,13 +59,13 @@ def add_to_cart(product_id):
 def remove_from_cart(product_id):
     product = Product.query.get_or_404(product_id)
     farmer_id = product.user_id
-    c = _get_cart()
+    c = get_cart()
     farmer_cart = c.get(str(farmer_id), {})
     if str(product_id) in farmer_cart:
         farmer_cart.pop(str(product_id))
         if not farmer_cart:
             c.pop(str(farmer_id), None)
-        _save_session()
+        save_cart()
         flash('Prodotto rimosso dal carrello', 'info')
     farmer = User.query.get(farmer_id)
     return redirect(_profile_url_for_farmer(farmer))
@@ -81,7 +83,7 @@ def update_cart(product_id):
     except Exception:
         qty = min_qty
     
-    c = _get_cart()
+    c = get_cart()
     farmer_cart = c.get(str(farmer_id), {})
     if str(product_id) in farmer_cart:
         if action == 'increment':
@@ -98,15 +100,15 @@ def update_cart(product_id):
                 qty = min_qty
             farmer_cart[str(product_id)]['qty'] = qty
         farmer_cart[str(product_id)]['min_qty'] = min_qty
-        _save_session()
+        save_cart()
     farmer = User.query.get(farmer_id)
     return redirect(url_for('profiles.view_profile', username=farmer.username))
 
 @cart.route('/cart/clear/<int:farmer_id>', methods=['POST'])
 def clear_cart(farmer_id):
-    c = _get_cart()
+    c = get_cart()
     c.pop(str(farmer_id), None)
-    _save_session()
+    save_cart()
     flash('Carrello svuotato', 'info')
     farmer = User.query.get_or_404(farmer_id)
     return redirect(_profile_url_for_farmer(farmer))
@@ -126,7 +128,7 @@ def order_success():
 
 @cart.route('/cart/whatsapp/<int:farmer_id>', methods=['GET', 'POST'])
 def whatsapp_order(farmer_id):
-    c = _get_cart()
+    c = get_cart()
     farmer_cart = c.get(str(farmer_id))
     farmer = User.query.get_or_404(farmer_id)
     if not farmer_cart:
@@ -179,7 +181,7 @@ def whatsapp_order(farmer_id):
 @cart.route('/orders/create/<int:farmer_id>', methods=['POST'])
 def create_order(farmer_id):
     # Allow guests to place orders: collect contact info
-    c = _get_cart()
+    c = get_cart()
     farmer_cart = c.get(str(farmer_id))
     if not farmer_cart:
         flash('Il carrello è vuoto', 'warning')
@@ -218,76 +220,61 @@ def create_order(farmer_id):
         total_price=total,
         status='pending'
     )
+    known = existing_product_ids(farmer_cart)
+    order.items = [OrderItem(**values) for values in item_values(farmer_cart, known)]
     db.session.add(order)
-    # Retry logic for intermittent SSL errors
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            db.session.commit()
-            break
-        except Exception as e:
-            db.session.rollback()
-            if attempt == max_retries - 1:
-                flash('Errore temporaneo nel salvare l\'ordine. Riprova tra poco.', 'danger')
-                farmer = User.query.get_or_404(farmer_id)
-                return redirect(url_for('profiles.view_profile', username=farmer.username))
-            import time
-            time.sleep(0.5 * (attempt + 1))
 
-    # If l'utente è registrato, invia anche un messaggio privato al venditore
+    # Messaggio privato e email vanno nello stesso commit dell'ordine; le email le invia worker.py
     if order.client_id:
-        try:
-            lines = [f"Nuovo ordine da {order.client_name or 'Cliente'}"]
-            for _, item in farmer_cart.items():
-                lines.append(f"- {item['name']} x{item['qty']} {item['unit']}")
-            lines.append(f"Totale: {order.total_price:.2f} €")
-            if order.delivery_requested and order.delivery_address:
-                lines.append(f"Consegna: {order.delivery_address}")
-            if order.client_phone:
-                lines.append(f"Telefono: {order.client_phone}")
-            if order.client_email:
-                lines.append(f"Email: {order.client_email}")
-            msg = Message(content="\n".join(lines), sender_id=order.client_id, recipient_id=farmer_id)
-            db.session.add(msg)
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
+        lines = [f"Nuovo ordine da {order.client_name or 'Cliente'}"]
+        for _, item in farmer_cart.items():
+            lines.append(f"- {item['name']} x{item['qty']} {item['unit']}")
+        lines.append(f"Totale: {order.total_price:.2f} €")
+        if order.delivery_requested and order.delivery_address:
+            lines.append(f"Consegna: {order.delivery_address}")
+        if order.client_phone:
+            lines.append(f"Telefono: {order.client_phone}")
+        if order.client_email:
+            lines.append(f"Email: {order.client_email}")
+        db.session.add(Message(content="\n".join(lines), sender_id=order.client_id, recipient_id=farmer_id))
     # Notify farmer via email (if available)
+    if farmer.email:
+        items = []
+        for _, item in farmer_cart.items():
+            items.append(f"<li><strong>{item['name']}</strong> x{item['qty']} {item['unit']} — {float(item['price'])*int(item['qty']):.2f} €</li>")
+        html = f"""
+            <h3>Nuovo ordine ricevuto</h3>
+            <p><strong>Da:</strong> {order.client_name or 'Cliente'}<br/>
+            <strong>Telefono:</strong> {order.client_phone or '—'}<br/>
+            <strong>Email:</strong> {order.client_email or '—'}</p>
+            <ul>{''.join(items)}</ul>
+            <p><strong>Totale:</strong> {order.total_price:.2f} €</p>
+            {'<p><strong>Consegna:</strong> ' + (order.delivery_address or '') + '</p>' if order.delivery_requested else ''}
+            <p>Accedi alla tua pagina per <strong>accettare</strong> o <strong>rifiutare</strong> l'ordine.</p>
+        """
+        enqueue_email(farmer.email, "OrtoVicino: nuovo ordine", html)
+    # Send confirmation to client if email provided
+    if order.client_email:
+        client_items = []
+        for _, item in farmer_cart.items():
+            client_items.append(f"<li><strong>{item['name']}</strong> x{item['qty']} {item['unit']} — {float(item['price'])*int(item['qty']):.2f} €</li>")
+        enqueue_email(order.client_email, "Conferma ordine inviato", f"""
+            <h3>Ordine inviato a {farmer.company_name or farmer.username}</h3>
+            <p><strong>Dettaglio ordine:</strong></p>
+            <ul>{''.join(client_items)}</ul>
+            <p><strong>Totale:</strong> {order.total_price:.2f} €</p>
+            {'<p><strong>Consegna richiesta a:</strong> ' + (order.delivery_address or '') + '</p>' if order.delivery_requested else '<p><strong>Ritiro presso azienda</strong></p>'}
+            <p>Riceverai conferma dall'azienda appena l'ordine verrà accettato.</p>
+        """)
     try:
-        farmer = User.query.get_or_404(farmer_id)
-        if farmer.email:
-            items = []
-            for _, item in farmer_cart.items():
-                items.append(f"<li><strong>{item['name']}</strong> x{item['qty']} {item['unit']} — {float(item['price'])*int(item['qty']):.2f} €</li>")
-            html = f"""
-                <h3>Nuovo ordine ricevuto</h3>
-                <p><strong>Da:</strong> {order.client_name or 'Cliente'}<br/>
-                <strong>Telefono:</strong> {order.client_phone or '—'}<br/>
-                <strong>Email:</strong> {order.client_email or '—'}</p>
-                <ul>{''.join(items)}</ul>
-                <p><strong>Totale:</strong> {order.total_price:.2f} €</p>
-                {'<p><strong>Consegna:</strong> ' + (order.delivery_address or '') + '</p>' if order.delivery_requested else ''}
-                <p>Accedi alla tua pagina per <strong>accettare</strong> o <strong>rifiutare</strong> l'ordine.</p>
-            """
-            send_email(farmer.email, "OrtoVicino: nuovo ordine", html)
-        # Send confirmation to client if email provided
-        if order.client_email:
-            client_items = []
-            for _, item in farmer_cart.items():
-                client_items.append(f"<li><strong>{item['name']}</strong> x{item['qty']} {item['unit']} — {float(item['price'])*int(item['qty']):.2f} €</li>")
-            send_email(order.client_email, "Conferma ordine inviato", f"""
-                <h3>Ordine inviato a {farmer.company_name or farmer.username}</h3>
-                <p><strong>Dettaglio ordine:</strong></p>
-                <ul>{''.join(client_items)}</ul>
-                <p><strong>Totale:</strong> {order.total_price:.2f} €</p>
-                {'<p><strong>Consegna richiesta a:</strong> ' + (order.delivery_address or '') + '</p>' if order.delivery_requested else '<p><strong>Ritiro presso azienda</strong></p>'}
-                <p>Riceverai conferma dall'azienda appena l'ordine verrà accettato.</p>
-            """)
+        db.session.commit()
     except Exception:
-        pass
+        db.session.rollback()
+        flash('Errore temporaneo nel salvare l\'ordine. Riprova tra poco.', 'danger')
+        return redirect(url_for('profiles.view_profile', username=farmer.username))
     # Clear cart after creating order
     c.pop(str(farmer_id), None)
-    _save_session()
+    save_cart()
     
     # Redirect to order success page
     return redirect(url_for('cart.order_success'))
@@ -300,31 +287,22 @@ def accept_order(order_id):
         flash('Non autorizzato', 'danger')
         return redirect(url_for('profiles.view_profile', username=current_user.username))
     order.status = 'confirmed'
-    db.session.commit()
     # Send in-app message if client is registered
     if order.client_id:
-        try:
-            msg = Message(
-                content=f"Il tuo ordine #{order.id} è stato confermato! L'azienda ti contatterà a breve per i dettagli.",
-                sender_id=current_user.id,
-                recipient_id=order.client_id
-            )
-            db.session.add(msg)
-            db.session.commit()
-        except Exception:
-            pass
+        db.session.add(Message(
+            content=f"Il tuo ordine #{order.id} è stato confermato! L'azienda ti contatterà a breve per i dettagli.",
+            sender_id=current_user.id,
+            recipient_id=order.client_id
+        ))
     # Send acceptance email to client
     if order.client_email:
-        try:
-            farmer = User.query.get(order.farmer_id)
-            send_email(order.client_email, "Ordine confermato", f"""
-                <h3>Il tuo ordine è stato confermato!</h3>
-                <p><strong>Azienda:</strong> {farmer.company_name or farmer.username}</p>
-                <p><strong>Totale:</strong> {order.total_price:.2f} €</p>
-                <p>L'azienda ti contatterà a breve per i dettagli.</p>
-            """)
-        except Exception:
-            pass
+        enqueue_email(order.client_email, "Ordine confermato", f"""
+            <h3>Il tuo ordine è stato confermato!</h3>
+            <p><strong>Azienda:</strong> {current_user.company_name or current_user.username}</p>
+            <p><strong>Totale:</strong> {order.total_price:.2f} €</p>
+            <p>L'azienda ti contatterà a breve per i dettagli.</p>
+        """)
+    db.session.commit()
     flash('Ordine confermato', 'success')
     return redirect(request.referrer or url_for('profiles.my_orders'))
 
@@ -337,23 +315,17 @@ def complete_order(order_id):
         flash('Non autorizzato', 'danger')
         return redirect(url_for('main.index'))
     
-    from datetime import datetime
     order.status = 'completed'
     order.completed_at = datetime.utcnow()
-    db.session.commit()
     
     # Notifica cliente
     if order.client_id:
-        try:
-            msg = Message(
-                content=f"Il tuo ordine #{order.id} è stato completato! Puoi lasciare una recensione dalla pagina I Miei Ordini.",
-                sender_id=current_user.id,
-                recipient_id=order.client_id
-            )
-            db.session.add(msg)
-            db.session.commit()
-        except Exception:
-            pass
+        db.session.add(Message(
+            content=f"Il tuo ordine #{order.id} è stato completato! Puoi lasciare una recensione dalla pagina I Miei Ordini.",
+            sender_id=current_user.id,
+            recipient_id=order.client_id
+        ))
+    db.session.commit()
     
     flash('✅ Ordine segnato come completato!', 'success')
     return redirect(request.referrer or url_for('profiles.my_orders'))
@@ -366,74 +338,87 @@ def reject_order(order_id):
         flash('Non autorizzato', 'danger')
         return redirect(url_for('profiles.view_profile', username=current_user.username))
     order.status = 'rejected'
-    db.session.commit()
     # Send in-app message if client is registered
     if order.client_id:
-        try:
-            msg = Message(
-                content=f"Il tuo ordine #{order.id} non può essere evaso al momento. Contatta l'azienda per maggiori informazioni.",
-                sender_id=current_user.id,
-                recipient_id=order.client_id
-            )
-            db.session.add(msg)
-            db.session.commit()
-        except Exception:
-            pass
+        db.session.add(Message(
+            content=f"Il tuo ordine #{order.id} non può essere evaso al momento. Contatta l'azienda per maggiori informazioni.",
+            sender_id=current_user.id,
+            recipient_id=order.client_id
+        ))
     # Send rejection email to client
     if order.client_email:
-        try:
-            farmer = User.query.get(order.farmer_id)
-            send_email(order.client_email, "Ordine non disponibile", f"""
-                <h3>Ordine non accettato</h3>
-                <p><strong>Azienda:</strong> {farmer.company_name or farmer.username}</p>
-                <p>Ci dispiace, l'ordine non può essere evaso al momento. Prova a contattare direttamente l'azienda.</p>
-            """)
-        except Exception:
-            pass
+        enqueue_email(order.client_email, "Ordine non disponibile", f"""
+            <h3>Ordine non accettato</h3>
+            <p><strong>Azienda:</strong> {current_user.company_name or current_user.username}</p>
+            <p>Ci dispiace, l'ordine non può essere evaso al momento. Prova a contattare direttamente l'azienda.</p>
+        """)
+    db.session.commit()
     flash('Ordine rifiutato', 'info')
     return redirect(request.referrer or url_for('profiles.my_orders'))
 
 
+# Notifiche al cliente dopo un'azione in blocco: (messaggio in-app, oggetto email, testo email)
+BULK_NOTIFICATIONS = {
+    'accept': ("Il tuo ordine #{id} è stato confermato! L'azienda ti contatterà a breve per i dettagli.",
+               "Ordine confermato", "Il tuo ordine è stato confermato!"),
+    'reject': ("Il tuo ordine #{id} non può essere evaso al momento. Contatta l'azienda per maggiori informazioni.",
+               "Ordine non disponibile", "L'ordine non può essere evaso al momento."),
+    'complete': ("Il tuo ordine #{id} è stato completato! Puoi lasciare una recensione dalla pagina I Miei Ordini.",
+                 None, None),
+}
+
+
 @cart.route('/orders/bulk', methods=['POST'])
 @login_required
 def bulk_update_orders():
+    """Accetta, rifiuta o completa in blocco gli ordini selezionati o di un intervallo di date"""
+    wants_json = request.accept_mimetypes.best == 'application/json'
     if not current_user.is_farmer:
+        if wants_json:
+            return jsonify(error='Solo gli agricoltori possono gestire gli ordini'), 403
         flash('Solo gli agricoltori possono gestire gli ordini', 'warning')
         return redirect(url_for('main.index'))
 
-    order_ids = request.form.getlist('order_ids')
+    order_ids = [int(i) for i in request.form.getlist('order_ids') if i.isdigit()]
     action = request.form.get('action')
+    date_from = parse_day(request.form.get('date_from'))
+    date_to = parse_day(request.form.get('date_to'))
+    if date_to:
+        # Data finale inclusa
+        date_to += timedelta(days=1)
 
-    if not order_ids:
-        flash('Seleziona almeno un ordine', 'warning')
+    error = None
+    if action not in TRANSITIONS:
+        error = 'Azione non valida'
+    elif not (order_ids or date_from or date_to):
+        error = 'Seleziona almeno un ordine o un intervallo di date'
+    if error:
+        if wants_json:
+            return jsonify(error=error), 400
+        flash(error, 'danger' if action not in TRANSITIONS else 'warning')
         return redirect(request.referrer or url_for('profiles.my_orders'))
 
-    valid_actions = {'accept': 'accepted', 'reject': 'rejected'}
-    if action not in valid_actions:
-        flash('Azione non valida', 'danger')
-        return redirect(request.referrer or url_for('profiles.my_orders'))
-
-    orders = OrderRequest.query.filter(
-        OrderRequest.id.in_(order_ids),
-        OrderRequest.farmer_id == current_user.id,
-        OrderRequest.status == 'pending'
-    ).all()
-
-    for order in orders:
-        order.status = valid_actions[action]
-        if order.client_email:
-            try:
-                status_subject = "Ordine accettato" if action == 'accept' else "Ordine non accettato"
-                status_body = "Il tuo ordine è stato accettato!" if action == 'accept' else "L'ordine non può essere evaso al momento."
-                send_email(order.client_email, status_subject, f"""
-                    <h3>{status_body}</h3>
-                    <p><strong>Azienda:</strong> {current_user.company_name or current_user.username}</p>
-                    <p><strong>Totale:</strong> {order.total_price:.2f} €</p>
-                """)
-            except Exception:
-                pass
+    rows, outcomes = bulk_transition(current_user.id, action, order_ids or None, date_from, date_to)
+    message_text, subject, body = BULK_NOTIFICATIONS[action]
+    company = current_user.company_name or current_user.username
+    for row in rows:
+        if row.client_id:
+            db.session.add(Message(content=message_text.format(id=row.id), sender_id=current_user.id,
+                                   recipient_id=row.client_id))
+        if subject and row.client_email:
+            enqueue_email(row.client_email, subject, f"""
+                <h3>{body}</h3>
+                <p><strong>Azienda:</strong> {company}</p>
+                <p><strong>Totale:</strong> {row.total_price or 0:.2f} €</p>
+            """)
     db.session.commit()
-    flash(f"Aggiornati {len(orders)} ordini", 'success')
+
+    skipped = [i for i, o in outcomes.items() if o['outcome'] != 'updated']
+    if wants_json:
+        return jsonify(updated=len(rows), orders={str(i): o for i, o in outcomes.items()})
+    flash(f"Aggiornati {len(rows)} ordini", 'success')
+    if skipped:
+        flash(f"{len(skipped)} ordini non modificabili: " + ', '.join(f'#{i}' for i in sorted(skipped)), 'warning')
     return redirect(request.referrer or url_for('profiles.my_orders'))
 
 
@@ -461,14 +446,12 @@ def reply_order(order_id):
         db.session.commit()
         flash('Risposta inviata al cliente', 'success')
     elif order.client_email:
-        try:
-            send_email(order.client_email, f"Risposta al tuo ordine #{order.id}", f"""
-                <p><strong>{current_user.company_name or current_user.username}</strong> ha risposto al tuo ordine:</p>
-                <blockquote>{message_text}</blockquote>
-            """)
-            flash('Risposta inviata via email al cliente', 'success')
-        except Exception:
-            flash('Impossibile inviare il messaggio', 'danger')
+        enqueue_email(order.client_email, f"Risposta al tuo ordine #{order.id}", f"""
+            <p><strong>{current_user.company_name or current_user.username}</strong> ha risposto al tuo ordine:</p>
+            <blockquote>{message_text}</blockquote>
+        """)
+        db.session.commit()
+        flash('Risposta inviata via email al cliente', 'success')
     else:
         flash('Mancano i contatti del cliente', 'warning')
 
@@ -0,0 +1,152 @@
+import json
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app, request, session
+from sqlalchemy import delete, insert, select, update
+from . import db
+from .models import CartSession
+
+# Carrelli non toccati da più di così vengono scartati (secondi)
+CART_TTL = 14 * 24 * 3600
+# Pulizia dei carrelli scaduti al massimo una volta ogni tanto per processo
+PURGE_INTERVAL = 3600
+
+# Ordine dei campi di un articolo nel formato compatto
+_ITEM_FIELDS = ('qty', 'price', 'min_qty', 'name', 'unit')
+
+
+def pack(cart):
+    """Serializza il carrello come JSON compatto: ogni articolo è una lista, non un dict"""
+    return json.dumps({
+        farmer_id: {pid: [item.get(f) for f in _ITEM_FIELDS] for pid, item in items.items()}
+        for farmer_id, items in cart.items() if items
+    }, separators=(',', ':'), ensure_ascii=False)
+
+
+def unpack(raw):
+    return {
+        farmer_id: {pid: dict(zip(_ITEM_FIELDS, values)) for pid, values in items.items()}
+        for farmer_id, items in json.loads(raw).items()
+    }
+
+
+class MemoryCartStore:
+    """Carrelli nel processo: per sviluppo e test (si perdono al riavvio)"""
+
+    def __init__(self, ttl=CART_TTL):
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def load(self, cart_id):
+        entry = self._data.get(cart_id)
+        if entry is None or entry[1] < time.time() - self.ttl:
+            return None
+        return entry[0]
+
+    def save(self, cart_id, raw):
+        with self._lock:
+            self._data[cart_id] = (raw, time.time())
+
+    def delete(self, cart_id):
+        with self._lock:
+            self._data.pop(cart_id, None)
+
+    def purge_expired(self):
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [k for k, (_, ts) in self._data.items() if ts < cutoff]
+            for k in expired:
+                del self._data[k]
+        return len(expired)
+
+
+class SqlCartStore:
+    """Carrelli nella tabella cart_session del database dell'app (SQLite in locale, PostgreSQL in produzione).
+
+    Usa connessioni proprie, fuori dalla sessione ORM della richiesta: salvare
+    il carrello non conferma né annulla altre modifiche in corso.
+    """
+
+    table = CartSession.__table__
+
+    def __init__(self, ttl=CART_TTL):
+        self.ttl = ttl
+        self._last_purge = 0.0
+
+    def _cutoff(self):
+        return datetime.utcnow() - timedelta(seconds=self.ttl)
+
+    def load(self, cart_id):
+        with db.engine.connect() as conn:
+            return conn.execute(select(self.table.c.data).where(
+                self.table.c.id == cart_id,
+                self.table.c.updated_at >= self._cutoff()
+            )).scalar()
+
+    def save(self, cart_id, raw):
+        now = datetime.utcnow()
+        with db.engine.begin() as conn:
+            done = conn.execute(update(self.table).where(self.table.c.id == cart_id)
+                                .values(data=raw, updated_at=now)).rowcount
+            if not done:
+                conn.execute(insert(self.table).values(id=cart_id, data=raw, updated_at=now))
+        if time.time() - self._last_purge > PURGE_INTERVAL:
+            self.purge_expired()
+
+    def delete(self, cart_id):
+        with db.engine.begin() as conn:
+            conn.execute(delete(self.table).where(self.table.c.id == cart_id))
+
+    def purge_expired(self):
+        self._last_purge = time.time()
+        with db.engine.begin() as conn:
+            return conn.execute(delete(self.table).where(self.table.c.updated_at < self._cutoff())).rowcount
+
+
+STORES = {'sql': SqlCartStore, 'memory': MemoryCartStore}
+
+
+def get_store():
+    """Backend dei carrelli scelto con CART_STORE ('sql' di default, oppure 'memory')"""
+    store = current_app.extensions.get('cart_store')
+    if store is None:
+        name = current_app.config.get('CART_STORE') or os.environ.get('CART_STORE', 'sql')
+        store = current_app.extensions['cart_store'] = STORES[name]()
+    return store
+
+
+def get_cart():
+    """Carrello della richiesta corrente, letto dallo store una volta sola"""
+    cart = getattr(request, '_cart', None)
+    if cart is None:
+        cart = {}
+        cart_id = session.get('cart_id')
+        if cart_id:
+            raw = get_store().load(cart_id)
+            cart = unpack(raw) if raw else {}
+        request._cart = cart
+        # Carrelli salvati nel cookie dalle versioni precedenti
+        legacy = session.pop('cart', None)
+        if legacy:
+            for farmer_id, items in legacy.items():
+                cart.setdefault(farmer_id, {}).update(items)
+            save_cart()
+    return cart
+
+
+def save_cart():
+    """Scrive il carrello nello store; un carrello vuoto viene eliminato"""
+    cart = get_cart()
+    cart_id = session.get('cart_id')
+    if not any(cart.values()):
+        if cart_id:
+            get_store().delete(cart_id)
+            session.pop('cart_id', None)
+        return
+    if not cart_id:
+        cart_id = session['cart_id'] = secrets.token_hex(16)
+    get_store().save(cart_id, pack(cart))
@@ -0,0 +1,208 @@
+import threading
+import time
+from collections import Counter
+from sqlalchemy import event, inspect as sa_inspect
+from sqlalchemy.orm import object_session
+from . import db
+from .models import User
+from .search import fold
+
+# Optional: numpy accumulates the trigram hits in one pass
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+# Quota minima dei trigrammi della query presenti nel profilo
+MIN_COVERAGE = 0.35
+# Ricostruzione forzata dell'indice dopo questo intervallo (secondi)
+INDEX_MAX_AGE = 600
+
+
+def trigrams(value):
+    """Trigrammi delle parole (stile pg_trgm: due spazi prima, uno dopo)"""
+    grams = set()
+    for word in ''.join(ch if ch.isalnum() else ' ' for ch in fold(value or '')).split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class ClaimIndex:
+    """Indice a trigrammi sui profili importati e non ancora rivendicati.
+
+    Tollera errori di battitura: un profilo è un risultato se contiene una
+    buona parte dei trigrammi della query, indipendentemente dalla posizione.
+    Ranking per copertura della query e poi per similarità (come pg_trgm).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirty = True
+        self._built_at = 0.0
+        self.ids = []
+        self.sizes = []
+        self.alive = []
+        self.postings = {}
+        self.positions = {}
+        self.id_array = None
+        # Per ogni profilo: (username, nome, comune, provincia) per l'autocompletamento
+        self.meta = []
+
+    def invalidate(self):
+        self._dirty = True
+
+    def load(self, rows, meta=None):
+        """Carica l'indice da (id, testo) già pronti (usato anche dai benchmark)"""
+        ids, sizes, postings = [], [], {}
+        for pos, (uid, value) in enumerate(rows):
+            grams = trigrams(value)
+            ids.append(uid)
+            sizes.append(len(grams))
+            for g in grams:
+                postings.setdefault(g, []).append(pos)
+        if HAS_NUMPY:
+            postings = {g: np.asarray(p, dtype=np.int32) for g, p in postings.items()}
+            sizes = np.asarray(sizes, dtype=np.float64)
+            alive = np.ones(len(ids), dtype=bool)
+        else:
+            alive = [True] * len(ids)
+        self.ids, self.sizes, self.alive, self.postings = ids, sizes, alive, postings
+        self.id_array = np.asarray(ids, dtype=np.int64) if HAS_NUMPY else None
+        self.meta = list(meta) if meta is not None else [(None, None, None, None)] * len(ids)
+        self.positions = {uid: pos for pos, uid in enumerate(ids)}
+        self._built_at = time.time()
+        self._dirty = False
+
+    def _build(self):
+        rows = db.session.query(User.id, User.company_name, User.username, User.city, User.province).filter(
+            User.is_farmer == True,
+            User.is_scraped == True,
+            User.is_claimed == False
+        ).order_by(User.id).all()
+        self.load([(r.id, ' '.join(filter(None, (r.company_name or r.username, r.city, r.province)))) for r in rows],
+                  [(r.username, r.company_name or r.username, r.city, r.province) for r in rows])
+
+    def ensure(self):
+        if self._dirty or time.time() - self._built_at > INDEX_MAX_AGE:
+            with self._lock:
+                if self._dirty or time.time() - self._built_at > INDEX_MAX_AGE:
+                    self._build()
+        return self
+
+    def discard(self, user_id):
+        """Toglie un profilo rivendicato senza ricostruire l'indice"""
+        pos = self.positions.get(user_id)
+        if pos is not None:
+            self.alive[pos] = False
+
+    def search(self, q, limit=10):
+        """Lista di (user_id, score) ordinata per rilevanza"""
+        grams = trigrams(q)
+        if not grams or not self.ids:
+            return []
+        lists = [self.postings[g] for g in grams if g in self.postings]
+        if not lists:
+            return []
+        n_query = len(grams)
+        if HAS_NUMPY:
+            hits = np.bincount(np.concatenate(lists), minlength=len(self.ids)).astype(np.float64)
+            hits[~self.alive] = 0
+            coverage = hits / n_query
+            candidates = np.nonzero(coverage >= MIN_COVERAGE)[0]
+            if not len(candidates):
+                return []
+            similarity = hits[candidates] / (n_query + self.sizes[candidates] - hits[candidates])
+            order = np.lexsort((self.id_array[candidates], -similarity, -coverage[candidates]))[:limit]
+            return [(self.ids[candidates[k]], float(coverage[candidates[k]] + similarity[k])) for k in order]
+        counts = Counter()
+        for postings in lists:
+            counts.update(postings)
+        scored = []
+        for pos, n in counts.items():
+            if not self.alive[pos] or n / n_query < MIN_COVERAGE:
+                continue
+            similarity = n / (n_query + self.sizes[pos] - n)
+            scored.append((-(n / n_query), -similarity, self.ids[pos]))
+        scored.sort()
+        return [(uid, -cov - sim) for cov, sim, uid in scored[:limit]]
+
+    def suggest(self, q, limit=8):
+        """Suggerimenti per l'autocompletamento come (user_id, dati), senza accesso al database"""
+        out = []
+        for uid, _ in self.search(q, limit):
+            username, name, city, province = self.meta[self.positions[uid]]
+            out.append((uid, {'username': username, 'name': name, 'city': city, 'province': province}))
+        return out
+
+
+claim_index = ClaimIndex()
+
+# Attributi di User che determinano presenza e testo nell'indice
+_INDEXED_ATTRS = ('is_farmer', 'is_scraped', 'company_name', 'username', 'city', 'province')
+
+
+def _record(target, op):
+    """Modifica all'indice applicata solo al commit: un rollback non deve nascondere profili"""
+    session = object_session(target)
+    if session is None:
+        claim_index.invalidate()
+        return
+    session.info.setdefault('claim_ops', []).append(op)
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_delete')
+def _profile_added_or_removed(mapper, connection, target):
+    if target.is_scraped:
+        _record(target, None)
+
+
+@event.listens_for(User, 'after_update')
+def _profile_updated(mapper, connection, target):
+    state = sa_inspect(target)
+    if any(state.attrs[attr].history.has_changes() for attr in _INDEXED_ATTRS):
+        _record(target, None)
+    elif state.attrs['is_claimed'].history.has_changes():
+        # None = ricostruire l'indice, altrimenti l'id del profilo rivendicato
+        _record(target, target.id if target.is_claimed else None)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_after_commit(session):
+    for op in session.info.pop('claim_ops', ()):
+        if op is None:
+            claim_index.invalidate()
+        else:
+            claim_index.discard(op)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_on_rollback(session, previous_transaction):
+    session.info.pop('claim_ops', None)
+
+
+def search_claimable(q, limit=20):
+    """Profili rivendicabili più simili alla query, come lista di User nell'ordine di rilevanza"""
+    hits = claim_index.ensure().search(q, limit)
+    if not hits:
+        return []
+    # Lo stato resta verificato in SQL: un profilo può essere stato rivendicato da un altro worker
+    rows = User.query.filter(User.id.in_([uid for uid, _ in hits]), User.is_claimed == False).all()
+    by_id = {u.id: u for u in rows}
+    return [by_id[uid] for uid, _ in hits if uid in by_id]
+
+
+def suggest_claimable(q, limit=8):
+    """Suggerimenti per l'autocompletamento dall'indice, senza i profili già rivendicati.
+
+    Gli altri worker aggiornano l'indice al più dopo INDEX_MAX_AGE: lo stato
+    viene verificato con una sola query IN sugli id suggeriti.
+    """
+    suggestions = claim_index.ensure().suggest(q, limit)
+    if not suggestions:
+        return []
+    open_ids = {uid for (uid,) in db.session.query(User.id).filter(
+        User.id.in_([uid for uid, _ in suggestions]), User.is_claimed == False)}
+    return [item for uid, item in suggestions if uid in open_ids]
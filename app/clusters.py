@@ -0,0 +1,119 @@
+import json
+import math
+import threading
+from .cache import TTLCache
+from .geo import farmer_index
+
+# Raggio di aggregazione in pixel e livelli di zoom precalcolati
+CLUSTER_RADIUS_PX = 60
+MIN_ZOOM = 0
+MAX_ZOOM = 16
+TILE_SIZE = 256
+
+
+def _mercator(lat, lng):
+    """Coordinate Web Mercator normalizzate in [0, 1]"""
+    lat = max(min(lat, 85.05112878), -85.05112878)
+    x = (lng + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return x, y
+
+
+def _cell_scale(zoom):
+    return TILE_SIZE * (2 ** zoom) / CLUSTER_RADIUS_PX
+
+
+class ClusterIndex:
+    """Cluster gerarchici su griglia per ogni livello di zoom.
+
+    Le celle di un livello contengono esattamente quattro celle del livello
+    successivo, quindi ogni livello si ottiene fondendo quello sotto:
+    il costo di costruzione è lineare nel numero di punti.
+    Ogni cluster è (count, somma_lat, somma_lng, posizione del primo punto).
+    """
+
+    def __init__(self, index, positions):
+        # Riferimento alla lista corrente: load() la sostituisce, non la modifica
+        self.meta = index.meta
+        self.levels = {}
+        cells = {}
+        scale = _cell_scale(MAX_ZOOM)
+        for p in positions:
+            lat, lng = float(index.lats[p]), float(index.lngs[p])
+            x, y = _mercator(lat, lng)
+            key = (int(x * scale), int(y * scale))
+            c = cells.get(key)
+            if c is None:
+                cells[key] = [1, lat, lng, p]
+            else:
+                c[0] += 1
+                c[1] += lat
+                c[2] += lng
+        self.levels[MAX_ZOOM] = cells
+        for zoom in range(MAX_ZOOM - 1, MIN_ZOOM - 1, -1):
+            parent = {}
+            for (cx, cy), (count, slat, slng, first) in self.levels[zoom + 1].items():
+                key = (cx // 2, cy // 2)
+                c = parent.get(key)
+                if c is None:
+                    parent[key] = [count, slat, slng, first]
+                else:
+                    c[0] += count
+                    c[1] += slat
+                    c[2] += slng
+            self.levels[zoom] = parent
+
+    def query(self, bbox, zoom):
+        """Cluster del livello `zoom` che cadono nel rettangolo (min_lat, max_lat, min_lng, max_lng)"""
+        zoom = max(MIN_ZOOM, min(MAX_ZOOM, int(zoom)))
+        cells = self.levels[zoom]
+        if bbox is None:
+            return list(cells.values())
+        min_lat, max_lat, min_lng, max_lng = bbox
+        scale = _cell_scale(zoom)
+        x0, y0 = _mercator(max_lat, min_lng)
+        x1, y1 = _mercator(min_lat, max_lng)
+        lo_x, lo_y, hi_x, hi_y = int(x0 * scale), int(y0 * scale), int(x1 * scale), int(y1 * scale)
+        if (hi_x - lo_x + 1) * (hi_y - lo_y + 1) > len(cells):
+            return [c for (cx, cy), c in cells.items() if lo_x <= cx <= hi_x and lo_y <= cy <= hi_y]
+        out = []
+        for cx in range(lo_x, hi_x + 1):
+            for cy in range(lo_y, hi_y + 1):
+                c = cells.get((cx, cy))
+                if c is not None:
+                    out.append(c)
+        return out
+
+    def geojson(self, bbox, zoom):
+        """FeatureCollection: centroidi con conteggio per i cluster, proprietà complete per i punti singoli"""
+        features = []
+        for count, slat, slng, first in self.query(bbox, zoom):
+            if count == 1:
+                name, slug, city, _ = self.meta[first]
+                properties = {'name': name, 'slug': slug, 'city': city}
+                coords = [round(slng, 5), round(slat, 5)]
+            else:
+                properties = {'cluster': True, 'count': count}
+                coords = [round(slng / count, 5), round(slat / count, 5)]
+            features.append({'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': coords},
+                             'properties': properties})
+        return json.dumps({'type': 'FeatureCollection', 'features': features}, separators=(',', ':'))
+
+
+# Indici per (versione dell'indice agricoltori, provincia, comune)
+_cluster_cache = TTLCache(ttl=3600, max_entries=64)
+_build_lock = threading.Lock()
+
+
+def cluster_index(province='', city=''):
+    """ClusterIndex aggiornato per i filtri dati; ricostruito quando cambiano gli agricoltori"""
+    index = farmer_index.ensure()
+    key = (index.version, province, city)
+    clusters = _cluster_cache.get(key)
+    if clusters is None:
+        with _build_lock:
+            clusters = _cluster_cache.get(key)
+            if clusters is None:
+                clusters = _cluster_cache.set(key, ClusterIndex(index, index.select(None, province, city)))
+    return clusters
@@ -0,0 +1,185 @@
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import and_, case, delete, event, func, insert, or_, select, update
+from . import db
+from .models import Message, Conversation, User
+from .summaries import upsert, table_ready, backfill_on_create
+
+# Caratteri del messaggio salvati nel riepilogo (l'inbox ne mostra 60)
+PREVIEW_LENGTH = 100
+
+# Ultimo messaggio mostrato nell'inbox: dal riepilogo o dalla tabella dei messaggi
+LastMessage = namedtuple('LastMessage', 'timestamp sender_id content')
+
+_message = Message.__table__
+_conversation = Conversation.__table__
+
+
+def summary_ready(bind):
+    """True se la tabella conversation esiste; senza migrazione l'inbox usa la query a finestra"""
+    return table_ready(bind, _conversation)
+
+
+def pair(a, b):
+    return (a, b) if a < b else (b, a)
+
+
+@event.listens_for(Message, 'after_insert')
+def _message_sent(mapper, connection, target):
+    if target.sender_id == target.recipient_id or not summary_ready(connection):
+        return
+    low, high = pair(target.sender_id, target.recipient_id)
+    timestamp = target.__dict__.get('timestamp')
+    if not isinstance(timestamp, datetime):
+        # Default lato server: il valore va riletto
+        timestamp = connection.execute(select(_message.c.timestamp).where(_message.c.id == target.id)).scalar()
+    unread = 'unread_low' if target.recipient_id == low else 'unread_high'
+    upsert(connection, _conversation, {'low_id': low, 'high_id': high},
+           {unread: 0 if target.read else 1},
+           {'last_message_id': target.id, 'last_message_at': timestamp, 'last_sender_id': target.sender_id,
+            'last_preview': (target.content or '')[:PREVIEW_LENGTH]})
+
+
+def mark_read(reader_id, other_id):
+    """Segna come letti i messaggi ricevuti da other_id e azzera il contatore della conversazione"""
+    count = Message.query.filter_by(sender_id=other_id, recipient_id=reader_id, read=False).update({'read': True})
+    if count and summary_ready(db.engine):
+        low, high = pair(reader_id, other_id)
+        column = 'unread_low' if reader_id == low else 'unread_high'
+        # Ricontati e non messi a zero: un messaggio arrivato nel frattempo resta non letto
+        remaining = select(func.count()).select_from(_message).where(
+            _message.c.sender_id == other_id, _message.c.recipient_id == reader_id,
+            _message.c.read == False  # noqa: E712
+        ).scalar_subquery()
+        db.session.execute(update(_conversation).where(
+            _conversation.c.low_id == low, _conversation.c.high_id == high
+        ).values({column: remaining}))
+    return count
+
+
+def _from_summary(user_id):
+    partner = case((Conversation.low_id == user_id, Conversation.high_id), else_=Conversation.low_id)
+    rows = db.session.query(Conversation, User).join(User, User.id == partner).filter(
+        or_(Conversation.low_id == user_id, Conversation.high_id == user_id)
+    ).order_by(Conversation.last_message_at.desc()).all()
+    return [{
+        'user': user,
+        'last_message': LastMessage(c.last_message_at, c.last_sender_id, c.last_preview or ''),
+        'unread_count': c.unread_for(user_id),
+    } for c, user in rows]
+
+
+def _from_messages(user_id):
+    """Stesso risultato in una sola query con funzioni a finestra sulla tabella dei messaggi"""
+    partner = case((Message.sender_id == user_id, Message.recipient_id), else_=Message.sender_id)
+    unread = case((and_(Message.recipient_id == user_id, Message.read == False), 1), else_=0)  # noqa: E712
+    ranked = select(
+        Message.id,
+        partner.label('partner_id'),
+        func.row_number().over(partition_by=partner,
+                               order_by=(Message.timestamp.desc(), Message.id.desc())).label('rn'),
+        func.sum(unread).over(partition_by=partner).label('unread'),
+    ).where(
+        or_(Message.sender_id == user_id, Message.recipient_id == user_id),
+        Message.sender_id != Message.recipient_id
+    ).subquery()
+    rows = db.session.query(Message, User, ranked.c.unread).join(ranked, ranked.c.id == Message.id).join(
+        User, User.id == ranked.c.partner_id
+    ).filter(ranked.c.rn == 1).order_by(Message.timestamp.desc()).all()
+    return [{'user': user, 'last_message': message, 'unread_count': unread or 0}
+            for message, user, unread in rows]
+
+
+def inbox_conversations(user_id):
+    """Conversazioni dell'utente, dalla più recente: utente, ultimo messaggio e non letti"""
+    if summary_ready(db.engine):
+        return _from_summary(user_id)
+    return _from_messages(user_id)
+
+
+def unread_total(user_id):
+    """Messaggi non letti dall'utente in tutte le conversazioni (badge)"""
+    if summary_ready(db.engine):
+        unread = case((Conversation.low_id == user_id, Conversation.unread_low), else_=Conversation.unread_high)
+        total = db.session.query(func.sum(unread)).filter(
+            or_(Conversation.low_id == user_id, Conversation.high_id == user_id)).scalar()
+    else:
+        total = Message.query.filter_by(recipient_id=user_id, read=False).count()
+    return total or 0
+
+
+def _fill(conn):
+    """Riempie la tabella conversation dai messaggi, con un INSERT ... SELECT a finestra"""
+    m = _message
+    low = case((m.c.sender_id < m.c.recipient_id, m.c.sender_id), else_=m.c.recipient_id)
+    high = case((m.c.sender_id < m.c.recipient_id, m.c.recipient_id), else_=m.c.sender_id)
+    not_read = func.coalesce(m.c.read, False) == False  # noqa: E712
+    window = {'partition_by': (low, high)}
+    ranked = select(
+        low.label('low_id'), high.label('high_id'), m.c.id, m.c.timestamp, m.c.sender_id,
+        func.substr(m.c.content, 1, PREVIEW_LENGTH).label('preview'),
+        func.row_number().over(order_by=(m.c.timestamp.desc(), m.c.id.desc()), **window).label('rn'),
+        func.sum(case((and_(m.c.recipient_id == low, not_read), 1), else_=0)).over(**window).label('unread_low'),
+        func.sum(case((and_(m.c.recipient_id == high, not_read), 1), else_=0)).over(**window).label('unread_high'),
+    ).where(m.c.sender_id != m.c.recipient_id).subquery()
+    conn.execute(insert(_conversation).from_select(
+        ['low_id', 'high_id', 'last_message_id', 'last_message_at', 'last_sender_id', 'last_preview',
+         'unread_low', 'unread_high'],
+        select(ranked.c.low_id, ranked.c.high_id, ranked.c.id, ranked.c.timestamp, ranked.c.sender_id,
+               ranked.c.preview, ranked.c.unread_low, ranked.c.unread_high).where(ranked.c.rn == 1)
+    ))
+
+
+# Creata da db.create_all() su un database con messaggi: riempita subito, non lasciata vuota
+backfill_on_create(_conversation, _message, _fill)
+
+
+def rebuild():
+    """Ricalcola da zero la tabella conversation dai messaggi"""
+    db.session.execute(delete(_conversation))
+    _fill(db.session.connection())
+    db.session.commit()
+    return db.session.query(func.count()).select_from(_conversation).scalar()
+
+
+# --- cronologia a pagine -------------------------------------------------------------
+
+# Messaggi caricati per volta nella pagina della conversazione
+PAGE_SIZE = 50
+
+
+def _thread(user_id, other_id):
+    return Message.query.filter(or_(
+        and_(Message.sender_id == user_id, Message.recipient_id == other_id),
+        and_(Message.sender_id == other_id, Message.recipient_id == user_id)
+    ))
+
+
+def history(user_id, other_id, before_id=None, limit=PAGE_SIZE):
+    """Gli ultimi `limit` messaggi (precedenti a before_id, se dato) in ordine cronologico.
+
+    Ordinamento e cursore sono (timestamp, id): il timestamp del messaggio di
+    riferimento è letto dal database, così il confronto avviene sempre tra
+    valori salvati. Ritorna (messaggi, True se ce ne sono altri prima).
+    """
+    query = _thread(user_id, other_id)
+    if before_id:
+        ref = select(Message.timestamp).where(Message.id == before_id).scalar_subquery()
+        query = query.filter(or_(Message.timestamp < ref, and_(Message.timestamp == ref, Message.id < before_id)))
+    rows = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit + 1).all()
+    return rows[:limit][::-1], len(rows) > limit
+
+
+def newer(user_id, other_id, after_id, limit=PAGE_SIZE):
+    """Messaggi inviati dopo after_id: gli id crescono con gli inserimenti, anche a parità di orario"""
+    return _thread(user_id, other_id).filter(Message.id > after_id).order_by(Message.id).limit(limit).all()
+
+
+def message_json(message, user_id):
+    return {
+        'id': message.id,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat() if message.timestamp else None,
+        'time': message.timestamp.strftime('%H:%M') if message.timestamp else '',
+        'mine': message.sender_id == user_id,
+    }
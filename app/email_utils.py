@@ -1,6 +1,9 @@
+import atexit
 import os
 import logging
 import smtplib
+import threading
+import time
 from email.message import EmailMessage
 
 # Optional: requests is only needed for SendGrid API
@@ -22,53 +25,234 @@ SMTP_PASS = os.environ.get('SMTP_PASS')
 SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', 'true').lower() in ('1', 'true', 'yes')
 
 SENDGRID_URL = 'https://api.sendgrid.com/v3/mail/send'
+# SendGrid accepts up to 1000 personalizations per request
+SENDGRID_BATCH = 1000
+# An idle SMTP connection is checked with NOOP before reuse after this many seconds
+SMTP_MAX_IDLE = 30
+# Idle SMTP connections kept open per process (shared by all threads/greenlets)
+SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', '4'))
 
 
-def _send_via_sendgrid(to_email: str, subject: str, html_content: str) -> bool:
-    if not HAS_REQUESTS:
-        logging.warning("SendGrid requires 'requests' library (not installed)")
-        return False
+class SmtpTransport:
+    """Pool of keep-alive SMTP connections shared by all threads, reopened when the server drops them.
+
+    STARTTLS and login are paid once per connection instead of once per message.
+    Under gevent threading.local is per greenlet, so connections live in a
+    lock-guarded module-level pool instead: at most `pool_size` stay open and
+    the extra ones are closed with QUIT as soon as they are released.
+    """
+
+    def __init__(self, max_idle=SMTP_MAX_IDLE, pool_size=SMTP_POOL_SIZE):
+        self.max_idle = max_idle
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._idle = []  # [(server, used_at)], most recently used last
+
+    def _connect(self):
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=5)
+        if SMTP_STARTTLS:
+            server.starttls()
+        server.login(SMTP_USER, SMTP_PASS)
+        return server
+
+    @staticmethod
+    def _quit(server):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                server, used_at = self._idle.pop()
+            if time.time() - used_at <= self.max_idle:
+                return server
+            try:
+                if server.noop()[0] == 250:
+                    return server
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._quit(server)
+        return self._connect()
+
+    def _release(self, server):
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append((server, time.time()))
+                return
+        self._quit(server)
+
+    def send(self, msg):
+        for attempt in range(2):
+            server = self._acquire()
+            try:
+                server.send_message(msg)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                # Stale connection: retry once on a fresh one
+                self._quit(server)
+                if attempt:
+                    raise
+                continue
+            except BaseException:
+                self._quit(server)
+                raise
+            self._release(server)
+            return
+
+    def close(self):
+        """Closes the idle connections (QUIT); called at exit"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _ in idle:
+            self._quit(server)
+
+
+smtp_transport = SmtpTransport()
+atexit.register(smtp_transport.close)
+_http = None
+_http_lock = threading.Lock()
+
+
+def _http_session():
+    """Shared requests.Session: TLS connections to SendGrid are kept alive between calls"""
+    global _http
+    if _http is None:
+        with _http_lock:
+            if _http is None:
+                session = requests.Session()
+                session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=10))
+                _http = session
+    return _http
+
+
+def _build_message(to_email, subject, html_content):
+    msg = EmailMessage()
+    msg['Subject'] = subject
+    msg['From'] = MAIL_FROM
+    msg['To'] = to_email
+    msg.set_content("This email requires an HTML-compatible client.")
+    msg.add_alternative(html_content, subtype='html')
+    return msg
+
+
+def _sendgrid_post(personalizations, html_content) -> bool:
     headers = {
         'Authorization': f'Bearer {SENDGRID_API_KEY}',
         'Content-Type': 'application/json'
     }
     data = {
-        'personalizations': [
-            {'to': [{'email': to_email}], 'subject': subject}
-        ],
+        'personalizations': personalizations,
         'from': {'email': MAIL_FROM, 'name': 'Agri KM Zero'},
         'content': [{'type': 'text/html', 'value': html_content}]
     }
-    resp = requests.post(SENDGRID_URL, headers=headers, json=data, timeout=8)
+    resp = _http_session().post(SENDGRID_URL, headers=headers, json=data, timeout=8)
     if 200 <= resp.status_code < 300:
         return True
     logging.error("SendGrid error %s: %s", resp.status_code, resp.text)
     return False
 
 
-def _send_via_smtp(to_email: str, subject: str, html_content: str) -> bool:
+def _send_many_via_sendgrid(messages):
+    """One API call per distinct body: recipients and subjects go in personalizations"""
+    if not HAS_REQUESTS:
+        logging.warning("SendGrid requires 'requests' library (not installed)")
+        return [False] * len(messages)
+    results = [False] * len(messages)
+    by_body = {}
+    for i, (_, _, html_content) in enumerate(messages):
+        by_body.setdefault(html_content, []).append(i)
+    for html_content, indexes in by_body.items():
+        for start in range(0, len(indexes), SENDGRID_BATCH):
+            chunk = indexes[start:start + SENDGRID_BATCH]
+            personalizations = [{'to': [{'email': messages[i][0]}], 'subject': messages[i][1]} for i in chunk]
+            try:
+                ok = _sendgrid_post(personalizations, html_content)
+            except Exception as e:
+                logging.warning("SendGrid send failed: %s", e)
+                ok = False
+            for i in chunk:
+                results[i] = ok
+    return results
+
+
+def _send_many_via_smtp(messages):
     if not (SMTP_HOST and SMTP_USER and SMTP_PASS):
         logging.warning("SMTP not configured (missing SMTP_HOST/SMTP_USER/SMTP_PASS)")
-        return False
-    msg = EmailMessage()
-    msg['Subject'] = subject
-    msg['From'] = MAIL_FROM
-    msg['To'] = to_email
-    msg.set_content("This email requires an HTML-compatible client.")
-    msg.add_alternative(html_content, subtype='html')
+        return [False] * len(messages)
+    results = []
+    for to_email, subject, html_content in messages:
+        try:
+            smtp_transport.send(_build_message(to_email, subject, html_content))
+            results.append(True)
+        except Exception as e:
+            logging.exception("SMTP send failed: %s", e)
+            results.append(False)
+    return results
+
+
+def _send_via_sendgrid(to_email: str, subject: str, html_content: str) -> bool:
+    return _send_many_via_sendgrid([(to_email, subject, html_content)])[0]
+
+
+def _send_via_smtp(to_email: str, subject: str, html_content: str) -> bool:
+    return _send_many_via_smtp([(to_email, subject, html_content)])[0]
+
+
+def _provider_configured() -> bool:
+    return bool(SENDGRID_API_KEY or (SMTP_HOST and SMTP_USER and SMTP_PASS))
+
+
+def _providers():
+    providers = []
+    if EMAIL_PROVIDER == 'smtp':
+        providers.append(_send_many_via_smtp)
+    if SENDGRID_API_KEY and (EMAIL_PROVIDER in (None, '', 'sendgrid')):
+        providers.append(_send_many_via_sendgrid)
+    # Attempt SMTP if creds exist and not already tried
+    if SMTP_HOST and SMTP_USER and SMTP_PASS and EMAIL_PROVIDER != 'smtp':
+        providers.append(_send_many_via_smtp)
+    return providers
+
+
+def send_many(messages, fallback: bool = True):
+    """
+    Send a list of (to_email, subject, html_content) reusing connections.
+    Providers are tried in the same order as send_email; each one only gets
+    the messages the previous ones could not deliver. Returns one bool per
+    message (see send_email for the meaning of fallback).
+    """
+    messages = list(messages)
+    results = [False] * len(messages)
     try:
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=5) as server:
-            if SMTP_STARTTLS:
-                server.starttls()
-            server.login(SMTP_USER, SMTP_PASS)
-            server.send_message(msg)
-        return True
+        for provider in _providers():
+            todo = [i for i, ok in enumerate(results) if not ok]
+            if not todo:
+                break
+            try:
+                sent = provider([messages[i] for i in todo])
+            except Exception as e:
+                logging.warning("%s failed, falling back: %s", provider.__name__, e)
+                continue
+            for i, ok in zip(todo, sent):
+                results[i] = ok
+        if not fallback and _provider_configured():
+            return results
+        # Ultimate fallback: log and succeed (don't block user actions)
+        for i, ok in enumerate(results):
+            if not ok:
+                to_email, subject, html_content = messages[i]
+                logging.info("[Email Fallback - Dev Mode] To: %s | Subject: %s\n%s", to_email, subject, html_content)
+                results[i] = True
+        return results
     except Exception as e:
-        logging.exception("SMTP send failed: %s", e)
-        return False
+        logging.exception("send_many completely failed, but not blocking user flow: %s", e)
+        return [fallback] * len(messages)
 
 
-def send_email(to_email: str, subject: str, html_content: str) -> bool:
+def send_email(to_email: str, subject: str, html_content: str, fallback: bool = True) -> bool:
     """
     Send an email using the configured provider.
     Order of preference:
@@ -76,36 +260,7 @@ def send_email(to_email: str, subject: str, html_content: str) -> bool:
     2) Else if SENDGRID_API_KEY set, use SendGrid.
     3) Else if SMTP envs present, try SMTP.
     4) Fallback: log email content and return True (never block user flow).
+    With fallback=False (outbox worker) a failure of the configured
+    providers returns False so the message can be retried.
     """
-    try:
-        if EMAIL_PROVIDER == 'smtp':
-            try:
-                ok = _send_via_smtp(to_email, subject, html_content)
-                if ok:
-                    return True
-            except Exception as e:
-                logging.warning("SMTP send failed, falling back: %s", e)
-        
-        if SENDGRID_API_KEY and (EMAIL_PROVIDER in (None, '', 'sendgrid')):
-            try:
-                ok = _send_via_sendgrid(to_email, subject, html_content)
-                if ok:
-                    return True
-            except Exception as e:
-                logging.warning("SendGrid send failed, falling back: %s", e)
-        
-        # Attempt SMTP if creds exist and not already tried
-        if SMTP_HOST and SMTP_USER and SMTP_PASS and EMAIL_PROVIDER != 'smtp':
-            try:
-                ok = _send_via_smtp(to_email, subject, html_content)
-                if ok:
-                    return True
-            except Exception as e:
-                logging.warning("SMTP fallback failed: %s", e)
-        
-        # Ultimate fallback: log and succeed (don't block user actions)
-        logging.info("[Email Fallback - Dev Mode] To: %s | Subject: %s\n%s", to_email, subject, html_content)
-        return True
-    except Exception as e:
-        logging.exception("send_email completely failed, but returning True to not block user flow: %s", e)
-        return True  # Never block registration/reset on email failure
+    return send_many([(to_email, subject, html_content)], fallback)[0]
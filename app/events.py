@@ -0,0 +1,295 @@
+import json
+import logging
+import os
+import queue
+import select as _select
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import Blueprint, Response, current_app
+from flask_login import login_required, current_user
+from sqlalchemy import delete, event, func, insert, select, inspect as sa_inspect
+from sqlalchemy.orm import object_session
+from . import db
+from .models import Message, OrderRequest, ServerEvent, User
+from .conversations import unread_total
+
+events = Blueprint('events', __name__)
+
+# Eventi in attesa per ogni client collegato: oltre, un client lento li perde (i badge si riallineano)
+QUEUE_SIZE = 100
+# Commento inviato sulle connessioni ferme, per proxy e per accorgersi dei client andati via (secondi)
+HEARTBEAT = 20
+# Dopo questo tempo lo stream si chiude e il browser si ricollega, anche su un altro worker (secondi)
+MAX_STREAM = 30 * 60
+# Attesa del browser prima di ricollegarsi (millisecondi)
+RETRY_MS = 5000
+
+# Trasporto 'poll': intervallo di lettura e durata degli eventi nella tabella server_event
+POLL_INTERVAL = 2
+POLL_RETENTION = timedelta(minutes=10)
+
+PG_CHANNEL = 'agri_events'
+
+_server_event = ServerEvent.__table__
+
+
+class Broker:
+    """Pub/sub in memoria del processo: una coda per ogni stream /events aperto"""
+
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, user_id):
+        q = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(q)
+        return q
+
+    def unsubscribe(self, user_id, q):
+        with self._lock:
+            queues = self._subscribers.get(user_id)
+            if queues is not None:
+                queues.discard(q)
+                if not queues:
+                    del self._subscribers[user_id]
+
+    def dispatch(self, user_id, kind, data):
+        with self._lock:
+            queues = list(self._subscribers.get(user_id, ()))
+        for q in queues:
+            try:
+                q.put_nowait((kind, data))
+            except queue.Full:
+                pass
+
+    def listeners(self):
+        with self._lock:
+            return sum(len(queues) for queues in self._subscribers.values())
+
+
+broker = Broker()
+
+
+# --- trasporti tra processi ------------------------------------------------------------
+
+class LocalTransport:
+    """Un solo processo: gli eventi vanno direttamente alle code del broker"""
+
+    def __init__(self, engine, broker=broker):
+        self.broker = broker
+
+    def start(self):
+        pass
+
+    def publish(self, items):
+        for user_id, kind, data in items:
+            self.broker.dispatch(user_id, kind, data)
+
+
+class _BackgroundTransport:
+    """Trasporto con un thread (un greenlet sotto gevent) che riceve gli eventi di tutti i worker"""
+
+    def __init__(self, engine, broker=broker):
+        self.engine = engine
+        self.broker = broker
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Parte col primo stream aperto nel processo
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+                self._thread.start()
+
+    def _deliver(self, user_id, kind, data):
+        self.broker.dispatch(user_id, kind, data)
+
+
+class PostgresTransport(_BackgroundTransport):
+    """PostgreSQL: NOTIFY a ogni commit, una connessione in LISTEN per processo"""
+
+    def publish(self, items):
+        with self.engine.begin() as conn:
+            for user_id, kind, data in items:
+                conn.execute(select(func.pg_notify(PG_CHANNEL, json.dumps([user_id, kind, data]))))
+
+    def _run(self):
+        while True:
+            raw = None
+            try:
+                raw = self.engine.raw_connection()
+                # Connessione dedicata, fuori dal pool
+                raw.detach()
+                conn = raw.dbapi_connection
+                conn.autocommit = True
+                conn.cursor().execute(f'LISTEN {PG_CHANNEL}')
+                while True:
+                    if _select.select([conn], [], [], HEARTBEAT) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._deliver(*json.loads(conn.notifies.pop(0).payload))
+            except Exception:
+                logging.exception("Eventi: LISTEN interrotto, nuovo tentativo tra 5 secondi")
+                time.sleep(5)
+            finally:
+                if raw is not None:
+                    try:
+                        raw.close()
+                    except Exception:
+                        pass
+
+
+class PollingTransport(_BackgroundTransport):
+    """Altri database: eventi scritti in server_event e letti da ogni processo ogni POLL_INTERVAL"""
+
+    def __init__(self, engine, broker=broker):
+        super().__init__(engine, broker)
+        self.last_id = None
+        self._purged_at = 0
+
+    def publish(self, items):
+        now = datetime.utcnow()
+        with self.engine.begin() as conn:
+            conn.execute(insert(_server_event), [
+                {'user_id': user_id, 'kind': kind, 'data': json.dumps(data), 'created_at': now}
+                for user_id, kind, data in items
+            ])
+
+    def poll_once(self):
+        with self.engine.connect() as conn:
+            if self.last_id is None:
+                # Solo gli eventi successivi all'avvio
+                self.last_id = conn.execute(select(func.max(_server_event.c.id))).scalar() or 0
+                return 0
+            rows = conn.execute(select(_server_event).where(_server_event.c.id > self.last_id)
+                                .order_by(_server_event.c.id).limit(1000)).all()
+        for row in rows:
+            self._deliver(row.user_id, row.kind, json.loads(row.data))
+            self.last_id = row.id
+        if time.monotonic() - self._purged_at > POLL_RETENTION.total_seconds():
+            self._purged_at = time.monotonic()
+            with self.engine.begin() as conn:
+                conn.execute(delete(_server_event).where(
+                    _server_event.c.created_at < datetime.utcnow() - POLL_RETENTION))
+        return len(rows)
+
+    def _run(self):
+        while True:
+            try:
+                self.poll_once()
+            except Exception:
+                logging.exception("Eventi: lettura di server_event non riuscita")
+            time.sleep(POLL_INTERVAL)
+
+
+TRANSPORTS = {'local': LocalTransport, 'postgres': PostgresTransport, 'poll': PollingTransport}
+
+
+def get_transport():
+    """Trasporto scelto con EVENTS_TRANSPORT; di default NOTIFY su PostgreSQL, in memoria altrove"""
+    transport = current_app.extensions.get('event_transport')
+    if transport is None:
+        default = 'postgres' if db.engine.dialect.name == 'postgresql' else 'local'
+        name = current_app.config.get('EVENTS_TRANSPORT') or os.environ.get('EVENTS_TRANSPORT', default)
+        transport = current_app.extensions['event_transport'] = TRANSPORTS[name](db.engine)
+    return transport
+
+
+# --- eventi generati dalle scritture ---------------------------------------------------
+
+def record(session, user_id, kind, data=None):
+    """Evento per user_id, pubblicato dopo il commit della sessione (scartato con il rollback)"""
+    if session is None or not user_id:
+        return
+    session.info.setdefault('events', []).append((user_id, kind, data or {}))
+
+
+@event.listens_for(Message, 'after_insert')
+def _message_created(mapper, connection, target):
+    record(object_session(target), target.recipient_id, 'message', {
+        'id': target.id, 'sender_id': target.sender_id, 'preview': (target.content or '')[:100]})
+
+
+@event.listens_for(OrderRequest, 'after_insert')
+def _order_created(mapper, connection, target):
+    record(object_session(target), target.farmer_id, 'order', {'id': target.id, 'status': target.status})
+
+
+@event.listens_for(OrderRequest, 'after_update')
+def _order_updated(mapper, connection, target):
+    history = sa_inspect(target).attrs['status'].history
+    if history.has_changes():
+        session = object_session(target)
+        record(session, target.client_id, 'order', {'id': target.id, 'status': target.status})
+        record(session, target.farmer_id, 'badges')
+
+
+@event.listens_for(db.session, 'after_commit')
+def _publish(session):
+    items = session.info.pop('events', None)
+    if not items:
+        return
+    try:
+        get_transport().publish(items)
+    except Exception:
+        # Il commit è già avvenuto: una notifica persa non deve far fallire la richiesta
+        logging.exception("Eventi: pubblicazione non riuscita")
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard(session, previous_transaction):
+    session.info.pop('events', None)
+
+
+# --- stream per il browser -------------------------------------------------------------
+
+def badge_counts(user_id):
+    pending = db.session.query(User.pending_orders_count).filter(User.id == user_id).scalar()
+    return {'unread': unread_total(user_id), 'pending': max(pending or 0, 0)}
+
+
+def _sse(kind, data):
+    return f"event: {kind}\ndata: {json.dumps(data)}\n\n"
+
+
+def _stream(app, user_id):
+    q = broker.subscribe(user_id)
+    try:
+        # Query brevi in un contesto proprio: lo stream non tiene una connessione al database
+        with app.app_context():
+            counts = badge_counts(user_id)
+        yield f"retry: {RETRY_MS}\n" + _sse('badges', counts)
+        deadline = time.monotonic() + MAX_STREAM
+        while time.monotonic() < deadline:
+            try:
+                items = [q.get(timeout=HEARTBEAT)]
+            except queue.Empty:
+                yield ": ping\n\n"
+                continue
+            # Eventi arrivati insieme: un solo ricalcolo dei badge
+            while True:
+                try:
+                    items.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            chunks = [_sse(kind, data) for kind, data in items if kind != 'badges']
+            with app.app_context():
+                chunks.append(_sse('badges', badge_counts(user_id)))
+            yield ''.join(chunks)
+    finally:
+        broker.unsubscribe(user_id, q)
+
+
+@events.route('/events')
+@login_required
+def stream():
+    """Stream Server-Sent Events dell'utente: nuovi messaggi, ordini e badge della navbar"""
+    get_transport().start()
+    return Response(_stream(current_app._get_current_object(), current_user.id),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -0,0 +1,206 @@
+import csv
+import io
+import json
+import re
+import zipfile
+from xml.sax.saxutils import escape
+from sqlalchemy import select
+from . import db
+from .models import OrderRequest, OrderItem
+from .rollups import STATUS_ALIASES
+
+# Ordini letti dal cursore lato server per ogni blocco (e righe d'ordine caricate insieme)
+CHUNK_SIZE = 1000
+
+COLUMNS = ['Ordine', 'Data', 'Stato', 'Cliente', 'Email', 'Telefono', 'Consegna', 'Indirizzo',
+           'Prodotti', 'Totale (€)', 'Completato il']
+
+STATUS_LABELS = {
+    'pending': 'In attesa', 'confirmed': 'Confermato', 'accepted': 'Confermato',
+    'completed': 'Completato', 'rejected': 'Annullato', 'cancelled': 'Annullato',
+}
+
+# Iniziali di una formula in Excel/LibreOffice (anche tab e a capo, come da OWASP)
+_FORMULA_CHARS = ('=', '+', '-', '@', '\t', '\r')
+
+_order = OrderRequest.__table__
+_item = OrderItem.__table__
+
+
+def _statuses(status):
+    # 'confermati' comprende anche il vecchio stato 'accepted'
+    return [status] + [old for old, new in STATUS_ALIASES.items() if new == status]
+
+
+def _describe(name, qty, unit):
+    return f"{name} x{qty}{' ' + unit if unit else ''}"
+
+
+def _legacy_items(items_json):
+    """Ordini non ancora convertiti in righe OrderItem: prodotti letti da items_json"""
+    try:
+        items = json.loads(items_json or '{}')
+        return [_describe(i.get('name') or 'Prodotto', i.get('qty') or 1, i.get('unit')) for i in items.values()]
+    except (ValueError, TypeError, AttributeError):
+        return []
+
+
+def _csv_safe(value):
+    """Testo che un foglio di calcolo leggerebbe come formula (=, +, -, @): preceduto da un apostrofo"""
+    if isinstance(value, str) and value.startswith(_FORMULA_CHARS):
+        return "'" + value
+    return value
+
+
+def _fmt_dt(value):
+    return value.strftime('%Y-%m-%d %H:%M') if value else ''
+
+
+def order_rows(farmer_id, date_from=None, date_to=None, status=None, chunk_size=CHUNK_SIZE):
+    """Righe dell'esportazione (una per ordine), lette a blocchi da un cursore lato server.
+
+    La memoria usata non dipende dal numero di ordini: in ogni momento c'è un
+    solo blocco di `chunk_size` ordini con le relative righe d'ordine.
+    """
+    stmt = select(
+        _order.c.id, _order.c.created_at, _order.c.status, _order.c.client_name, _order.c.client_email,
+        _order.c.client_phone, _order.c.delivery_requested, _order.c.delivery_address,
+        _order.c.total_price, _order.c.completed_at, _order.c.items_json
+    ).where(_order.c.farmer_id == farmer_id).order_by(_order.c.created_at.desc(), _order.c.id.desc())
+    if date_from:
+        stmt = stmt.where(_order.c.created_at >= date_from)
+    if date_to:
+        stmt = stmt.where(_order.c.created_at < date_to)
+    if status:
+        stmt = stmt.where(_order.c.status.in_(_statuses(status)))
+
+    result = db.session.execute(stmt.execution_options(stream_results=True, yield_per=chunk_size))
+    for orders in result.partitions():
+        items = {}
+        for r in db.session.execute(
+            select(_item.c.order_id, _item.c.name, _item.c.qty, _item.c.unit)
+            .where(_item.c.order_id.in_([o.id for o in orders])).order_by(_item.c.id)
+        ):
+            items.setdefault(r.order_id, []).append(_describe(r.name, r.qty, r.unit))
+        for o in orders:
+            yield [
+                o.id, _fmt_dt(o.created_at), STATUS_LABELS.get(o.status, o.status or ''),
+                o.client_name or '', o.client_email or '', o.client_phone or '',
+                'Consegna' if o.delivery_requested else 'Ritiro',
+                (o.delivery_address or '') if o.delivery_requested else '',
+                '; '.join(items.get(o.id) or _legacy_items(o.items_json)),
+                round(o.total_price or 0, 2), _fmt_dt(o.completed_at),
+            ]
+
+
+def csv_stream(rows, flush_every=200):
+    """CSV a pezzi: il BOM iniziale fa riconoscere l'UTF-8 a Excel.
+
+    I campi scritti dai clienti (nome, indirizzo, prodotti) non devono diventare
+    formule all'apertura del file. Nell'XLSX le celle di testo sono già sicure.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(COLUMNS)
+    for n, row in enumerate(rows, 1):
+        writer.writerow([_csv_safe(v) for v in row])
+        if n % flush_every == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+# --- XLSX in streaming ------------------------------------------------------------------
+# Un file .xlsx è uno zip di XML: il foglio viene scritto riga per riga dentro lo zip e
+# i byte compressi escono subito, senza tenere in memoria il documento intero.
+
+_MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+_DOC_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_XML_HEAD = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+_XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        f'<Relationships xmlns="{_REL_NS}">'
+        f'<Relationship Id="rId1" Type="{_DOC_REL}/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        f'<workbook xmlns="{_MAIN_NS}" xmlns:r="{_DOC_REL}">'
+        '<sheets><sheet name="Ordini" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        f'<Relationships xmlns="{_REL_NS}">'
+        f'<Relationship Id="rId1" Type="{_DOC_REL}/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+# Caratteri di controllo non ammessi in XML 1.0
+_INVALID_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+class _Sink:
+    """Destinazione dello zip non posizionabile: accumula i byte finché non vengono letti"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _cell(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c><v>{value}</v></c>'
+    text = escape(_INVALID_XML.sub('', str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _row(values):
+    return ('<row>' + ''.join(_cell(v) for v in values) + '</row>').encode()
+
+
+def xlsx_stream(rows, flush_every=200):
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, xml in _XLSX_PARTS.items():
+            zf.writestr(name, _XML_HEAD + xml)
+        with zf.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(f'{_XML_HEAD}<worksheet xmlns="{_MAIN_NS}"><sheetData>'.encode())
+            sheet.write(_row(COLUMNS))
+            for n, row in enumerate(rows, 1):
+                sheet.write(_row(row))
+                if n % flush_every == 0:
+                    data = sink.pop()
+                    if data:
+                        yield data
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.pop()
+
+
+FORMATS = {
+    'csv': (csv_stream, 'text/csv; charset=utf-8'),
+    'xlsx': (xlsx_stream, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
@@ -0,0 +1,243 @@
+import threading
+import time
+from collections import Counter
+from sqlalchemy import event, func, inspect as sa_inspect
+from sqlalchemy.orm import object_session
+from . import db
+from .models import User, Product
+
+CATEGORY_OPTIONS = ['frutta', 'verdura', 'vino', 'olio', 'latticini', 'miele', 'altro']
+# Ricostruzione forzata dell'indice dopo questo intervallo (secondi): raccoglie le scritture
+# fatte da altri processi (altri worker, worker.py, script di import e backfill)
+INDEX_MAX_AGE = 600
+
+
+class FacetIndex:
+    """Valori distinti di provincia/comune/categoria con conteggi, tenuti in memoria.
+
+    Costruito al primo utilizzo con due query aggregate e poi aggiornato
+    in modo incrementale dalle scritture su User e Product (applicate solo
+    dopo il commit della transazione). Le scritture degli altri processi
+    arrivano con la ricostruzione dopo INDEX_MAX_AGE.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._built = False
+        self._built_at = 0.0
+        # farmer_id -> (province, city)
+        self.farmers = {}
+        # farmer_id -> Counter(category -> n prodotti)
+        self.farmer_products = {}
+        self.province_farmers = Counter()
+        self.province_products = Counter()
+        self.city_farmers = {}    # province -> Counter(city)
+        self.city_products = {}   # province -> Counter(city)
+        self.category_products = Counter()
+
+    def invalidate(self):
+        with self._lock:
+            self._built = False
+
+    # --- costruzione -------------------------------------------------------
+
+    def _build(self):
+        fresh = FacetIndex()
+        for fid, province, city in db.session.query(User.id, User.province, User.city).filter(User.is_farmer == True):
+            fresh._add_farmer(fid, province, city)
+        rows = db.session.query(Product.user_id, Product.category, func.count(Product.id)) \
+            .group_by(Product.user_id, Product.category).all()
+        for fid, category, n in rows:
+            fresh._add_products(fid, category, n)
+        # Sostituzione in blocco: chi legge senza lock (ricerca in memoria) vede il vecchio indice o il nuovo
+        self.farmers, self.farmer_products = fresh.farmers, fresh.farmer_products
+        self.province_farmers, self.province_products = fresh.province_farmers, fresh.province_products
+        self.city_farmers, self.city_products = fresh.city_farmers, fresh.city_products
+        self.category_products = fresh.category_products
+        self._built_at = time.time()
+        self._built = True
+
+    def _stale(self):
+        return not self._built or time.time() - self._built_at > INDEX_MAX_AGE
+
+    def ensure(self):
+        if self._stale():
+            with self._lock:
+                if self._stale():
+                    self._build()
+        return self
+
+    # --- aggiornamenti incrementali --------------------------------------
+
+    def _location_counts(self, province, city, farmers_delta, products_delta):
+        if province:
+            self.province_farmers[province] += farmers_delta
+            self.province_products[province] += products_delta
+            if city:
+                self.city_farmers.setdefault(province, Counter())[city] += farmers_delta
+                self.city_products.setdefault(province, Counter())[city] += products_delta
+
+    def _add_farmer(self, fid, province, city):
+        self.farmers[fid] = (province, city)
+        n_products = sum(self.farmer_products.get(fid, Counter()).values())
+        self._location_counts(province, city, 1, n_products)
+
+    def _remove_farmer(self, fid):
+        province, city = self.farmers.pop(fid, (None, None))
+        n_products = sum(self.farmer_products.get(fid, Counter()).values())
+        self._location_counts(province, city, -1, -n_products)
+
+    def _add_products(self, fid, category, n):
+        category = category or 'altro'
+        self.farmer_products.setdefault(fid, Counter())[category] += n
+        if fid in self.farmers:
+            province, city = self.farmers[fid]
+            self._location_counts(province, city, 0, n)
+            self.category_products[category] += n
+
+    def apply(self, ops):
+        """Applica le variazioni registrate durante una transazione confermata"""
+        with self._lock:
+            if not self._built:
+                return
+            for op in ops:
+                if op[0] == 'farmer':
+                    _, fid, was_farmer, is_farmer, province, city = op
+                    if was_farmer:
+                        products = self.farmer_products.get(fid, Counter())
+                        self.category_products.subtract(products)
+                        self._remove_farmer(fid)
+                    if is_farmer:
+                        self._add_farmer(fid, province, city)
+                        self.category_products.update(self.farmer_products.get(fid, Counter()))
+                else:
+                    _, old_fid, old_category, new_fid, new_category = op
+                    if old_fid is not None:
+                        self._add_products(old_fid, old_category, -1)
+                    if new_fid is not None:
+                        self._add_products(new_fid, new_category, 1)
+
+    # --- letture -----------------------------------------------------------
+
+    @staticmethod
+    def _positive(counter):
+        return sorted(k for k, v in counter.items() if v > 0)
+
+    def provinces(self):
+        """Province con almeno un agricoltore"""
+        with self._lock:
+            return self._positive(self.ensure().province_farmers)
+
+    def cities(self, province=None):
+        """Comuni con almeno un agricoltore (di una provincia o di tutte)"""
+        with self._lock:
+            self.ensure()
+            if province:
+                return self._positive(self.city_farmers.get(province, Counter()))
+            merged = Counter()
+            for counter in self.city_farmers.values():
+                merged.update({k: v for k, v in counter.items() if v > 0})
+            return self._positive(merged)
+
+    def province_counts(self):
+        """Lista di dict {name, farmers, products} ordinata per nome"""
+        with self._lock:
+            self.ensure()
+            return [{'name': p, 'farmers': self.province_farmers[p], 'products': self.province_products[p]}
+                    for p in self._positive(self.province_farmers)]
+
+    def city_counts(self, province):
+        with self._lock:
+            self.ensure()
+            farmers = self.city_farmers.get(province, Counter())
+            products = self.city_products.get(province, Counter())
+            return [{'name': c, 'farmers': farmers[c], 'products': products[c]} for c in self._positive(farmers)]
+
+    def category_counts(self):
+        """Categorie note con il numero di prodotti (anche zero)"""
+        with self._lock:
+            self.ensure()
+            names = CATEGORY_OPTIONS + sorted(set(self._positive(self.category_products)) - set(CATEGORY_OPTIONS))
+            return [{'name': c, 'products': self.category_products[c]} for c in names]
+
+
+facet_index = FacetIndex()
+
+
+# --- hook sulle scritture ----------------------------------------------------
+
+def _record(target, op):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('facet_ops', []).append(op)
+
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    return value
+
+
+# active_history: il valore precedente viene caricato anche se l'attributo era scaduto,
+# così la history di after_update riporta sempre la categoria/azienda di partenza
+for _attr in (Product.category, Product.user_id, User.is_farmer):
+    event.listen(_attr, 'set', _keep_old_value, active_history=True, retval=True)
+
+
+def _old_value(state, attr):
+    history = state.attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(state.object, attr)
+
+
+@event.listens_for(User, 'after_insert')
+def _user_inserted(mapper, connection, target):
+    if target.is_farmer:
+        _record(target, ('farmer', target.id, False, True, target.province, target.city))
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    state = sa_inspect(target)
+    if not any(state.attrs[a].history.has_changes() for a in ('is_farmer', 'province', 'city')):
+        return
+    was_farmer = bool(_old_value(state, 'is_farmer'))
+    _record(target, ('farmer', target.id, was_farmer, bool(target.is_farmer), target.province, target.city))
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, target):
+    if target.is_farmer:
+        _record(target, ('farmer', target.id, True, False, None, None))
+
+
+@event.listens_for(Product, 'after_insert')
+def _product_inserted(mapper, connection, target):
+    _record(target, ('product', None, None, target.user_id, target.category))
+
+
+@event.listens_for(Product, 'after_update')
+def _product_updated(mapper, connection, target):
+    state = sa_inspect(target)
+    if not any(state.attrs[a].history.has_changes() for a in ('user_id', 'category')):
+        return
+    _record(target, ('product', _old_value(state, 'user_id'), _old_value(state, 'category'),
+                     target.user_id, target.category))
+
+
+@event.listens_for(Product, 'after_delete')
+def _product_deleted(mapper, connection, target):
+    _record(target, ('product', target.user_id, target.category, None, None))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_after_commit(session):
+    ops = session.info.pop('facet_ops', None)
+    if ops:
+        facet_index.apply(ops)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_on_rollback(session, previous_transaction):
+    # Un rollback annidato scarta anche variazioni già valide: meglio ricostruire
+    if session.info.pop('facet_ops', None):
+        facet_index.invalidate()
@@ -0,0 +1,249 @@
+import hashlib
+import json
+import math
+import threading
+import time
+from sqlalchemy import event, inspect as sa_inspect
+from . import db
+from .cache import TTLCache
+from .models import User
+
+# Optional: numpy vectorizes the final distance pass
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+EARTH_RADIUS_KM = 6371.0088
+# Valore minimo (all'equatore): il rettangolo risulta leggermente più ampio del cerchio
+KM_PER_DEG = 110.574
+
+# Lato della cella della griglia in gradi (~28 km di latitudine)
+GRID_CELL_DEG = 0.25
+# Ricostruzione forzata dell'indice dopo questo intervallo (secondi)
+INDEX_MAX_AGE = 600
+
+
+def bounding_box(lat, lng, radius_km):
+    """Ritorna (min_lat, max_lat, min_lng, max_lng) che contiene il cerchio di raggio radius_km"""
+    dlat = radius_km / KM_PER_DEG
+    cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+    dlng = min(radius_km / (KM_PER_DEG * cos_lat), 180.0)
+    return lat - dlat, lat + dlat, lng - dlng, lng + dlng
+
+
+def bbox_filter(query, bbox):
+    """Aggiunge alla query il filtro sul rettangolo di coordinate (usa User.latitude/longitude)"""
+    min_lat, max_lat, min_lng, max_lng = bbox
+    return query.filter(
+        User.latitude.between(min_lat, max_lat),
+        User.longitude.between(min_lng, max_lng)
+    )
+
+
+def haversine_km(lat, lng, lats, lngs):
+    """Distanza haversine (km) da (lat, lng) verso ogni punto di lats/lngs"""
+    if HAS_NUMPY:
+        lat1 = np.radians(lat)
+        lat2 = np.radians(np.asarray(lats, dtype=float))
+        dlat = lat2 - lat1
+        dlng = np.radians(np.asarray(lngs, dtype=float) - lng)
+        a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    lat1 = math.radians(lat)
+    cos_lat1 = math.cos(lat1)
+    out = []
+    for plat, plng in zip(lats, lngs):
+        lat2 = math.radians(plat)
+        a = math.sin((lat2 - lat1) / 2) ** 2 + cos_lat1 * math.cos(lat2) * math.sin(math.radians(plng - lng) / 2) ** 2
+        out.append(2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0))))
+    return out
+
+
+def _cell(lat, lng):
+    return int(math.floor(lat / GRID_CELL_DEG)), int(math.floor(lng / GRID_CELL_DEG))
+
+
+class FarmerIndex:
+    """Indice a griglia in memoria sulle coordinate degli agricoltori.
+
+    Viene costruito al primo utilizzo con una sola query sulle colonne
+    necessarie (coordinate, nome, slug, località) e invalidato quando un
+    agricoltore cambia.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirty = True
+        self._built_at = 0.0
+        self.ids = []
+        self.lats = []
+        self.lngs = []
+        # Per ogni punto: (nome, slug, comune, provincia) per mappe e GeoJSON
+        self.meta = []
+        self.grid = {}
+        # Impronta del contenuto e momento dell'ultima modifica (ETag/Last-Modified)
+        self.version = ''
+        self.modified_at = time.time()
+
+    def invalidate(self):
+        self._dirty = True
+
+    def load(self, ids, lats, lngs, meta=None):
+        """Carica l'indice da sequenze già pronte (usato anche dai benchmark)"""
+        grid = {}
+        for pos, (plat, plng) in enumerate(zip(lats, lngs)):
+            grid.setdefault(_cell(plat, plng), []).append(pos)
+        meta = list(meta) if meta is not None else [(None, None, None, None)] * len(ids)
+        digest = hashlib.sha1(repr((list(ids), list(lats), list(lngs), meta)).encode()).hexdigest()[:16]
+        if HAS_NUMPY:
+            lats = np.asarray(lats, dtype=float)
+            lngs = np.asarray(lngs, dtype=float)
+        self.ids, self.lats, self.lngs, self.meta, self.grid = list(ids), lats, lngs, meta, grid
+        if digest != self.version:
+            self.version = digest
+            self.modified_at = time.time()
+        self._built_at = time.time()
+        self._dirty = False
+
+    def _build(self):
+        rows = db.session.query(
+            User.id, User.latitude, User.longitude, User.company_name, User.username,
+            User.company_slug, User.city, User.province
+        ).filter(
+            User.is_farmer == True,
+            User.latitude.isnot(None),
+            User.longitude.isnot(None)
+        ).order_by(User.id).all()
+        meta = [(r.company_name or r.username, r.company_slug or User.slug_for(r.id, r.company_name, r.username),
+                 r.city or '', r.province or '') for r in rows]
+        self.load([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows], meta)
+
+    def ensure(self):
+        if self._dirty or time.time() - self._built_at > INDEX_MAX_AGE:
+            with self._lock:
+                if self._dirty or time.time() - self._built_at > INDEX_MAX_AGE:
+                    self._build()
+        return self
+
+    def candidates(self, bbox):
+        """Posizioni dei punti nelle celle che intersecano il rettangolo"""
+        min_lat, max_lat, min_lng, max_lng = bbox
+        lo_i, lo_j = _cell(min_lat, min_lng)
+        hi_i, hi_j = _cell(max_lat, max_lng)
+        positions = []
+        if (hi_i - lo_i + 1) * (hi_j - lo_j + 1) > len(self.grid):
+            for (i, j), cell in self.grid.items():
+                if lo_i <= i <= hi_i and lo_j <= j <= hi_j:
+                    positions.extend(cell)
+        else:
+            for i in range(lo_i, hi_i + 1):
+                for j in range(lo_j, hi_j + 1):
+                    positions.extend(self.grid.get((i, j), ()))
+        return positions
+
+    def nearby(self, lat, lng, radius_km):
+        """Lista di (farmer_id, distanza_km) entro il raggio, ordinata per distanza"""
+        positions = self.candidates(bounding_box(lat, lng, radius_km))
+        if not positions:
+            return []
+        if HAS_NUMPY:
+            idx = np.asarray(positions)
+            dists = haversine_km(lat, lng, self.lats[idx], self.lngs[idx])
+            keep = np.nonzero(dists <= radius_km)[0]
+            order = keep[np.argsort(dists[keep], kind='stable')]
+            return [(self.ids[positions[k]], float(dists[k])) for k in order]
+        dists = haversine_km(lat, lng, [self.lats[p] for p in positions], [self.lngs[p] for p in positions])
+        hits = [(self.ids[p], d) for p, d in zip(positions, dists) if d <= radius_km]
+        hits.sort(key=lambda h: h[1])
+        return hits
+
+    def distances(self, lat, lng):
+        """Dizionario farmer_id -> distanza_km per tutti gli agricoltori indicizzati"""
+        if not self.ids:
+            return {}
+        dists = haversine_km(lat, lng, self.lats, self.lngs)
+        if HAS_NUMPY:
+            dists = dists.tolist()
+        return dict(zip(self.ids, dists))
+
+
+    def select(self, bbox=None, province='', city=''):
+        """Posizioni dei punti nel rettangolo (opzionale) e con provincia/comune indicati"""
+        if bbox is not None:
+            min_lat, max_lat, min_lng, max_lng = bbox
+            positions = [p for p in self.candidates(bbox)
+                         if min_lat <= self.lats[p] <= max_lat and min_lng <= self.lngs[p] <= max_lng]
+        else:
+            positions = range(len(self.ids))
+        if province or city:
+            positions = [p for p in positions
+                         if (not province or self.meta[p][3] == province) and (not city or self.meta[p][2] == city)]
+        return sorted(positions)
+
+
+farmer_index = FarmerIndex()
+
+# Conteggi prodotti per azienda usati dall'ordinamento per distanza (products.py):
+# dipendono anche da provincia/comune e stato dell'azienda, quindi si svuotano con l'indice
+farmer_counts_cache = TTLCache(ttl=60)
+
+# Attributi di User che, se cambiano, rendono obsoleto l'indice
+_INDEXED_ATTRS = ('is_farmer', 'latitude', 'longitude', 'company_name', 'username',
+                  'company_slug', 'city', 'province')
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_delete')
+def _farmer_added_or_removed(mapper, connection, target):
+    if target.is_farmer:
+        farmer_index.invalidate()
+        farmer_counts_cache.clear()
+
+
+@event.listens_for(User, 'after_update')
+def _farmer_updated(mapper, connection, target):
+    state = sa_inspect(target)
+    if any(state.attrs[attr].history.has_changes() for attr in _INDEXED_ATTRS):
+        farmer_index.invalidate()
+        farmer_counts_cache.clear()
+
+
+def nearby_farmers(lat, lng, radius_km=50):
+    """Agricoltori entro radius_km da (lat, lng) come lista di (User, km) ordinata per distanza"""
+    hits = farmer_index.ensure().nearby(lat, lng, radius_km)
+    if not hits:
+        return []
+    # Il filtro sul rettangolo resta in SQL: scarta punti spostati dopo la costruzione dell'indice
+    rows = bbox_filter(User.query.filter(User.id.in_([fid for fid, _ in hits])),
+                       bounding_box(lat, lng, radius_km)).all()
+    by_id = {u.id: u for u in rows}
+    return [(by_id[fid], dist) for fid, dist in hits if fid in by_id]
+
+
+def parse_bbox(value):
+    """Legge un bbox "min_lng,min_lat,max_lng,max_lat" (ordine GeoJSON); None se assente o non valido"""
+    if not value:
+        return None
+    try:
+        min_lng, min_lat, max_lng, max_lat = (float(v) for v in value.split(','))
+    except ValueError:
+        return None
+    if min_lat > max_lat or min_lng > max_lng:
+        return None
+    return min_lat, max_lat, min_lng, max_lng
+
+
+def farmers_geojson(bbox=None, province='', city=''):
+    """FeatureCollection compatta degli agricoltori (coordinate a 5 decimali, proprietà brevi)"""
+    index = farmer_index.ensure()
+    features = []
+    for p in index.select(bbox, province, city):
+        name, slug, pcity, _ = index.meta[p]
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [round(float(index.lngs[p]), 5), round(float(index.lats[p]), 5)]},
+            'properties': {'name': name, 'slug': slug, 'city': pcity}
+        })
+    return json.dumps({'type': 'FeatureCollection', 'features': features}, separators=(',', ':'))
@@ -0,0 +1,147 @@
+import re
+from sqlalchemy import update
+from . import db
+from .models import User
+from .locations import gazetteer
+
+# Parti dell'indirizzo da ignorare nella ricerca del comune (CAP, numeri civici, sigle)
+_ADDRESS_NOISE = re.compile(r'\b\d+[a-zA-Z]?\b|\(\s*[A-Za-z]{2}\s*\)')
+
+
+def _comune_from_address(address, province=None):
+    """Primo comune noto citato nell'indirizzo ("Via Roma 3, 09072 Cabras (OR)" -> Cabras)"""
+    parts = [p.strip() for p in _ADDRESS_NOISE.sub(' ', address).replace(';', ',').split(',')]
+    # Il comune di solito segue la via: si parte dal fondo
+    for part in reversed([p for p in parts if p]):
+        comune = gazetteer.lookup(part, province)
+        if comune:
+            return comune
+    return None
+
+
+def geocode(province=None, city=None, address=None):
+    """Coordinate approssimate da provincia/comune/indirizzo, senza servizi esterni.
+
+    Ritorna (lat, lng, precisione) con precisione 'comune' o 'provincia',
+    oppure None se la località non è riconosciuta.
+    """
+    comune = gazetteer.lookup(city, province) if city else None
+    if comune is None and address:
+        comune = _comune_from_address(address, province)
+    if comune is not None and comune.lat is not None:
+        return comune.lat, comune.lng, 'comune'
+    centroid = gazetteer.province_centroid(province or (comune.province if comune else None))
+    if centroid:
+        return centroid[0], centroid[1], 'provincia'
+    return None
+
+
+def geocode_user(user):
+    """Aggiorna latitude/longitude dell'utente dal suo comune; True se ha trovato coordinate.
+
+    Il centro della provincia non viene salvato: sulla mappa e nell'ordinamento
+    per distanza varrebbe come una posizione esatta.
+    """
+    result = geocode(user.province, user.city, user.address)
+    if result is None or result[2] != 'comune':
+        return False
+    user.latitude, user.longitude, _ = result
+    return True
+
+
+# Scarto ammesso (gradi, ~0.1 m) nel riconoscere un centro di provincia salvato:
+# i valori riletti dal database o arrotondati non sono identici a quelli calcolati
+CENTROID_TOLERANCE = 1e-6
+
+
+def clear_province_centroids(dry_run=False):
+    """Toglie le coordinate salvate in passato come centro della provincia; ritorna quanti utenti.
+
+    Erano scritte dalla geocodifica quando il comune non era riconosciuto:
+    senza coordinate l'agricoltore esce dalla mappa invece di apparire in un punto a caso.
+    """
+    gazetteer.ensure()
+    cleared = 0
+    for province, (lat, lng) in gazetteer.centroids.items():
+        at_centroid = (User.province == province,
+                       User.latitude.between(lat - CENTROID_TOLERANCE, lat + CENTROID_TOLERANCE),
+                       User.longitude.between(lng - CENTROID_TOLERANCE, lng + CENTROID_TOLERANCE))
+        if dry_run:
+            cleared += db.session.query(User.id).filter(*at_centroid).count()
+        else:
+            cleared += db.session.execute(
+                update(User).where(*at_centroid).values(latitude=None, longitude=None)).rowcount
+    if cleared and not dry_run:
+        db.session.commit()
+        from .geo import farmer_index
+        farmer_index.invalidate()
+    return cleared
+
+
+def backfill(chunk_size=500, start_id=0, dry_run=False, log=print):
+    """Assegna coordinate agli agricoltori che non le hanno, a blocchi di `chunk_size`.
+
+    Ogni blocco è confermato con un solo UPDATE in bulk: se il processo si
+    interrompe basta rilanciarlo (i già geocodificati non vengono più letti).
+    Come in geocode_user, chi ha solo la provincia resta senza coordinate.
+    Ritorna (aggiornati, non risolti).
+    """
+    last_id, updated, unresolved = start_id, 0, 0
+    while True:
+        rows = db.session.query(User.id, User.province, User.city, User.address).filter(
+            User.is_farmer == True,
+            User.id > last_id,
+            db.or_(User.latitude.is_(None), User.longitude.is_(None))
+        ).order_by(User.id).limit(chunk_size).all()
+        if not rows:
+            break
+        values = []
+        for r in rows:
+            result = geocode(r.province, r.city, r.address)
+            if result is None or result[2] != 'comune':
+                unresolved += 1
+            else:
+                values.append({'id': r.id, 'latitude': result[0], 'longitude': result[1]})
+        if values and not dry_run:
+            db.session.execute(update(User), values)
+            db.session.commit()
+        updated += len(values)
+        last_id = rows[-1].id
+        log(f"  ... fino a id {last_id}: {updated} aggiornati, {unresolved} non risolti")
+    if updated and not dry_run:
+        from .geo import farmer_index
+        farmer_index.invalidate()
+    return updated, unresolved
+
+
+def remap_locations(chunk_size=500, dry_run=False, log=print):
+    """Allinea provincia e comune salvati sugli utenti ai dati del gazetteer, a blocchi.
+
+    Corregge i comuni passati ad altra provincia e la grafia del nome
+    (es. Cagliari/Teulada -> Sud Sardegna/Teulada), così il profilo torna
+    valido per le select del form. Ritorna il numero di utenti aggiornati.
+    """
+    last_id, updated = 0, 0
+    while True:
+        rows = db.session.query(User.id, User.province, User.city).filter(
+            User.id > last_id, User.city.isnot(None)
+        ).order_by(User.id).limit(chunk_size).all()
+        if not rows:
+            break
+        values = []
+        for r in rows:
+            comune = gazetteer.lookup(r.city, r.province)
+            if comune is not None and (comune.province, comune.name) != (r.province, r.city):
+                values.append({'id': r.id, 'province': comune.province, 'city': comune.name})
+        if values and not dry_run:
+            db.session.execute(update(User), values)
+            db.session.commit()
+        updated += len(values)
+        last_id = rows[-1].id
+        log(f"  ... fino a id {last_id}: {updated} aggiornati")
+    if updated and not dry_run:
+        from .geo import farmer_index
+        from .facets import facet_index
+        farmer_index.invalidate()
+        facet_index.invalidate()
+    return updated
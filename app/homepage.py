@@ -0,0 +1,80 @@
+from sqlalchemy import func
+from . import db
+from .models import User, Product
+
+# Limiti per la homepage: numero di aziende e prodotti per azienda
+FARMER_LIMIT = 30
+PRODUCTS_PER_FARMER = 4
+
+# Centro mappa di default (Oristano)
+DEFAULT_CENTER = (39.9043, 8.5900)
+
+
+def _farmer_slug(farmer):
+    return farmer.company_slug or farmer.compute_company_slug()
+
+
+def load_homepage_data(province='', city='', farmer_limit=FARMER_LIMIT, products_per_farmer=PRODUCTS_PER_FARMER):
+    """Carica aziende e prodotti della homepage con un numero fisso di query.
+
+    Una query per le aziende filtrate e una per i prodotti, limitati a
+    `products_per_farmer` per azienda tramite ROW_NUMBER() così il costo
+    non cresce con la dimensione del catalogo.
+    """
+    query = User.query.filter_by(is_farmer=True)
+    if province:
+        query = query.filter_by(province=province)
+    if city:
+        query = query.filter_by(city=city)
+    farmers = query.limit(farmer_limit).all()
+
+    farmers_by_id = {f.id: f for f in farmers}
+    slugs = {f.id: _farmer_slug(f) for f in farmers}
+
+    products = []
+    if farmers_by_id:
+        ranked = db.session.query(
+            Product.id.label('id'),
+            func.row_number().over(
+                partition_by=Product.user_id,
+                order_by=Product.id.desc()
+            ).label('rn')
+        ).filter(Product.user_id.in_(list(farmers_by_id))).subquery()
+        products = Product.query.join(ranked, Product.id == ranked.c.id) \
+            .filter(ranked.c.rn <= products_per_farmer) \
+            .order_by(Product.id.desc()).all()
+
+    products_data = []
+    for product in products:
+        farmer = farmers_by_id.get(product.user_id)
+        if not farmer:
+            continue
+        products_data.append({
+            'id': product.id,
+            'name': product.name,
+            'description': product.description,
+            'price': product.price,
+            'unit': product.unit,
+            'image_path': product.image_path,
+            'farmer_name': farmer.company_name or farmer.username,
+            'farmer_username': farmer.username,
+            'farmer_slug': slugs[farmer.id],
+            'farmer_city': farmer.city,
+            'farmer_province': farmer.province,
+            'farmer_address': farmer.address,
+            'user_id': farmer.id
+        })
+
+    # Centro mappa: prima azienda con coordinate, altrimenti default
+    center_lat, center_lng = DEFAULT_CENTER
+    for f in farmers:
+        if f.latitude and f.longitude:
+            center_lat, center_lng = f.latitude, f.longitude
+            break
+
+    return {
+        'farmers': farmers,
+        'products_data': products_data,
+        'center_lat': center_lat,
+        'center_lng': center_lng,
+    }
@@ -1,40 +1,122 @@
-# Province e comuni della Sardegna
-SARDEGNA_LOCATIONS = {
-    "Cagliari": ["Cagliari", "Quartu Sant'Elena", "Assemini", "Capoterra", "Selargius", "Sestu", "Monserrato", 
-                 "Decimomannu", "Elmas", "Maracalagonis", "Quartucciu", "Sarroch", "Sinnai", "Uta", "Villa San Pietro",
-                 "Pula", "Domus de Maria", "Teulada", "Santadi", "Villaputzu", "Muravera", "San Vito", "Castiadas"],
-    
-    "Nuoro": ["Nuoro", "Siniscola", "Macomer", "Orosei", "Dorgali", "Tortolì", "Bitti", "Onifai", "Oliena", "Orgosolo",
-              "Posada", "Borore", "Birori", "Bolotana", "Bortigali", "Dualchi", "Lei", "Macomer", "Noragugume", "Silanus",
-              "Fonni", "Gavoi", "Mamoiada", "Ollolai", "Oniferi", "Orani", "Orotelli", "Ottana", "Sarule", "Teti", "Tiana"],
-    
-    "Oristano": ["Oristano", "Terralba", "Cabras", "Bosa", "Ghilarza", "Cuglieri", "Marrubiu", "Ales", "Arborea", "Baratili San Pietro",
-                 "Milis", "Narbolia", "Nurachi", "Riola Sardo", "San Vero Milis", "Santa Giusta", "Simaxis", "Solarussa", "Tramatza",
-                 "Zeddiani", "Fordongianus", "Seneghe", "Scano di Montiferro", "Tresnuraghes", "Flussio", "Magomadas", "Modolo", "Sagama",
-                 "Paulilatino", "Bonarcado", "Santu Lussurgiu", "Seneghe", "Abbasanta", "Aidomaggiore", "Norbello", "Sedilo", "Sorradile",
-                 "Allai", "Assolo", "Baradili", "Baressa", "Curcuris", "Gonnosnò", "Gonnoscodina", "Gonnostramatza", "Masullas", "Mogoro",
-                 "Morgongiori", "Pompu", "Ruinas", "Simala", "Siris", "Uras", "Usellus", "Villa Sant'Antonio", "Villa Verde"],
-    
-    "Sassari": ["Sassari", "Alghero", "Olbia", "Porto Torres", "Tempio Pausania", "Arzachena", "La Maddalena", "Sorso", "Sennori",
-                "Castelsardo", "Ozieri", "Thiesi", "Bonorva", "Ittiri", "Uri", "Usini", "Ossi", "Tissi", "Muros", "Cargeghe",
-                "Codrongianos", "Florinas", "Olmedo", "Putifigari", "Villanova Monteleone", "Monteleone Rocca Doria", "Romana",
-                "Padria", "Mara", "Pozzomaggiore", "Semestene", "Bessude", "Borutta", "Cheremule", "Giave", "Torralba", "Bonnanaro",
-                "Santa Maria Coghinas", "Valledoria", "Viddalba", "Badesi", "Trinità d'Agultu e Vignola", "Aggius", "Aglientu",
-                "Luogosanto", "Luras", "Calangianus", "Telti", "Loiri Porto San Paolo", "Golfo Aranci", "Palau", "Sant'Antonio di Gallura",
-                "Bortigiadas", "Monti", "Padru", "Berchidda", "Oschiri", "Tula", "Erula", "Perfugas", "Laerru", "Martis", "Nulvi",
-                "Chiaramonti", "Sedini", "Bulzi", "Tergu", "Ploaghe", "Ardara", "Mores", "Siligo", "Banari", "Ittireddu"],
-    
-    "Sud Sardegna": ["Carbonia", "Iglesias", "Gonnesa", "Portoscuso", "Sant'Antioco", "Carloforte", "Calasetta", "Villamassargia",
-                     "Domusnovas", "Musei", "Buggerru", "Fluminimaggiore", "Arbus", "Guspini", "Villacidro", "San Gavino Monreale",
-                     "Sardara", "Sanluri", "Samassi", "Serramanna", "Serrenti", "Villasor", "Decimoputzu", "Siliqua", "Vallermosa",
-                     "Villaspeciosa", "Narcao", "Perdaxius", "Santadi", "Tratalias", "Villaperuccio", "Masainas", "Piscinas", "Giba",
-                     "San Giovanni Suergiu", "Nuxis", "Teulada", "Domus de Maria", "Pula", "Villa San Pietro", "Sarroch", "Capoterra"]
-}
+import hashlib
+import os
+import threading
+import unicodedata
+from collections import namedtuple
+
+# Comuni italiani attivi (generato da run_build_comuni.py)
+DATA_PATH = os.path.join(os.path.dirname(__file__), 'data', 'comuni.tsv')
+
+# Lunghezza massima dei prefissi indicizzati per l'autocompletamento
+PREFIX_LEN = 4
+
+Comune = namedtuple('Comune', 'name province sigla region code lat lng')
+
+
+def _key(value):
+    """Chiave di confronto: minuscolo, senza accenti, apostrofi e spazi"""
+    decomposed = unicodedata.normalize('NFKD', (value or '').lower())
+    return ''.join(ch for ch in decomposed if ch.isalnum() and not unicodedata.combining(ch))
+
+
+class Gazetteer:
+    """Indice in memoria dei comuni, caricato dal file dati al primo utilizzo.
+
+    Tutte le liste sono ordinate una volta sola in fase di caricamento:
+    province, comuni per provincia e per prefisso sono letture da dizionario.
+    """
+
+    def __init__(self, path=DATA_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            raw = f.read()
+        comuni = []
+        for line in raw.decode('utf-8').splitlines():
+            if not line or line.startswith('#'):
+                continue
+            region, province, sigla, name, code, lat, lng = line.split('\t')
+            comuni.append(Comune(name, province, sigla, region, code,
+                                 float(lat) if lat else None, float(lng) if lng else None))
+        comuni.sort(key=lambda c: (_key(c.name), c.province))
+
+        by_province, by_name, by_prefix, regions, sums = {}, {}, {}, {}, {}
+        for c in comuni:
+            by_province.setdefault(c.province, []).append(c.name)
+            if c.lat is not None:
+                total = sums.setdefault(c.province, [0.0, 0.0, 0])
+                total[0] += c.lat
+                total[1] += c.lng
+                total[2] += 1
+            by_name.setdefault(_key(c.name), []).append(c)
+            regions.setdefault(c.region, set()).add(c.province)
+            key = _key(c.name)
+            for n in range(1, min(len(key), PREFIX_LEN) + 1):
+                by_prefix.setdefault(key[:n], []).append(c)
+
+        self.comuni = tuple(comuni)
+        self.by_province = {p: tuple(names) for p, names in by_province.items()}
+        self.provinces = tuple(sorted(by_province))
+        self.regions = {r: tuple(sorted(ps)) for r, ps in sorted(regions.items())}
+        self.by_name = by_name
+        self.by_prefix = {p: tuple(cs) for p, cs in by_prefix.items()}
+        # Centro di ogni provincia: media delle coordinate dei suoi comuni
+        self.centroids = {p: (t[0] / t[2], t[1] / t[2]) for p, t in sums.items()}
+        # Impronta del file: ETag delle risposte che dipendono dai dati
+        self.version = hashlib.sha1(raw).hexdigest()[:16]
+        self._loaded = True
+
+    def ensure(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._load()
+        return self
+
+    def cities(self, province):
+        return self.ensure().by_province.get(province, ())
+
+    def province_centroid(self, province):
+        return self.ensure().centroids.get(province)
+
+    def lookup(self, name, province=None):
+        """Comune con questo nome (se ambiguo, nella provincia indicata); None se non trovato.
+
+        Se nella provincia indicata non c'è, vale il solo nome quando è univoco:
+        i comuni passati ad altra provincia (es. Teulada, da Cagliari a Sud Sardegna)
+        restano riconosciuti con la provincia salvata prima del cambio.
+        """
+        matches = self.ensure().by_name.get(_key(name), [])
+        if province:
+            matches = [c for c in matches if c.province == province] or matches
+        return matches[0] if len(matches) == 1 else None
+
+    def complete(self, prefix, province=None, limit=10):
+        """Comuni il cui nome inizia con `prefix`, in ordine alfabetico"""
+        key = _key(prefix)
+        if not key:
+            return []
+        candidates = self.ensure().by_prefix.get(key[:PREFIX_LEN], ())
+        out = []
+        for c in candidates:
+            if (len(key) <= PREFIX_LEN or _key(c.name).startswith(key)) and (not province or c.province == province):
+                out.append(c)
+                if len(out) >= limit:
+                    break
+        return out
+
+
+gazetteer = Gazetteer()
+
 
 def get_provinces():
-    """Ritorna lista ordinata di province sarde"""
-    return sorted(SARDEGNA_LOCATIONS.keys())
+    """Ritorna lista ordinata delle province"""
+    return gazetteer.ensure().provinces
+
 
 def get_cities(province):
-    """Ritorna lista comuni per provincia sarda"""
-    return sorted(SARDEGNA_LOCATIONS.get(province, []))
+    """Ritorna lista ordinata dei comuni della provincia"""
+    return gazetteer.cities(province)
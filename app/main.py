@@ -1,12 +1,18 @@
-from flask import Blueprint, render_template, request, redirect, url_for, jsonify, flash
+from flask import Blueprint, render_template, request, redirect, url_for, jsonify, flash, Response
 from flask_login import login_required, current_user
 from . import db
 from .models import User, Product
-from .locations import get_provinces, get_cities
+from .locations import get_cities, gazetteer
 from .email_utils import send_email
-from geopy.distance import geodesic
-import json
-from datetime import datetime
+from .homepage import load_homepage_data
+from .geo import nearby_farmers, farmer_index, farmers_geojson, parse_bbox
+from .cache import TTLCache
+from .clusters import cluster_index, MAX_ZOOM
+from .facets import facet_index
+from .claims import search_claimable, suggest_claimable
+from datetime import datetime, timezone
+import hashlib
+import math
 import secrets
 import logging
 
@@ -35,9 +41,55 @@ def faq():
 
 @main.route('/api/cities')
 def api_cities():
+    """Comuni di una provincia, oppure per prefisso con ?q= (autocompletamento)"""
     province = request.args.get('province', '')
-    cities = get_cities(province)
-    return jsonify(cities)
+    prefix = request.args.get('q', '').strip()[:50]
+    if prefix:
+        cities = [c.name for c in gazetteer.complete(prefix, province or None)]
+    else:
+        cities = get_cities(province)
+    # I dati cambiano solo con un nuovo deploy: risposta cacheabile a lungo
+    response = jsonify(cities)
+    response.set_etag(hashlib.sha1(repr((gazetteer.version, province, prefix)).encode()).hexdigest()[:20])
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response.make_conditional(request)
+
+# GeoJSON già serializzato, per versione dell'indice e filtri
+_geojson_cache = TTLCache(ttl=300, max_entries=256)
+
+
+@main.route('/api/farmers.geojson')
+def api_farmers_geojson():
+    """Agricoltori per le mappe, filtrabili per bbox (min_lng,min_lat,max_lng,max_lat), provincia e comune.
+
+    Con ?zoom=N i punti vicini sono aggregati in cluster (centroide + conteggio)
+    fino a MAX_ZOOM; oltre si ricevono i singoli punti.
+    """
+    bbox = parse_bbox(request.args.get('bbox', ''))
+    if bbox:
+        # Arrotonda verso l'esterno: viewport quasi uguali condividono la stessa voce di cache
+        bbox = (math.floor(bbox[0] * 100) / 100, math.ceil(bbox[1] * 100) / 100,
+                math.floor(bbox[2] * 100) / 100, math.ceil(bbox[3] * 100) / 100)
+    province = request.args.get('province', '').strip()
+    city = request.args.get('city', '').strip()
+    zoom = request.args.get('zoom', type=int)
+    if zoom is not None and zoom > MAX_ZOOM:
+        zoom = None
+
+    index = farmer_index.ensure()
+    key = (index.version, bbox, province, city, zoom)
+    if zoom is None:
+        body = _geojson_cache.get_or_set(key, lambda: farmers_geojson(bbox, province, city))
+    else:
+        body = _geojson_cache.get_or_set(key, lambda: cluster_index(province, city).geojson(bbox, zoom))
+
+    response = Response(body, mimetype='application/geo+json')
+    response.set_etag(hashlib.sha1(repr(key).encode()).hexdigest()[:20])
+    response.last_modified = datetime.fromtimestamp(int(index.modified_at), tz=timezone.utc)
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response.make_conditional(request)
 
 @main.route('/contact', methods=['GET', 'POST'])
 def contact():
@@ -82,75 +134,21 @@ def index():
     province_filter = request.args.get('province', '')
     city_filter = request.args.get('city', '')
     
-    # Query farmers with limit for performance
-    query = User.query.filter_by(is_farmer=True)
-    
-    # Apply filters
-    if province_filter:
-        query = query.filter_by(province=province_filter)
-    if city_filter:
-        query = query.filter_by(city=city_filter)
-    
-    farmers = query.limit(30).all()
-    
-    # Get products from filtered farmers
-    farmer_ids = [f.id for f in farmers]
-    products = Product.query.filter(Product.user_id.in_(farmer_ids)).all() if farmer_ids else []
-    
-    # Prepare data with farmer info
-    products_data = []
-    for product in products:
-        farmer = db.session.get(User, product.user_id)
-        if farmer:
-            products_data.append({
-                'id': product.id,
-                'name': product.name,
-                'description': product.description,
-                'price': product.price,
-                'unit': product.unit,
-                'image_path': product.image_path,
-                'farmer_name': farmer.company_name or farmer.username,
-                'farmer_username': farmer.username,
-                'farmer_slug': farmer.company_slug or farmer.compute_company_slug(),
-                'farmer_city': farmer.city,
-                'farmer_province': farmer.province,
-                'farmer_address': farmer.address,
-                'user_id': farmer.id
-            })
+    data = load_homepage_data(province_filter, city_filter)
     
     # Get provinces and cities for filters
-    provinces = get_provinces()
-    cities = get_cities(province_filter) if province_filter else []
-    
-    # Choose map center: default Oristano, else first farmer with coordinates
-    center_lat = 39.9043
-    center_lng = 8.5900
-    for f in farmers:
-        if f.latitude and f.longitude:
-            center_lat = f.latitude
-            center_lng = f.longitude
-            break
-    
-    # Prepare farmers JSON for map
-    farmers_json = json.dumps([{
-        'lat': f.latitude,
-        'lng': f.longitude,
-        'name': f.company_name or f.username,
-        'slug': f.company_slug or f.compute_company_slug(),
-        'city': f.city or '',
-        'province': f.province or ''
-    } for f in farmers])
+    provinces = facet_index.provinces()
+    cities = facet_index.cities(province_filter) if province_filter else []
 
     return render_template('index.html', 
-                         products_data=products_data,
-                         farmers=farmers,
-                         farmers_json=farmers_json,
+                         products_data=data['products_data'],
+                         farmers=data['farmers'],
                          provinces=provinces,
                          cities=cities,
                          selected_province=province_filter,
                          selected_city=city_filter,
-                         center_lat=center_lat,
-                         center_lng=center_lng)
+                         center_lat=data['center_lat'],
+                         center_lng=data['center_lng'])
 
 @main.route('/search', methods=['GET', 'POST'])
 @login_required
@@ -159,13 +157,7 @@ def search():
         lat = float(request.form.get('lat'))
         lng = float(request.form.get('lng'))
         radius = 50  # km
-        farmers = User.query.filter_by(is_farmer=True).all()
-        nearby = []
-        for farmer in farmers:
-            if farmer.latitude and farmer.longitude:
-                dist = geodesic((lat, lng), (farmer.latitude, farmer.longitude)).km
-                if dist <= radius:
-                    nearby.append((farmer, dist))
+        nearby = nearby_farmers(lat, lng, radius)
         return render_template('search_results.html', nearby=nearby)
     return render_template('search.html')
 
@@ -176,20 +168,24 @@ def claim_search():
     results = []
     
     if query:
-        # Cerca tra profili non rivendicati
-        results = User.query.filter(
-            User.is_farmer == True,
-            User.is_scraped == True,
-            User.is_claimed == False,
-            db.or_(
-                User.company_name.ilike(f'%{query}%'),
-                User.city.ilike(f'%{query}%'),
-                User.username.ilike(f'%{query}%')
-            )
-        ).limit(20).all()
+        # Cerca tra profili non rivendicati (indice a trigrammi, tollera errori di battitura)
+        results = search_claimable(query, limit=20)
     
     return render_template('claim_search.html', query=query, results=results)
 
+@main.route('/api/claim-search')
+def api_claim_search():
+    """Autocompletamento della ricerca aziende da rivendicare (JSON)"""
+    query = request.args.get('q', '').strip()[:100]
+    if len(query) < 2:
+        return jsonify([])
+    suggestions = suggest_claimable(query, limit=8)
+    for item in suggestions:
+        item['url'] = url_for('main.claim_business', username=item['username'])
+    response = jsonify(suggestions)
+    response.cache_control.max_age = 30
+    return response
+
 @main.route('/rivendica/<username>', methods=['GET', 'POST'])
 def claim_business(username):
     """Pagina per rivendicare una specifica azienda"""
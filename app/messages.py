@@ -3,7 +3,7 @@ from flask_login import login_required, current_user
 from . import db
 from .models import Message, User
 from .forms import MessageForm
-from sqlalchemy import or_, and_
+from .conversations import inbox_conversations, mark_read, history, newer, message_json
 
 messages = Blueprint('messages', __name__)
 
@@ -11,42 +11,9 @@ messages = Blueprint('messages', __name__)
 @login_required
 def inbox():
     """Mostra tutte le conversazioni dell'utente"""
-    # Get all users with whom current_user has exchanged messages
-    conversations_query = db.session.query(User).join(
-        Message,
-        or_(
-            and_(Message.sender_id == User.id, Message.recipient_id == current_user.id),
-            and_(Message.recipient_id == User.id, Message.sender_id == current_user.id)
-        )
-    ).filter(User.id != current_user.id).distinct()
-    
-    conversation_users = conversations_query.all()
-    
-    # For each user, get the last message and unread count
-    conversations = []
-    for user in conversation_users:
-        last_message = Message.query.filter(
-            or_(
-                and_(Message.sender_id == current_user.id, Message.recipient_id == user.id),
-                and_(Message.sender_id == user.id, Message.recipient_id == current_user.id)
-            )
-        ).order_by(Message.timestamp.desc()).first()
-        
-        unread_count = Message.query.filter_by(
-            sender_id=user.id,
-            recipient_id=current_user.id,
-            read=False
-        ).count()
-        
-        conversations.append({
-            'user': user,
-            'last_message': last_message,
-            'unread_count': unread_count
-        })
-    
-    # Sort by last message timestamp
-    conversations.sort(key=lambda x: x['last_message'].timestamp if x['last_message'] else 0, reverse=True)
-    
+    # Una sola query: dal riepilogo conversation o, senza migrazione, con funzioni a finestra
+    conversations = inbox_conversations(current_user.id)
+
     return render_template('inbox.html', conversations=conversations)
 
 @messages.route('/conversation/<int:user_id>', methods=['GET', 'POST'])
@@ -54,27 +21,14 @@ def inbox():
 def conversation(user_id):
     """Mostra conversazione con un utente specifico"""
     other_user = User.query.get_or_404(user_id)
+    wants_json = request.accept_mimetypes.best == 'application/json'
     
     if other_user.id == current_user.id:
+        if wants_json:
+            return jsonify(error='Non puoi inviare messaggi a te stesso'), 400
         flash('⚠ Non puoi inviare messaggi a te stesso', 'warning')
         return redirect(url_for('messages.inbox'))
     
-    # Mark all messages from other_user as read
-    Message.query.filter_by(
-        sender_id=other_user.id,
-        recipient_id=current_user.id,
-        read=False
-    ).update({'read': True})
-    db.session.commit()
-    
-    # Get all messages between the two users
-    conversation_messages = Message.query.filter(
-        or_(
-            and_(Message.sender_id == current_user.id, Message.recipient_id == other_user.id),
-            and_(Message.sender_id == other_user.id, Message.recipient_id == current_user.id)
-        )
-    ).order_by(Message.timestamp.asc()).all()
-    
     form = MessageForm()
     if form.validate_on_submit():
         message = Message(
@@ -84,10 +38,46 @@ def conversation(user_id):
         )
         db.session.add(message)
         db.session.commit()
+        if wants_json:
+            # Invio dalla pagina: torna solo il nuovo messaggio, non tutta la conversazione
+            return jsonify(message=message_json(message, current_user.id)), 201
         flash('✓ Messaggio inviato', 'success')
         return redirect(url_for('messages.conversation', user_id=other_user.id))
+    if request.method == 'POST' and wants_json:
+        return jsonify(error='Messaggio vuoto'), 400
     
-    return render_template('conversation.html', other_user=other_user, messages=conversation_messages, form=form)
+    # Mark all messages from other_user as read
+    mark_read(current_user.id, other_user.id)
+    db.session.commit()
+    
+    # Solo gli ultimi messaggi: i precedenti si caricano a richiesta
+    conversation_messages, has_earlier = history(current_user.id, other_user.id)
+    
+    return render_template('conversation.html', other_user=other_user, messages=conversation_messages,
+                           has_earlier=has_earlier, form=form)
+
+@messages.route('/conversation/<int:user_id>/earlier')
+@login_required
+def earlier_messages(user_id):
+    """Pagina precedente della conversazione (JSON), prima del messaggio ?before=<id>"""
+    other_user = User.query.get_or_404(user_id)
+    before_id = request.args.get('before', type=int)
+    if not before_id:
+        return jsonify(error='Parametro before mancante'), 400
+    rows, has_earlier = history(current_user.id, other_user.id, before_id=before_id)
+    return jsonify(messages=[message_json(m, current_user.id) for m in rows], has_earlier=has_earlier)
+
+@messages.route('/conversation/<int:user_id>/since')
+@login_required
+def new_messages(user_id):
+    """Messaggi arrivati dopo ?after=<id> (JSON): quelli ricevuti vengono segnati come letti"""
+    other_user = User.query.get_or_404(user_id)
+    after_id = request.args.get('after', 0, type=int)
+    rows = newer(current_user.id, other_user.id, after_id)
+    if any(m.sender_id == other_user.id and not m.read for m in rows):
+        mark_read(current_user.id, other_user.id)
+        db.session.commit()
+    return jsonify(messages=[message_json(m, current_user.id) for m in rows])
 
 @messages.route('/send_message/<int:user_id>', methods=['GET', 'POST'])
 @login_required
@@ -39,6 +39,21 @@ class User(UserMixin, db.Model):
     claim_token = db.Column(db.String(64), unique=True)  # Token per rivendicare
     verified_at = db.Column(db.DateTime)  # Data verifica proprietà
     data_source = db.Column(db.String(100))  # Fonte dati (es. "Google Maps", "Manual", "Claimed")
+    # Ordini in attesa (badge in navbar): mantenuto da app/orders.py, riallineato da run_reconcile_pending_orders.py
+    pending_orders_count = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+
+    # Elenco aziende e filtri per luogo; pagina aziendale; link delle email
+    __table_args__ = (
+        db.Index('ix_user_farmer_location', 'is_farmer', 'province', 'city'),
+        db.Index('ix_user_company_slug', 'company_slug'),
+        # Token quasi sempre NULL: indicizzate solo le righe che ne hanno uno
+        db.Index('ix_user_verification_token', 'verification_token',
+                 sqlite_where=db.text('verification_token IS NOT NULL'),
+                 postgresql_where=db.text('verification_token IS NOT NULL')),
+        db.Index('ix_user_reset_token', 'reset_token',
+                 sqlite_where=db.text('reset_token IS NOT NULL'),
+                 postgresql_where=db.text('reset_token IS NOT NULL')),
+    )
 
     products = db.relationship('Product', backref='farmer', lazy=True)
     sent_messages = db.relationship('Message', foreign_keys='Message.sender_id', backref='sender', lazy=True)
@@ -59,9 +74,13 @@ class User(UserMixin, db.Model):
         return self.reset_token
 
     def compute_company_slug(self):
-        base = self.company_name or self.username or f"user-{self.id}"
+        return User.slug_for(self.id, self.company_name, self.username)
+
+    @staticmethod
+    def slug_for(user_id, company_name, username):
+        base = company_name or username or f"user-{user_id}"
         slug = re.sub(r'[^a-zA-Z0-9]+', '-', base).strip('-').lower()
-        return slug or f"azienda-{self.id}"
+        return slug or f"azienda-{user_id}"
 
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -74,6 +93,13 @@ class Product(db.Model):
     minimum_order_quantity = db.Column(db.Integer, default=1)  # Ordine minimo di pezzi/unità
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
+    # Prodotti di un'azienda e filtro per categoria, nell'ordine delle pagine del catalogo
+    __table_args__ = (
+        db.Index('ix_product_user_id', 'user_id', 'id'),
+        db.Index('ix_product_category', 'category', 'name', 'id'),
+        db.Index('ix_product_name', 'name', 'id'),
+    )
+
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
@@ -82,6 +108,37 @@ class Message(db.Model):
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     read = db.Column(db.Boolean, default=False)
 
+    # Cronologia di una conversazione (in entrambi i versi) e messaggi non letti
+    __table_args__ = (
+        db.Index('ix_message_thread', 'sender_id', 'recipient_id', 'timestamp'),
+        db.Index('ix_message_recipient_read', 'recipient_id', 'read'),
+    )
+
+
+class Conversation(db.Model):
+    """Riepilogo di una conversazione tra due utenti (low_id < high_id), aggiornato a ogni messaggio"""
+    low_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    high_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    last_message_id = db.Column(db.Integer)
+    last_message_at = db.Column(db.DateTime)
+    last_sender_id = db.Column(db.Integer)
+    last_preview = db.Column(db.String(100))
+    # Messaggi non ancora letti da low_id e da high_id
+    unread_low = db.Column(db.Integer, nullable=False, default=0)
+    unread_high = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_conversation_low_last', 'low_id', 'last_message_at'),
+        db.Index('ix_conversation_high_last', 'high_id', 'last_message_at'),
+    )
+
+    def partner_id(self, user_id):
+        return self.high_id if user_id == self.low_id else self.low_id
+
+    def unread_for(self, user_id):
+        return self.unread_low if user_id == self.low_id else self.unread_high
+
+
 class OrderRequest(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -97,9 +154,36 @@ class OrderRequest(db.Model):
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     completed_at = db.Column(db.DateTime, nullable=True)  # Data completamento ordine
     reviewed = db.Column(db.Boolean, default=False)  # Se il cliente ha già recensito
-    
+
+    # Ordini ricevuti (per stato) e inviati, dal più recente
+    __table_args__ = (
+        db.Index('ix_order_request_farmer_status', 'farmer_id', 'status', 'created_at'),
+        db.Index('ix_order_request_farmer_created', 'farmer_id', 'created_at'),
+        db.Index('ix_order_request_client_created', 'client_id', 'created_at'),
+    )
+
     farmer = db.relationship('User', foreign_keys=[farmer_id], backref='received_orders')
     client = db.relationship('User', foreign_keys=[client_id], backref='placed_orders')
+    items = db.relationship('OrderItem', backref='order', lazy=True, order_by='OrderItem.id',
+                            cascade='all, delete-orphan')
+
+
+class OrderItem(db.Model):
+    """Riga d'ordine: nome, unità e prezzo sono copiati dal prodotto al momento dell'ordine"""
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order_request.id'), nullable=False, index=True)
+    # NULL se il prodotto è stato eliminato dopo l'ordine
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='SET NULL'), index=True)
+    name = db.Column(db.String(150), nullable=False)
+    unit = db.Column(db.String(20))
+    price = db.Column(db.Float, nullable=False, default=0.0)
+    qty = db.Column(db.Integer, nullable=False, default=1)
+
+    @property
+    def subtotal(self):
+        return (self.price or 0) * (self.qty or 0)
+
+
 class Review(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -113,3 +197,78 @@ class Review(db.Model):
     farmer = db.relationship('User', foreign_keys=[farmer_id], backref='reviews')
     client = db.relationship('User', foreign_keys=[client_id], backref='written_reviews')
     order = db.relationship('OrderRequest', backref='review')
+
+    __table_args__ = (db.Index('ix_review_farmer_created', 'farmer_id', 'created_at'),)
+
+
+class RatingSummary(db.Model):
+    """Valutazioni di un'azienda: numero, somma e istogramma delle stelle, aggiornati a ogni recensione"""
+    farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    review_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    stars_1 = db.Column(db.Integer, nullable=False, default=0)
+    stars_2 = db.Column(db.Integer, nullable=False, default=0)
+    stars_3 = db.Column(db.Integer, nullable=False, default=0)
+    stars_4 = db.Column(db.Integer, nullable=False, default=0)
+    stars_5 = db.Column(db.Integer, nullable=False, default=0)
+    last_review_id = db.Column(db.Integer)  # ultima recensione ricevuta
+    # Ultima modifica (nuova recensione, voto o commento cambiato, eliminazione): entra nell'ETag
+    updated_at = db.Column(db.DateTime)
+
+    @property
+    def average(self):
+        return round(self.rating_sum / self.review_count, 1) if self.review_count else 0
+
+    def histogram(self):
+        """Recensioni per numero di stelle, da 1 a 5"""
+        return [self.stars_1, self.stars_2, self.stars_3, self.stars_4, self.stars_5]
+
+
+class CartSession(db.Model):
+    """Carrello lato server: nel cookie di sessione resta solo l'id"""
+    id = db.Column(db.String(32), primary_key=True)
+    data = db.Column(db.Text, nullable=False)  # {farmer_id: {product_id: [qty, price, min_qty, name, unit]}}
+    updated_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class OutboxMessage(db.Model):
+    """Notifica da inviare, scritta nella stessa transazione dell'evento che la genera"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False, default='email')
+    payload = db.Column(db.Text, nullable=False)  # JSON con i dati per l'invio
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending|sent|failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    available_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())  # prossimo tentativo
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (db.Index('ix_outbox_message_due', 'status', 'available_at'),)
+
+
+class ServerEvent(db.Model):
+    """Evento per lo stream /events, letto dagli altri worker quando non c'è LISTEN/NOTIFY"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    data = db.Column(db.Text, nullable=False)  # JSON
+    created_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp(), index=True)
+
+
+class SalesDaily(db.Model):
+    """Riepilogo giornaliero degli ordini per agricoltore e stato (giorno di creazione dell'ordine)"""
+    farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+
+
+class ProductSalesDaily(db.Model):
+    """Venduto giornaliero per prodotto (solo ordini confermati/completati); product_id 0 = prodotto eliminato"""
+    farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(150))
+    qty = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
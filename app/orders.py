@@ -0,0 +1,228 @@
+import json
+from datetime import datetime
+from sqlalchemy import event, func, select, update, insert, exists, inspect as sa_inspect
+from sqlalchemy.orm import object_session
+from . import db
+from .models import User, Product, OrderRequest, OrderItem
+from .principal import forget_after_commit, _principal_cache
+from . import rollups, events
+
+PENDING = 'pending'
+
+# Azioni sugli ordini: stati di partenza ammessi e stato di arrivo
+TRANSITIONS = {
+    'accept': ((PENDING,), 'confirmed'),
+    'reject': ((PENDING,), 'rejected'),
+    'complete': (('confirmed', 'accepted'), 'completed'),
+}
+
+# Stati in cui un ordine conta come venduto nelle statistiche
+SOLD_STATUSES = ('confirmed', 'accepted', 'completed')
+
+_user = User.__table__
+_order = OrderRequest.__table__
+
+
+def adjust_pending(connection, farmer_id, delta, session=None):
+    """Aggiorna in SQL il contatore degli ordini in attesa, nella transazione corrente"""
+    if not farmer_id or not delta:
+        return
+    connection.execute(
+        update(_user).where(_user.c.id == farmer_id)
+        .values(pending_orders_count=func.coalesce(_user.c.pending_orders_count, 0) + delta)
+    )
+    if session is not None:
+        # Il badge arriva dall'identità in cache: va rinfrescata dopo il commit
+        forget_after_commit(session, farmer_id)
+
+
+def _previous(state, attr):
+    history = state.attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(state.object, attr)
+
+
+@event.listens_for(OrderRequest, 'after_insert')
+def _order_created(mapper, connection, target):
+    if target.status == PENDING:
+        adjust_pending(connection, target.farmer_id, 1, object_session(target))
+
+
+@event.listens_for(OrderRequest, 'after_update')
+def _order_updated(mapper, connection, target):
+    state = sa_inspect(target)
+    if not (state.attrs['status'].history.has_changes() or state.attrs['farmer_id'].history.has_changes()):
+        return
+    session = object_session(target)
+    if _previous(state, 'status') == PENDING:
+        adjust_pending(connection, _previous(state, 'farmer_id'), -1, session)
+    if target.status == PENDING:
+        adjust_pending(connection, target.farmer_id, 1, session)
+
+
+@event.listens_for(OrderRequest, 'after_delete')
+def _order_deleted(mapper, connection, target):
+    state = sa_inspect(target)
+    if _previous(state, 'status') == PENDING:
+        adjust_pending(connection, _previous(state, 'farmer_id'), -1, object_session(target))
+
+
+# Carica sempre il valore precedente: serve per sapere se l'ordine era in attesa
+@event.listens_for(OrderRequest.status, 'set', active_history=True)
+@event.listens_for(OrderRequest.farmer_id, 'set', active_history=True)
+def _keep_previous(target, value, oldvalue, initiator):
+    pass
+
+
+def reconcile_pending_counts():
+    """Riallinea i contatori al conteggio reale degli ordini; ritorna quanti agricoltori sono stati corretti"""
+    actual = select(func.count(OrderRequest.id)).where(
+        OrderRequest.farmer_id == _user.c.id,
+        OrderRequest.status == PENDING
+    ).scalar_subquery()
+    result = db.session.execute(
+        update(_user).where(
+            _user.c.is_farmer == True,
+            db.or_(_user.c.pending_orders_count.is_(None), _user.c.pending_orders_count != actual)
+        ).values(pending_orders_count=actual)
+    )
+    db.session.commit()
+    if result.rowcount:
+        _principal_cache.clear()
+    return result.rowcount
+
+
+def parse_day(value):
+    """Data 'AAAA-MM-GG' di un filtro (form o query string); None se assente o non valida"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except ValueError:
+        return None
+
+
+def bulk_transition(farmer_id, action, order_ids=None, date_from=None, date_to=None):
+    """Applica `action` agli ordini dell'agricoltore con un solo UPDATE.
+
+    Selezione per id (order_ids) e/o per data di creazione [date_from, date_to).
+    Ritorna (righe, esiti): le righe modificate (id, client_id, client_email,
+    total_price, created_at) e, per ogni id richiesto, {'outcome': 'updated' | 'not_found'
+    | 'invalid_status', 'status': stato attuale}. Non fa commit: notifiche e
+    contatori restano nella stessa transazione del chiamante.
+    """
+    sources, target = TRANSITIONS[action]
+    if order_ids is None and date_from is None and date_to is None:
+        raise ValueError('Selezione vuota: indicare ordini o intervallo di date')
+    conditions = [_order.c.farmer_id == farmer_id, _order.c.status.in_(sources)]
+    if order_ids is not None:
+        conditions.append(_order.c.id.in_(order_ids))
+    if date_from is not None:
+        conditions.append(_order.c.created_at >= date_from)
+    if date_to is not None:
+        conditions.append(_order.c.created_at < date_to)
+    values = {'status': target}
+    if target == 'completed':
+        values['completed_at'] = datetime.utcnow()
+    columns = (_order.c.id, _order.c.client_id, _order.c.client_email, _order.c.total_price, _order.c.created_at)
+
+    session = db.session()
+    conn = session.connection()
+    if conn.dialect.update_returning:
+        rows = conn.execute(update(_order).where(*conditions).values(**values).returning(*columns)).all()
+    else:
+        # Senza RETURNING: blocca le righe, poi un UPDATE sugli id trovati
+        rows = conn.execute(select(*columns).where(*conditions).with_for_update()).all()
+        if rows:
+            conn.execute(update(_order).where(_order.c.id.in_([r.id for r in rows])).values(**values))
+
+    if PENDING in sources:
+        adjust_pending(conn, farmer_id, -len(rows), session)
+    # Notifiche in tempo reale ai clienti (/events), inviate dopo il commit
+    for r in rows:
+        events.record(session, r.client_id, 'order', {'id': r.id, 'status': target})
+    events.record(session, farmer_id, 'badges')
+    # Gli stati di partenza di una stessa azione coincidono nei riepiloghi ('accepted' = 'confirmed')
+    rollups.move_orders(conn, farmer_id, rows, sources[0], target)
+    # Gli ordini già caricati nella sessione vanno riletti
+    updated = {r.id for r in rows}
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, OrderRequest) and obj.id in updated:
+            session.expire(obj)
+
+    outcomes = {r.id: {'outcome': 'updated', 'status': target} for r in rows}
+    missing = [i for i in (order_ids or ()) if i not in outcomes]
+    if missing:
+        current = dict(conn.execute(select(_order.c.id, _order.c.status).where(
+            _order.c.id.in_(missing), _order.c.farmer_id == farmer_id)).all())
+        for i in missing:
+            if i in current:
+                outcomes[i] = {'outcome': 'invalid_status', 'status': current[i]}
+            else:
+                outcomes[i] = {'outcome': 'not_found', 'status': None}
+    return rows, outcomes
+
+
+# --- righe d'ordine -----------------------------------------------------------------
+
+def item_values(items, known_product_ids, order_id=None):
+    """Valori delle righe d'ordine da un carrello/items_json {product_id: {name, unit, price, qty}}"""
+    values = []
+    for pid, item in items.items():
+        pid = int(pid) if str(pid).isdigit() else None
+        values.append({
+            'order_id': order_id,
+            'product_id': pid if pid in known_product_ids else None,
+            'name': (item.get('name') or 'Prodotto')[:150],
+            'unit': item.get('unit'),
+            'price': float(item.get('price') or 0),
+            'qty': int(item.get('qty') or 1),
+        })
+    return values
+
+
+def existing_product_ids(ids):
+    ids = {int(i) for i in ids if str(i).isdigit()}
+    if not ids:
+        return set()
+    return {pid for (pid,) in db.session.query(Product.id).filter(Product.id.in_(ids))}
+
+
+def backfill_order_items(chunk_size=500, start_id=0, log=print):
+    """Crea le righe OrderItem degli ordini che hanno solo items_json, a blocchi di `chunk_size`.
+
+    Ogni blocco è confermato subito: rilanciando lo script si riparte dagli
+    ordini ancora senza righe. Gli ordini vuoti ('{}') sono esclusi dalla query;
+    un items_json illeggibile non viene mai modificato: è scritto nel log (da
+    correggere a mano) e saltato. Ritorna (ordini convertiti, righe create, illeggibili).
+    """
+    last_id, converted, created, unreadable = start_id, 0, 0, 0
+    while True:
+        rows = db.session.query(OrderRequest.id, OrderRequest.items_json).filter(
+            OrderRequest.id > last_id,
+            OrderRequest.items_json != '{}',
+            ~exists().where(OrderItem.order_id == OrderRequest.id)
+        ).order_by(OrderRequest.id).limit(chunk_size).all()
+        if not rows:
+            break
+        parsed = {}
+        for r in rows:
+            try:
+                data = json.loads(r.items_json)
+            except (ValueError, TypeError):
+                data = None
+            if isinstance(data, dict):
+                parsed[r.id] = data
+            else:
+                log(f"  ordine {r.id}: items_json illeggibile, lasciato invariato: {r.items_json!r}")
+                unreadable += 1
+        known = existing_product_ids(pid for data in parsed.values() for pid in data)
+        values = [v for order_id, data in parsed.items() for v in item_values(data, known, order_id)]
+        if values:
+            db.session.execute(insert(OrderItem), values)
+        db.session.commit()
+        converted += len(parsed)
+        created += len(values)
+        last_id = rows[-1].id
+        log(f"  ... fino all'ordine {last_id}: {converted} ordini, {created} righe")
+    return converted, created, unreadable
+
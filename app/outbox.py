@@ -0,0 +1,103 @@
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from . import db
+from .models import OutboxMessage
+from .email_utils import send_many
+
+# Tentativi prima di segnare il messaggio come fallito
+MAX_ATTEMPTS = 8
+# Attesa tra i tentativi: BACKOFF_BASE * 2^tentativi, al massimo BACKOFF_MAX (secondi)
+BACKOFF_BASE = 30
+BACKOFF_MAX = 6 * 3600
+# Attesa del worker quando la coda è vuota (secondi)
+POLL_INTERVAL = 5
+
+
+def enqueue_email(to_email, subject, html_content):
+    """Accoda un'email: viene salvata con il prossimo commit della sessione, insieme all'evento che la genera"""
+    if not to_email:
+        return None
+    msg = OutboxMessage(kind='email', available_at=datetime.utcnow(),
+                        payload=json.dumps({'to': to_email, 'subject': subject, 'html': html_content}))
+    db.session.add(msg)
+    return msg
+
+
+def _deliver_emails(payloads):
+    # Un solo giro di connessioni (SMTP/SendGrid) per tutto il blocco
+    return send_many([(p['to'], p['subject'], p['html']) for p in payloads], fallback=False)
+
+
+# Per tipo di messaggio: funzione che riceve i payload del blocco e ritorna un esito per ciascuno
+HANDLERS = {'email': _deliver_emails}
+
+
+def backoff(attempts):
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+
+
+def _claim(batch_size):
+    query = OutboxMessage.query.filter(
+        OutboxMessage.status == 'pending',
+        OutboxMessage.available_at <= datetime.utcnow()
+    ).order_by(OutboxMessage.id).limit(batch_size)
+    if db.engine.dialect.name == 'postgresql':
+        # Più worker in parallelo: ognuno prende righe diverse
+        query = query.with_for_update(skip_locked=True)
+    return query.all()
+
+
+def drain(batch_size=20, log=logging.info):
+    """Invia i messaggi in scadenza, a blocchi; ritorna quanti ne ha elaborati"""
+    processed = 0
+    while True:
+        batch = _claim(batch_size)
+        if not batch:
+            break
+        outcomes = {}
+        by_kind = {}
+        for msg in batch:
+            by_kind.setdefault(msg.kind, []).append(msg)
+        for kind, msgs in by_kind.items():
+            try:
+                results = HANDLERS[kind]([json.loads(m.payload) for m in msgs])
+                errors = [None if ok else 'invio non riuscito' for ok in results]
+            except Exception as e:
+                errors = [repr(e)] * len(msgs)
+            outcomes.update((m.id, error) for m, error in zip(msgs, errors))
+        for msg in batch:
+            error = outcomes[msg.id]
+            msg.attempts += 1
+            if error is None:
+                msg.status, msg.sent_at, msg.last_error = 'sent', datetime.utcnow(), None
+            else:
+                msg.last_error = error
+                if msg.attempts >= MAX_ATTEMPTS:
+                    msg.status = 'failed'
+                    log(f"Outbox: messaggio {msg.id} scartato dopo {msg.attempts} tentativi: {error}")
+                else:
+                    msg.available_at = datetime.utcnow() + timedelta(seconds=backoff(msg.attempts))
+        db.session.commit()
+        processed += len(batch)
+    return processed
+
+
+def run_worker(poll_interval=POLL_INTERVAL, once=False, log=logging.info):
+    """Ciclo del worker: svuota la coda, poi attende nuovi messaggi"""
+    while True:
+        try:
+            processed = drain(log=log)
+            if processed:
+                log(f"Outbox: {processed} messaggi elaborati")
+        except Exception:
+            db.session.rollback()
+            logging.exception("Outbox: errore durante l'invio")
+            processed = 0
+        finally:
+            db.session.remove()
+        if once:
+            return processed
+        if not processed:
+            time.sleep(poll_interval)
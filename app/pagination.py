@@ -0,0 +1,93 @@
+import base64
+import json
+from sqlalchemy import and_, or_, event
+from .cache import TTLCache
+from .models import User, Product
+
+# Le prime pagine restano raggiungibili con ?page=N (OFFSET), oltre si usa il cursore
+OFFSET_PAGES = 5
+
+# Totali approssimati: il COUNT viene rifatto al massimo una volta al minuto per filtro
+_count_cache = TTLCache(ttl=60)
+
+
+@event.listens_for(Product, 'after_insert')
+@event.listens_for(Product, 'after_delete')
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_delete')
+def _listing_changed(mapper, connection, target):
+    _count_cache.clear()
+
+
+def encode_cursor(sort_value, row_id, direction, page):
+    raw = json.dumps([sort_value, row_id, direction, page], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Ritorna (sort_value, row_id, direction, page) oppure None se il token non è valido"""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        sort_value, row_id, direction, page = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    if direction not in ('n', 'p') or not isinstance(row_id, int) or not isinstance(page, int):
+        return None
+    # Liste e oggetti arriverebbero come parametri della query (errore 500): si riparte da pagina 1
+    if isinstance(sort_value, bool) or not isinstance(sort_value, (str, int, float)):
+        return None
+    return sort_value, row_id, direction, page
+
+
+def cached_count(key, query):
+    """Totale della query, memorizzato per chiave (es. nome lista + filtri)"""
+    return _count_cache.get_or_set(key, query.count)
+
+
+class KeysetPage:
+    """Risultato di una pagina: righe, numero pagina (stimato) e token precedente/successivo"""
+
+    def __init__(self, rows, page, next_cursor=None, prev_cursor=None, prev_page=None):
+        self.rows = rows
+        self.page = page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        # Con la paginazione a offset la pagina precedente resta un link ?page=N
+        self.prev_page = prev_page
+
+
+def keyset_paginate(query, sort_col, id_col, key_fn, per_page, cursor=None, page=1):
+    """Pagina ordinata su (sort_col, id_col).
+
+    Senza cursore usa OFFSET per `page` (compatibilità con i link ?page=N);
+    con un cursore valido filtra per chiave e non scorre le righe precedenti.
+    key_fn(row) ritorna la tupla (sort_value, id) di una riga.
+    """
+    decoded = decode_cursor(cursor)
+    if decoded is None:
+        page = max(1, page)
+        rows = query.order_by(sort_col, id_col).offset((page - 1) * per_page).limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(*key_fn(rows[-1]), 'n', page + 1) if has_next and rows else None
+        return KeysetPage(rows, page, next_cursor=next_cursor, prev_page=page - 1 if page > 1 else None)
+
+    sort_value, row_id, direction, page = decoded
+    if direction == 'n':
+        rows = query.filter(or_(sort_col > sort_value, and_(sort_col == sort_value, id_col > row_id))) \
+            .order_by(sort_col, id_col).limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        has_prev = True
+    else:
+        rows = query.filter(or_(sort_col < sort_value, and_(sort_col == sort_value, id_col < row_id))) \
+            .order_by(sort_col.desc(), id_col.desc()).limit(per_page + 1).all()
+        has_prev = len(rows) > per_page
+        rows = list(reversed(rows[:per_page]))
+        has_next = True
+
+    next_cursor = encode_cursor(*key_fn(rows[-1]), 'n', page + 1) if has_next and rows else None
+    prev_cursor = encode_cursor(*key_fn(rows[0]), 'p', page - 1) if has_prev and rows and page > 1 else None
+    return KeysetPage(rows, page, next_cursor=next_cursor, prev_cursor=prev_cursor)
@@ -0,0 +1,97 @@
+from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from . import db
+from .cache import TTLCache
+from .models import User
+
+# Campi dell'utente autenticato usati da quasi tutte le pagine (niente colonne TEXT)
+PRINCIPAL_FIELDS = ('id', 'username', 'email', 'is_farmer', 'premium', 'display_name', 'province', 'city',
+                    'latitude', 'longitude', 'company_name', 'company_slug', 'email_verified',
+                    'pending_orders_count')
+
+# Breve: gli altri worker vedono le modifiche al massimo dopo questo intervallo
+PRINCIPAL_TTL = 60
+
+_principal_cache = TTLCache(ttl=PRINCIPAL_TTL, max_entries=10000)
+
+
+class CachedPrincipal(UserMixin):
+    """Identità dell'utente autenticato ricostruita dalla cache.
+
+    I campi di PRINCIPAL_FIELDS sono attributi normali; qualsiasi altro
+    attributo o metodo carica l'oggetto User completo (una sola volta per
+    richiesta) e viene letto da lì. Le assegnazioni vanno sempre sull'User.
+    """
+
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+        self.__dict__['_user'] = None
+
+    def _load(self):
+        user = self.__dict__['_user']
+        if user is None:
+            user = self.__dict__['_user'] = db.session.get(User, self.__dict__['id'])
+        return user
+
+    def __getattr__(self, name):
+        # Chiamato solo per gli attributi non in cache
+        if name.startswith('__'):
+            raise AttributeError(name)
+        user = self._load()
+        if user is None:
+            raise AttributeError(name)
+        return getattr(user, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+        if name in self.__dict__:
+            self.__dict__[name] = value
+        forget_principal(self.__dict__['id'])
+
+    def compute_company_slug(self):
+        return User.slug_for(self.id, self.company_name, self.username)
+
+    def __repr__(self):
+        return f'<CachedPrincipal {self.id} {self.username}>'
+
+
+def load_principal(user_id):
+    """user_loader: identità dalla cache, altrimenti una query sulle sole colonne necessarie"""
+    fields = _principal_cache.get(user_id)
+    if fields is None:
+        row = db.session.query(*(getattr(User, f) for f in PRINCIPAL_FIELDS)).filter(User.id == user_id).first()
+        if row is None:
+            return None
+        fields = _principal_cache.set(user_id, dict(zip(PRINCIPAL_FIELDS, row)))
+    return CachedPrincipal(fields)
+
+
+def forget_principal(user_id):
+    _principal_cache.delete(user_id)
+
+
+def forget_after_commit(session, user_id):
+    """Toglie l'identità dalla cache al commit della sessione.
+
+    Toglierla al flush non basta: fino al commit le altre richieste leggono
+    ancora i valori vecchi e li rimetterebbero in cache per PRINCIPAL_TTL.
+    """
+    session.info.setdefault('stale_principals', set()).add(user_id)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, target):
+    forget_after_commit(object_session(target), target.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _forget_changed(session):
+    for user_id in session.info.pop('stale_principals', ()):
+        forget_principal(user_id)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_on_rollback(session, previous_transaction):
+    session.info.pop('stale_principals', None)
@@ -3,19 +3,44 @@ from flask_login import login_required, current_user
 from . import db
 from .models import Product, User
 from .forms import ProductForm
+from .geo import farmer_index, farmer_counts_cache
+from .facets import facet_index
+from .pagination import keyset_paginate, cached_count, OFFSET_PAGES
+from .search import search_products
+from sqlalchemy import func, event
 import os
 from werkzeug.utils import secure_filename
 
 products = Blueprint('products', __name__)
 
-@products.route('/products')
-def list_products():
-    province = request.args.get('province', '').strip()
-    city = request.args.get('city', '').strip()
-    category = request.args.get('category', '').strip()
-    page = request.args.get('page', 1, type=int)
-    per_page = 12
+PER_PAGE = 12
+
+@event.listens_for(Product, 'after_insert')
+@event.listens_for(Product, 'after_update')
+@event.listens_for(Product, 'after_delete')
+def _product_changed(mapper, connection, target):
+    farmer_counts_cache.clear()
+
+
+def _product_dict(p, farmer, distance_km=None):
+    return {
+        'id': p.id,
+        'name': p.name,
+        'description': p.description,
+        'price': p.price,
+        'unit': p.unit,
+        'image_path': p.image_path,
+        'user_id': p.user_id,
+        'farmer_name': farmer.company_name if farmer and farmer.company_name else (farmer.username if farmer else 'Sconosciuto'),
+        'farmer_username': farmer.username if farmer else None,
+        'farmer_slug': farmer.company_slug if farmer else None,
+        'farmer_city': farmer.city if farmer else None,
+        'farmer_province': farmer.province if farmer else None,
+        'distance_km': distance_km
+    }
 
+
+def _filtered_query(province, city, category):
     query = db.session.query(Product, User).join(User, Product.user_id == User.id).filter(User.is_farmer == True)
     if province:
         query = query.filter(User.province == province)
@@ -23,38 +48,122 @@ def list_products():
         query = query.filter(User.city == city)
     if category:
         query = query.filter(Product.category == category)
+    return query
+
+
+def _farmer_product_counts(province, city, category):
+    """Numero di prodotti per azienda con i filtri correnti: {farmer_id: count}"""
+    def load():
+        query = db.session.query(Product.user_id, func.count(Product.id)) \
+            .join(User, Product.user_id == User.id).filter(User.is_farmer == True)
+        if province:
+            query = query.filter(User.province == province)
+        if city:
+            query = query.filter(User.city == city)
+        if category:
+            query = query.filter(Product.category == category)
+        return dict(query.group_by(Product.user_id).all())
+    return farmer_counts_cache.get_or_set((province, city, category), load)
+
+
+def _proximity_page(lat, lng, province, city, category, page, per_page):
+    """Pagina di prodotti ordinati per distanza dell'azienda.
+
+    La distanza è calcolata una volta per azienda sull'indice in memoria;
+    dal database si leggono solo i prodotti delle aziende che cadono nella pagina.
+    """
+    counts = _farmer_product_counts(province, city, category)
+    distances = farmer_index.ensure().distances(lat, lng)
+    # Aziende senza coordinate in coda
+    ordered = sorted(counts, key=lambda fid: (fid not in distances, distances.get(fid, 0.0), fid))
+    total = sum(counts.values())
+
+    # Individua le aziende che coprono l'intervallo [start, end)
+    start, end = (page - 1) * per_page, page * per_page
+    window = []  # (farmer_id, skip, take)
+    seen = 0
+    for fid in ordered:
+        n = counts[fid]
+        if seen + n > start:
+            skip = max(0, start - seen)
+            take = min(n - skip, end - seen - skip)
+            window.append((fid, skip, take))
+        seen += n
+        if seen >= end:
+            break
+
+    rows_by_farmer = {}
+    full = [fid for fid, skip, take in window if skip == 0 and take == counts[fid]]
+    if full:
+        for p, farmer in _filtered_query(province, city, category).filter(Product.user_id.in_(full)).order_by(Product.id).all():
+            rows_by_farmer.setdefault(farmer.id, []).append((p, farmer))
+    for fid, skip, take in window:
+        if fid not in rows_by_farmer:
+            rows_by_farmer[fid] = _filtered_query(province, city, category).filter(Product.user_id == fid) \
+                .order_by(Product.id).offset(skip).limit(take).all()
 
-    total = query.count()
-    total_pages = (total + per_page - 1) // per_page
-    rows = query.offset((page - 1) * per_page).limit(per_page).all()
-    
     products_data = []
-    for p, farmer in rows:
-        products_data.append({
-            'id': p.id,
-            'name': p.name,
-            'description': p.description,
-            'price': p.price,
-            'unit': p.unit,
-            'image_path': p.image_path,
-            'user_id': p.user_id,
-            'farmer_name': farmer.company_name if farmer and farmer.company_name else (farmer.username if farmer else 'Sconosciuto'),
-            'farmer_username': farmer.username if farmer else None,
-            'farmer_slug': farmer.company_slug if farmer else None,
-            'farmer_city': farmer.city if farmer else None,
-            'farmer_province': farmer.province if farmer else None
-        })
-
-    province_options = sorted({f.province for f in User.query.filter(User.is_farmer == True, User.province.isnot(None)).all()})
-    city_options = []
-    if province:
-        city_options = sorted({f.city for f in User.query.filter(User.is_farmer == True, User.province == province, User.city.isnot(None)).all()})
+    for fid, _, _ in window:
+        for p, farmer in rows_by_farmer.get(fid, []):
+            products_data.append(_product_dict(p, farmer, distances.get(fid)))
+    return products_data, total
+
+
+def _search_page(q, province, city, category, page, per_page):
+    """Pagina di risultati della ricerca testuale, nell'ordine di rilevanza"""
+    hits, total = search_products(q, page, per_page, province=province, city=city, category=category)
+    if not hits:
+        return [], total
+    rows = _filtered_query(province, city, category).filter(Product.id.in_([pid for pid, _ in hits])).all()
+    by_id = {p.id: (p, farmer) for p, farmer in rows}
+    return [_product_dict(*by_id[pid]) for pid, _ in hits if pid in by_id], total
+
+
+@products.route('/products')
+def list_products():
+    province = request.args.get('province', '').strip()
+    city = request.args.get('city', '').strip()
+    category = request.args.get('category', '').strip()
+    q = request.args.get('q', '').strip()[:200]
+    sort = request.args.get('sort', '').strip()
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = PER_PAGE
+
+    # Posizione per l'ordinamento: parametri espliciti o posizione salvata del cliente
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    if sort == 'distance' and (lat is None or lng is None) and current_user.is_authenticated \
+            and current_user.latitude is not None and current_user.longitude is not None:
+        lat, lng = current_user.latitude, current_user.longitude
+    if sort == 'distance' and (lat is None or lng is None):
+        sort = ''
+
+    next_cursor = prev_cursor = None
+    if q:
+        # Ricerca testuale: ordinamento per rilevanza, paginazione per numero di pagina
+        sort = ''
+        products_data, total = _search_page(q, province, city, category, page, per_page)
+    elif sort == 'distance':
+        products_data, total = _proximity_page(lat, lng, province, city, category, page, per_page)
     else:
-        city_options = sorted({f.city for f in User.query.filter(User.is_farmer == True, User.city.isnot(None)).all()})
+        query = _filtered_query(province, city, category)
+        total = cached_count(('products', province, city, category), query)
+        result = keyset_paginate(query, Product.name, Product.id, lambda row: (row[0].name, row[0].id),
+                                 per_page, cursor=request.args.get('cursor'), page=page)
+        products_data = [_product_dict(p, farmer) for p, farmer in result.rows]
+        page, next_cursor, prev_cursor = result.page, result.next_cursor, result.prev_cursor
+    total_pages = (total + per_page - 1) // per_page
 
-    category_options = ['frutta', 'verdura', 'vino', 'olio', 'latticini', 'miele', 'altro']
+    province_options = facet_index.province_counts()
+    if province:
+        city_options = facet_index.city_counts(province)
+    else:
+        city_options = [{'name': c} for c in facet_index.cities()]
+    category_options = facet_index.category_counts()
 
-    return render_template('products.html', products=products_data, provinces=province_options, cities=city_options, categories=category_options, selected_province=province, selected_city=city, selected_category=category, page=page, total_pages=total_pages)
+    return render_template('products.html', products=products_data, provinces=province_options, cities=city_options, categories=category_options, selected_province=province, selected_city=city, selected_category=category, page=page, total_pages=total_pages,
+                           sort=sort, lat=lat if sort == 'distance' else None, lng=lng if sort == 'distance' else None,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor, offset_pages=OFFSET_PAGES, q=q)
 
 @products.route('/add_product', methods=['GET', 'POST'])
 @login_required
@@ -1,12 +1,20 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app
+from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, Response, stream_with_context
 from flask_login import login_required, current_user
 from . import db
 from .models import User, Product, OrderRequest
 from .forms import FarmerProfileForm, ClientProfileForm
 from .locations import get_provinces, get_cities
+from .facets import facet_index
+from .geocoding import geocode_user
+from .pagination import keyset_paginate, cached_count, OFFSET_PAGES
+from . import rollups, exports, ratings
+from .orders import parse_day
+from sqlalchemy import func
+from sqlalchemy.orm import selectinload, joinedload
 from werkzeug.utils import secure_filename
 import os
 import re
+from datetime import datetime, timedelta
 
 profiles = Blueprint('profiles', __name__)
 
@@ -51,6 +59,7 @@ def edit_profile():
                 flash('⚠ Seleziona un comune dalla provincia scelta', 'warning')
                 return render_template('profile_edit.html', farmer=True, form=form)
             
+            old_place = (current_user.province, current_user.city)
             current_user.username = form.username.data
             if form.display_name.data:
                 current_user.display_name = form.display_name.data
@@ -64,6 +73,12 @@ def edit_profile():
             if form.address.data:
                 current_user.address = form.address.data
             current_user.delivery = form.delivery.data
+            # Coordinate dal gazetteer solo se mancano o se è cambiato il comune:
+            # cambiare l'indirizzo non sovrascrive coordinate più precise
+            if (current_user.province, current_user.city) != old_place:
+                current_user.latitude = current_user.longitude = None
+            if current_user.latitude is None or current_user.longitude is None:
+                geocode_user(current_user)
             # Aggiorna slug azienda (unico, basato su nome azienda)
             if current_user.is_farmer:
                 base_slug = slugify(current_user.company_name or current_user.username)
@@ -144,7 +159,9 @@ def view_company(slug):
         return redirect(url_for('profiles.view_company', slug=user.company_slug))
     products = Product.query.filter_by(user_id=user.id).all()
     orders = OrderRequest.query.filter_by(farmer_id=user.id).order_by(OrderRequest.created_at.desc()).all()
-    return render_template('profile.html', user=user, products=products, orders=orders, farmer=True)
+    # Media e istogramma dal riepilogo; i commenti li carica la pagina, a blocchi
+    return render_template('profile.html', user=user, products=products, orders=orders, farmer=True,
+                           rating=ratings.summary(user.id))
 
 
 @profiles.route('/u/<username>')
@@ -170,10 +187,46 @@ def my_orders():
     orders = OrderRequest.query.filter_by(farmer_id=current_user.id).order_by(OrderRequest.created_at.desc()).all()
     return render_template('my_orders.html', orders=orders)
 
+@profiles.route('/my-orders/export')
+@login_required
+def export_orders():
+    """Scarica gli ordini ricevuti in CSV o XLSX, generati a blocchi mentre vengono inviati"""
+    if not current_user.is_farmer:
+        flash('Solo gli agricoltori possono esportare gli ordini ricevuti', 'warning')
+        return redirect(url_for('main.index'))
+    fmt = request.args.get('format', 'csv')
+    status = request.args.get('status') or None
+    if fmt not in exports.FORMATS or (status and status not in exports.STATUS_LABELS):
+        flash('Formato o stato non valido', 'danger')
+        return redirect(url_for('profiles.my_orders'))
+    date_from = parse_day(request.args.get('date_from'))
+    date_to = parse_day(request.args.get('date_to'))
+    if date_to:
+        # Data finale inclusa
+        date_to += timedelta(days=1)
+
+    writer, mimetype = exports.FORMATS[fmt]
+    rows = exports.order_rows(current_user.id, date_from, date_to, status)
+    filename = f"ordini-{datetime.utcnow():%Y%m%d}.{fmt}"
+    return Response(stream_with_context(writer(rows)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@profiles.route('/dashboard')
+@login_required
+def dashboard():
+    """Vendite dell'agricoltore: legge solo i riepiloghi giornalieri, mai lo storico ordini"""
+    if not current_user.is_farmer:
+        flash('Solo gli agricoltori possono visualizzare la dashboard', 'warning')
+        return redirect(url_for('main.index'))
+    return render_template('dashboard.html', **rollups.dashboard(current_user.id))
+
 @profiles.route('/my-client-orders')
 @login_required
 def my_client_orders():
-    orders = OrderRequest.query.filter_by(client_id=current_user.id).order_by(OrderRequest.created_at.desc()).all()
+    # Righe e azienda di tutti gli ordini in due query, non una per ordine
+    orders = OrderRequest.query.filter_by(client_id=current_user.id).options(
+        selectinload(OrderRequest.items), joinedload(OrderRequest.farmer)
+    ).order_by(OrderRequest.created_at.desc()).all()
     return render_template('my_client_orders.html', orders=orders)
 
 
@@ -190,9 +243,14 @@ def companies():
     if city:
         query = query.filter_by(city=city)
 
-    total = query.count()
+    total = cached_count(('companies', province, city), query)
     total_pages = (total + per_page - 1) // per_page
-    farmers = query.offset((page - 1) * per_page).limit(per_page).all()
+    # Nome vuoto ('' dai profili importati) come nome mancante: deve coincidere con la chiave del cursore
+    sort_name = func.coalesce(func.nullif(User.company_name, ''), User.username)
+    result = keyset_paginate(query, sort_name, User.id, lambda f: (f.company_name or f.username, f.id),
+                             per_page, cursor=request.args.get('cursor'), page=page)
+    farmers = result.rows
+    page = result.page
     
     updated = False
     for f in farmers:
@@ -202,25 +260,13 @@ def companies():
     if updated:
         db.session.commit()
 
-    province_options = sorted({f.province for f in User.query.filter_by(is_farmer=True).filter(User.province.isnot(None)).all()})
-    city_options = []
+    province_options = facet_index.province_counts()
     if province:
-        city_options = sorted({f.city for f in User.query.filter_by(is_farmer=True, province=province).filter(User.city.isnot(None)).all()})
+        city_options = facet_index.city_counts(province)
     else:
-        city_options = sorted({f.city for f in User.query.filter_by(is_farmer=True).filter(User.city.isnot(None)).all()})
-
-    # Prepara dati JSON per la mappa (tutte le aziende filtrate, non solo pagina corrente)
-    all_filtered_farmers = query.all()
-    import json
-    farmers_json = json.dumps([{
-        'name': f.company_name or f.username,
-        'slug': f.company_slug or f.compute_company_slug(),
-        'city': f.city or '',
-        'province': f.province or '',
-        'lat': f.latitude,
-        'lng': f.longitude
-    } for f in all_filtered_farmers if f.latitude and f.longitude])
+        city_options = [{'name': c} for c in facet_index.cities()]
 
     return render_template('companies.html', farmers=farmers, provinces=province_options, cities=city_options, 
                          selected_province=province, selected_city=city, page=page, total_pages=total_pages,
-                         farmers_json=farmers_json)
+                         next_cursor=result.next_cursor, prev_cursor=result.prev_cursor,
+                         offset_pages=OFFSET_PAGES)
@@ -0,0 +1,138 @@
+from datetime import datetime
+from sqlalchemy import and_, case, delete, event, func, insert, literal, or_, select, inspect as sa_inspect
+from . import db
+from .models import Review, RatingSummary
+from .summaries import upsert, table_ready, backfill_on_create
+
+STARS = range(1, 6)
+
+# Recensioni per pagina nel profilo aziendale (massimo richiedibile con ?limit=)
+PAGE_SIZE = 10
+MAX_PAGE_SIZE = 50
+
+_review = Review.__table__
+_summary = RatingSummary.__table__
+
+
+def summary_ready(bind):
+    """True se la tabella rating_summary esiste; senza migrazione i totali sono calcolati in SQL"""
+    return table_ready(bind, _summary)
+
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    return value
+
+
+# active_history: la history di after_update/after_delete riporta sempre azienda e voto di partenza
+for _attr in (Review.rating, Review.farmer_id):
+    event.listen(_attr, 'set', _keep_old_value, active_history=True, retval=True)
+
+
+def _old(target, attr):
+    history = sa_inspect(target).attrs[attr].history
+    return history.deleted[0] if history.deleted else getattr(target, attr)
+
+
+def _apply(connection, farmer_id, rating, sign, replace):
+    """Aggiunge (sign=1) o toglie (sign=-1) un voto; con rating None aggiorna solo `replace`"""
+    deltas = {'review_count': sign, 'rating_sum': sign * rating, f'stars_{rating}': sign} if rating in STARS else {}
+    upsert(connection, _summary, {'farmer_id': farmer_id}, deltas, replace)
+
+
+# Nella stessa transazione della recensione, con un upsert: nessuna lettura-modifica-scrittura.
+# updated_at cambia a ogni modifica (anche del solo commento) ed entra nell'ETag delle pagine.
+
+@event.listens_for(Review, 'after_insert')
+def _review_added(mapper, connection, target):
+    if summary_ready(connection):
+        _apply(connection, target.farmer_id, target.rating, 1,
+               {'last_review_id': target.id, 'updated_at': datetime.utcnow()})
+
+
+@event.listens_for(Review, 'after_update')
+def _review_updated(mapper, connection, target):
+    if not summary_ready(connection):
+        return
+    old = (_old(target, 'farmer_id'), _old(target, 'rating'))
+    replace = {'updated_at': datetime.utcnow()}
+    if old == (target.farmer_id, target.rating):
+        _apply(connection, target.farmer_id, None, 0, replace)
+    else:
+        _apply(connection, *old, -1, replace)
+        _apply(connection, target.farmer_id, target.rating, 1, replace)
+
+
+@event.listens_for(Review, 'after_delete')
+def _review_deleted(mapper, connection, target):
+    if summary_ready(connection):
+        _apply(connection, _old(target, 'farmer_id'), _old(target, 'rating'), -1,
+               {'updated_at': datetime.utcnow()})
+
+
+def _empty(farmer_id):
+    return RatingSummary(farmer_id=farmer_id, review_count=0, rating_sum=0,
+                         **{f'stars_{n}': 0 for n in STARS})
+
+
+def _aggregates():
+    r = _review.c
+    return (
+        func.count(r.id).label('review_count'),
+        func.coalesce(func.sum(r.rating), 0).label('rating_sum'),
+        *[func.coalesce(func.sum(case((r.rating == n, 1), else_=0)), 0).label(f'stars_{n}') for n in STARS],
+        func.max(r.id).label('last_review_id'),
+    )
+
+
+def summary(farmer_id):
+    """Riepilogo delle valutazioni dell'azienda (mai None): una lettura per chiave primaria"""
+    if summary_ready(db.engine):
+        return db.session.get(RatingSummary, farmer_id) or _empty(farmer_id)
+    row = db.session.execute(select(*_aggregates()).where(
+        _review.c.farmer_id == farmer_id, _review.c.rating.between(1, 5))).one()
+    return RatingSummary(farmer_id=farmer_id, **row._asdict())
+
+
+def page(farmer_id, before_id=None, limit=PAGE_SIZE):
+    """Recensioni dalla più recente, `limit` alla volta, precedenti a before_id se dato.
+
+    Cursore (created_at, id) con l'orario di riferimento letto dal database,
+    come per la cronologia dei messaggi. Ritorna (recensioni, True se ce ne sono altre).
+    """
+    query = Review.query.filter(Review.farmer_id == farmer_id)
+    if before_id:
+        ref = select(Review.created_at).where(Review.id == before_id).scalar_subquery()
+        query = query.filter(or_(Review.created_at < ref, and_(Review.created_at == ref, Review.id < before_id)))
+    rows = query.order_by(Review.created_at.desc(), Review.id.desc()).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
+
+def review_json(review):
+    return {
+        'id': review.id,
+        'client_name': review.client_name,
+        'rating': review.rating,
+        'comment': review.comment,
+        'created_at': review.created_at.strftime('%d/%m/%Y') if review.created_at else '',
+    }
+
+
+def _fill(conn):
+    """Riempie la tabella rating_summary dalle recensioni, con un INSERT ... SELECT"""
+    columns = ['farmer_id', 'review_count', 'rating_sum', *[f'stars_{n}' for n in STARS], 'last_review_id',
+               'updated_at']
+    conn.execute(insert(_summary).from_select(columns, select(
+        _review.c.farmer_id, *_aggregates(), literal(datetime.utcnow(), _summary.c.updated_at.type)
+    ).where(_review.c.rating.between(1, 5)).group_by(_review.c.farmer_id)))
+
+
+# Creata da db.create_all() su un database con recensioni: riempita subito, non lasciata vuota
+backfill_on_create(_summary, _review, _fill)
+
+
+def rebuild():
+    """Ricalcola da zero la tabella rating_summary dalle recensioni"""
+    db.session.execute(delete(_summary))
+    _fill(db.session.connection())
+    db.session.commit()
+    return db.session.query(func.count()).select_from(_summary).scalar()
@@ -1,6 +1,7 @@
-from flask import Blueprint, request, jsonify, render_template, flash, redirect, url_for
+import hashlib
+from flask import Blueprint, Response, request, jsonify, render_template, flash, redirect, url_for
 from flask_login import login_required, current_user
-from app import db
+from app import db, ratings
 from app.models import Review, User, OrderRequest
 
 reviews_bp = Blueprint('reviews', __name__)
@@ -70,6 +71,7 @@ def submit_review(farmer_id):
         # Contrassegna l'ordine come recensito
         order.reviewed = True
         
+        # Il riepilogo delle valutazioni (app/ratings.py) si aggiorna nello stesso commit
         db.session.add(review)
         db.session.commit()
         
@@ -85,25 +87,29 @@ def submit_review(farmer_id):
 
 @reviews_bp.route('/farmer/<int:farmer_id>/reviews')
 def get_farmer_reviews(farmer_id):
-    """Ottieni tutte le recensioni di un'azienda"""
-    reviews = Review.query.filter_by(farmer_id=farmer_id).order_by(Review.created_at.desc()).all()
-    
-    # Calcola media stelle
-    if reviews:
-        avg_rating = sum(r.rating for r in reviews) / len(reviews)
+    """Recensioni di un'azienda a pagine, con media e istogramma dal riepilogo.
+
+    ?before=<id> carica la pagina successiva. L'ETag dipende solo dal
+    riepilogo: se nulla è cambiato risponde 304 senza leggere le recensioni.
+    """
+    before = request.args.get('before', type=int)
+    limit = min(max(request.args.get('limit', ratings.PAGE_SIZE, type=int), 1), ratings.MAX_PAGE_SIZE)
+    stats = ratings.summary(farmer_id)
+    key = (farmer_id, stats.review_count, stats.last_review_id, stats.updated_at, before, limit)
+    etag = hashlib.sha1(repr(key).encode()).hexdigest()[:20]
+
+    if request.if_none_match.contains(etag):
+        response = Response()
     else:
-        avg_rating = 0
-    
-    reviews_data = [{
-        'id': r.id,
-        'client_name': r.client_name,
-        'rating': r.rating,
-        'comment': r.comment,
-        'created_at': r.created_at.strftime('%d/%m/%Y')
-    } for r in reviews]
-    
-    return jsonify({
-        'reviews': reviews_data,
-        'total': len(reviews),
-        'avg_rating': round(avg_rating, 1)
-    })
+        reviews, has_more = ratings.page(farmer_id, before, limit)
+        response = jsonify({
+            'reviews': [ratings.review_json(r) for r in reviews],
+            'total': stats.review_count,
+            'avg_rating': stats.average,
+            'histogram': stats.histogram(),
+            'has_more': has_more,
+        })
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response.make_conditional(request)
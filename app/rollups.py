@@ -0,0 +1,220 @@
+from datetime import date, datetime, timedelta
+from sqlalchemy import case, delete, event, func, insert, select, inspect as sa_inspect
+from . import db
+from .models import OrderRequest, OrderItem, SalesDaily, ProductSalesDaily
+from .summaries import upsert
+
+# 'accepted' è il vecchio stato delle conferme in blocco: nei riepiloghi conta come 'confirmed'
+STATUS_ALIASES = {'accepted': 'confirmed'}
+# Stati (già normalizzati) che contano come venduto
+SOLD = ('confirmed', 'completed')
+
+_order = OrderRequest.__table__
+_item = OrderItem.__table__
+_sales = SalesDaily.__table__
+_product_sales = ProductSalesDaily.__table__
+
+
+def rollup_status(status):
+    return STATUS_ALIASES.get(status, status or 'pending')
+
+
+def _to_day(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.utcnow().date()
+
+
+def _add_items(conn, farmer_id, items, sign):
+    """items: righe (day, product_id, name, qty, price) da sommare (sign=1) o togliere (sign=-1)"""
+    totals = {}
+    for day, product_id, name, qty, price in items:
+        entry = totals.setdefault((day, product_id or 0), [0, 0.0, name])
+        entry[0] += qty or 0
+        entry[1] += (qty or 0) * (price or 0)
+        entry[2] = name
+    for (day, product_id), (qty, revenue, name) in totals.items():
+        upsert(conn, _product_sales, {'farmer_id': farmer_id, 'day': day, 'product_id': product_id},
+               {'qty': sign * qty, 'revenue': sign * revenue}, {'name': name})
+
+
+def move_orders(conn, farmer_id, orders, old_status, new_status, products=True):
+    """Sposta ordini (righe con id, created_at, total_price) da uno stato all'altro nei riepiloghi.
+
+    old_status None = ordine nuovo, new_status None = ordine eliminato. Con
+    products=True aggiorna anche il venduto per prodotto se cambia lo stato
+    di "venduto" (serve una query sulle righe d'ordine).
+    """
+    old = rollup_status(old_status) if old_status is not None else None
+    new = rollup_status(new_status) if new_status is not None else None
+    if old == new or not orders:
+        return
+    per_day = {}
+    for o in orders:
+        entry = per_day.setdefault(_to_day(o.created_at), [0, 0.0])
+        entry[0] += 1
+        entry[1] += o.total_price or 0
+    for day, (count, revenue) in per_day.items():
+        for status, sign in ((old, -1), (new, 1)):
+            if status is not None:
+                upsert(conn, _sales, {'farmer_id': farmer_id, 'day': day, 'status': status},
+                       {'orders': sign * count, 'revenue': sign * revenue})
+    if products and (old in SOLD) != (new in SOLD):
+        days = {o.id: _to_day(o.created_at) for o in orders}
+        rows = conn.execute(select(_item.c.order_id, _item.c.product_id, _item.c.name, _item.c.qty, _item.c.price)
+                            .where(_item.c.order_id.in_(list(days)))).all()
+        _add_items(conn, farmer_id, [(days[r.order_id], r.product_id, r.name, r.qty, r.price) for r in rows],
+                   1 if new in SOLD else -1)
+
+
+# --- aggiornamento incrementale sulle scritture ORM ----------------------------------
+
+class _OrderFacts:
+    """Dati dell'ordine per i riepiloghi, senza caricare attributi scaduti durante il flush"""
+
+    def __init__(self, conn, target):
+        values = target.__dict__
+        self.id = target.id
+        self.created_at = values.get('created_at')
+        self.total_price = values.get('total_price')
+        if self.id and (self.created_at is None or 'total_price' not in values):
+            row = conn.execute(select(_order.c.created_at, _order.c.total_price)
+                               .where(_order.c.id == self.id)).first()
+            if row is not None:
+                self.created_at, self.total_price = row
+        if not isinstance(self.created_at, (date, datetime)):
+            # Default lato server appena inserito: l'ordine è di oggi
+            self.created_at = datetime.utcnow()
+
+
+def _previous(state, attr):
+    history = state.attrs[attr].history
+    return history.deleted[0] if history.deleted else getattr(state.object, attr)
+
+
+@event.listens_for(OrderRequest, 'after_insert')
+def _order_inserted(mapper, connection, target):
+    # Il venduto per prodotto arriva dalle righe, inserite dopo l'ordine
+    move_orders(connection, target.farmer_id, [_OrderFacts(connection, target)], None, target.status,
+                products=False)
+
+
+@event.listens_for(OrderRequest, 'after_update')
+def _order_updated(mapper, connection, target):
+    state = sa_inspect(target)
+    if not (state.attrs['status'].history.has_changes() or state.attrs['farmer_id'].history.has_changes()):
+        return
+    facts = [_OrderFacts(connection, target)]
+    old_farmer = _previous(state, 'farmer_id')
+    if old_farmer != target.farmer_id:
+        move_orders(connection, old_farmer, facts, _previous(state, 'status'), None)
+        move_orders(connection, target.farmer_id, facts, None, target.status)
+    else:
+        move_orders(connection, target.farmer_id, facts, _previous(state, 'status'), target.status)
+
+
+@event.listens_for(OrderRequest, 'after_delete')
+def _order_deleted(mapper, connection, target):
+    state = sa_inspect(target)
+    move_orders(connection, _previous(state, 'farmer_id'), [_OrderFacts(connection, target)],
+                _previous(state, 'status'), None, products=False)
+
+
+def _item_changed(connection, target, sign):
+    order = target.__dict__.get('order')
+    if order is not None:
+        farmer_id, status, created_at = order.farmer_id, order.status, order.__dict__.get('created_at')
+    else:
+        row = connection.execute(select(_order.c.farmer_id, _order.c.status, _order.c.created_at)
+                                 .where(_order.c.id == target.order_id)).first()
+        if row is None:
+            return
+        farmer_id, status, created_at = row
+    if rollup_status(status) in SOLD:
+        _add_items(connection, farmer_id, [(_to_day(created_at), target.product_id, target.name,
+                                            target.qty, target.price)], sign)
+
+
+@event.listens_for(OrderItem, 'after_insert')
+def _item_inserted(mapper, connection, target):
+    _item_changed(connection, target, 1)
+
+
+@event.listens_for(OrderItem, 'after_delete')
+def _item_deleted(mapper, connection, target):
+    _item_changed(connection, target, -1)
+
+
+# --- ricostruzione completa ----------------------------------------------------------
+
+def rebuild(farmer_id=None):
+    """Ricalcola da zero i riepiloghi (di un agricoltore o di tutti) con due INSERT ... SELECT"""
+    status = case(*((_order.c.status == old, new) for old, new in STATUS_ALIASES.items()),
+                  else_=func.coalesce(_order.c.status, 'pending'))
+    day = func.date(_order.c.created_at)
+    where = [_order.c.created_at.isnot(None)]
+    if farmer_id is not None:
+        where.append(_order.c.farmer_id == farmer_id)
+        db.session.execute(delete(_sales).where(_sales.c.farmer_id == farmer_id))
+        db.session.execute(delete(_product_sales).where(_product_sales.c.farmer_id == farmer_id))
+    else:
+        db.session.execute(delete(_sales))
+        db.session.execute(delete(_product_sales))
+
+    db.session.execute(insert(_sales).from_select(
+        ['farmer_id', 'day', 'status', 'orders', 'revenue'],
+        select(_order.c.farmer_id, day, status, func.count(),
+               func.coalesce(func.sum(_order.c.total_price), 0.0))
+        .where(*where).group_by(_order.c.farmer_id, day, status)
+    ))
+    product_id = func.coalesce(_item.c.product_id, 0)
+    sold = [old for old, new in STATUS_ALIASES.items() if new in SOLD] + list(SOLD)
+    db.session.execute(insert(_product_sales).from_select(
+        ['farmer_id', 'day', 'product_id', 'name', 'qty', 'revenue'],
+        select(_order.c.farmer_id, day, product_id, func.max(_item.c.name),
+               func.sum(_item.c.qty), func.sum(_item.c.qty * _item.c.price))
+        .select_from(_item.join(_order, _order.c.id == _item.c.order_id))
+        .where(*where, _order.c.status.in_(sold))
+        .group_by(_order.c.farmer_id, day, product_id)
+    ))
+    db.session.commit()
+
+
+# --- lettura per la dashboard --------------------------------------------------------
+
+def dashboard(farmer_id, weeks=12, top=10, today=None):
+    """Dati della dashboard letti solo dalle tabelle di riepilogo"""
+    today = today or datetime.utcnow().date()
+    start = today - timedelta(days=today.weekday() + 7 * (weeks - 1))
+
+    weekly = [{'week': start + timedelta(weeks=k), 'orders': 0, 'revenue': 0.0} for k in range(weeks)]
+    rows = db.session.query(SalesDaily.day, func.sum(SalesDaily.orders), func.sum(SalesDaily.revenue)).filter(
+        SalesDaily.farmer_id == farmer_id,
+        SalesDaily.day >= start,
+        SalesDaily.status.in_(SOLD)
+    ).group_by(SalesDaily.day).all()
+    for day, orders, revenue in rows:
+        week = weekly[(day - start).days // 7]
+        week['orders'] += orders or 0
+        week['revenue'] += revenue or 0
+
+    by_status = {status: {'orders': orders or 0, 'revenue': revenue or 0.0}
+                 for status, orders, revenue in db.session.query(
+                     SalesDaily.status, func.sum(SalesDaily.orders), func.sum(SalesDaily.revenue)
+                 ).filter(SalesDaily.farmer_id == farmer_id).group_by(SalesDaily.status)}
+
+    revenue = func.sum(ProductSalesDaily.revenue)
+    top_products = db.session.query(
+        ProductSalesDaily.product_id,
+        func.max(ProductSalesDaily.name).label('name'),
+        func.sum(ProductSalesDaily.qty).label('qty'),
+        revenue.label('revenue')
+    ).filter(
+        ProductSalesDaily.farmer_id == farmer_id,
+        ProductSalesDaily.day >= start
+    ).group_by(ProductSalesDaily.product_id).having(revenue > 0).order_by(revenue.desc()).limit(top).all()
+
+    return {'start': start, 'weekly': weekly, 'by_status': by_status, 'top_products': top_products,
+            'max_week_revenue': max(w['revenue'] for w in weekly)}
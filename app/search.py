@@ -0,0 +1,566 @@
+import math
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from functools import lru_cache
+from sqlalchemy import event, func, select, text, inspect as sa_inspect
+from sqlalchemy.orm import object_session
+from . import db
+from .models import User, Product
+from .facets import facet_index
+
+# --- normalizzazione del testo ---------------------------------------------
+# La stessa pipeline (minuscole, niente accenti, stemming leggero) vale per
+# documenti e query, su tutti i backend: l'indice contiene solo radici.
+
+STOPWORDS = frozenset("""
+a ad al alla alle allo agli ai anche che chi con da dal dalla dalle dai dagli dallo
+del della delle dello dei degli di e ed i il in la le lo gli ma nei nel nella nelle
+negli o per piu su sul sulla sulle sui tra fra un una uno non come senza
+""".split())
+
+# Suffissi flessivi più comuni, dal più lungo al più corto
+_SUFFIXES = ('issimi', 'issime', 'issimo', 'issima', 'mente', 'zioni', 'zione',
+             'ie', 'io', 'ia', 'i', 'e', 'a', 'o')
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# Massimo numero di termini considerati in una query
+MAX_QUERY_TERMS = 8
+
+# Solo l'ultimo termine della query (quello che si sta scrivendo) vale come prefisso,
+# e solo da questa lunghezza: 'ol' (olio) non deve trovare oliva, 'pan' non panna
+PREFIX_MIN = 4
+
+
+def fold(value):
+    """Minuscolo senza accenti: 'Caffè Città' -> 'caffe citta'"""
+    if value.isascii():
+        return value.lower()
+    decomposed = unicodedata.normalize('NFKD', value.lower())
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+@lru_cache(maxsize=65536)
+def stem(token):
+    """Stemmer italiano minimale: toglie le desinenze di genere/numero.
+
+    pomodoro/pomodori -> pomodor, arancia/arance -> aranc, pesca/pesche -> pesc
+    """
+    if len(token) <= 3 or token.isdigit():
+        return token
+    for suffix in _SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 2:
+            token = token[:-len(suffix)]
+            break
+    # Plurali in -che/-ghe e -ci/-gi: pesch -> pesc, arancia -> aranci -> aranc
+    if len(token) > 3 and token[-1] in 'hi' and token[-2] in 'cg':
+        token = token[:-1]
+    return token
+
+
+def tokenize(value):
+    """Radici indicizzabili di un testo (stopword escluse, ordine preservato)"""
+    if not value:
+        return []
+    return [stem(t) for t in _TOKEN_RE.findall(fold(value)) if t not in STOPWORDS]
+
+
+def query_terms(q):
+    """Termini distinti di una query, al massimo MAX_QUERY_TERMS"""
+    terms = []
+    for t in tokenize(q):
+        if t not in terms:
+            terms.append(t)
+    return terms[:MAX_QUERY_TERMS]
+
+
+def is_prefix(terms, i):
+    """True se il termine i-esimo della query va cercato anche come prefisso"""
+    return i == len(terms) - 1 and len(terms[i]) >= PREFIX_MIN
+
+
+def product_document(name, description, category, farmer):
+    """Campi indicizzati di un prodotto, già normalizzati"""
+    return {
+        'name': ' '.join(tokenize(name)),
+        'body': ' '.join(tokenize(description)),
+        'category': ' '.join(tokenize(category)),
+        'farmer': ' '.join(tokenize(farmer)),
+    }
+
+
+# Pesi dei campi nel ranking (il nome conta più dell'azienda, poi categoria e descrizione)
+FIELD_WEIGHTS = {'name': 10.0, 'farmer': 4.0, 'category': 3.0, 'body': 1.0}
+
+
+# --- backend -----------------------------------------------------------------
+
+class SqliteBackend:
+    """Tabella virtuale FTS5 con rowid = product.id e ranking bm25"""
+
+    name = 'fts5'
+
+    def exists(self, conn):
+        return conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'product_search'")).first() is not None
+
+    def create(self, conn):
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5("
+            "name, body, category, farmer, prefix='2 3')"
+        ))
+
+    def insert(self, conn, docs):
+        if docs:
+            conn.execute(text("INSERT INTO product_search (rowid, name, body, category, farmer) "
+                              "VALUES (:id, :name, :body, :category, :farmer)"),
+                         [dict(doc, id=pid) for pid, doc in docs])
+
+    def upsert(self, conn, docs):
+        self.delete(conn, [pid for pid, _ in docs])
+        self.insert(conn, docs)
+
+    def delete(self, conn, ids):
+        if ids:
+            conn.execute(text("DELETE FROM product_search WHERE rowid = :id"), [{'id': pid} for pid in ids])
+
+    def clear(self, conn):
+        conn.execute(text("DELETE FROM product_search"))
+
+    def search(self, conn, terms, filters, limit, offset):
+        match = ' AND '.join(f'"{t}"*' if is_prefix(terms, i) else f'"{t}"' for i, t in enumerate(terms))
+        where, params = _filter_sql(filters)
+        params.update(match=match, limit=limit, offset=offset)
+        weights = ', '.join(str(FIELD_WEIGHTS[f]) for f in ('name', 'body', 'category', 'farmer'))
+        joins = ("JOIN product ON product.id = product_search.rowid "
+                 "JOIN \"user\" ON \"user\".id = product.user_id ") if where else ''
+        base = f"FROM product_search {joins}WHERE product_search MATCH :match {where}"
+        total = conn.execute(text(f"SELECT count(*) {base}"), params).scalar()
+        rows = conn.execute(text(
+            f"SELECT product_search.rowid, bm25(product_search, {weights}) AS rank {base} "
+            "ORDER BY rank, product_search.rowid LIMIT :limit OFFSET :offset"), params).all()
+        return [(r[0], -r[1]) for r in rows], total
+
+
+class PostgresBackend:
+    """Tabella product_search con tsvector pesato (configurazione 'simple') e indice GIN"""
+
+    name = 'tsvector'
+
+    def exists(self, conn):
+        return conn.execute(text("SELECT to_regclass('product_search')")).scalar() is not None
+
+    def create(self, conn):
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS product_search ("
+            "product_id INTEGER PRIMARY KEY REFERENCES product(id) ON DELETE CASCADE, "
+            "document TSVECTOR NOT NULL)"
+        ))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_product_search_document "
+                          "ON product_search USING GIN (document)"))
+
+    def upsert(self, conn, docs):
+        if not docs:
+            return
+        conn.execute(text(
+            "INSERT INTO product_search (product_id, document) VALUES (:id, "
+            "setweight(to_tsvector('simple', :name), 'A') || setweight(to_tsvector('simple', :farmer), 'B') || "
+            "setweight(to_tsvector('simple', :category), 'C') || setweight(to_tsvector('simple', :body), 'D')) "
+            "ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document"
+        ), [dict(doc, id=pid) for pid, doc in docs])
+
+    def insert(self, conn, docs):
+        self.upsert(conn, docs)
+
+    def delete(self, conn, ids):
+        if ids:
+            conn.execute(text("DELETE FROM product_search WHERE product_id = ANY(:ids)"), {'ids': list(ids)})
+
+    def clear(self, conn):
+        conn.execute(text("TRUNCATE product_search"))
+
+    def search(self, conn, terms, filters, limit, offset):
+        where, params = _filter_sql(filters)
+        tsq = ' & '.join(f'{t}:*' if is_prefix(terms, i) else t for i, t in enumerate(terms))
+        params.update(tsq=tsq, limit=limit, offset=offset)
+        joins = ("JOIN product ON product.id = product_search.product_id "
+                 "JOIN \"user\" ON \"user\".id = product.user_id") if where else ''
+        base = (f"FROM product_search {joins}, to_tsquery('simple', :tsq) AS query "
+                f"WHERE product_search.document @@ query {where}")
+        total = conn.execute(text(f"SELECT count(*) {base}"), params).scalar()
+        rows = conn.execute(text(
+            f"SELECT product_search.product_id, ts_rank_cd('{{0.1, 0.3, 0.4, 1.0}}', product_search.document, query) AS rank "
+            f"{base} ORDER BY rank DESC, product_search.product_id LIMIT :limit OFFSET :offset"), params).all()
+        return [(r[0], float(r[1])) for r in rows], total
+
+
+def _filter_sql(filters):
+    """Condizioni SQL sui filtri della lista; senza filtri la ricerca non fa join"""
+    clauses, params = [], {}
+    for key, column in (('province', '"user".province'), ('city', '"user".city'), ('category', 'product.category')):
+        if filters.get(key):
+            clauses.append(f'AND {column} = :{key}')
+            params[key] = filters[key]
+    return ' '.join(clauses), params
+
+
+class MemoryBackend:
+    """Indice invertito in memoria, usato quando il database non ha FTS.
+
+    Costruito al primo utilizzo e aggiornato dopo ogni commit con i
+    documenti registrati durante il flush (come l'indice dei filtri).
+    """
+
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._built = False
+        self.postings = {}   # termine -> {product_id: peso}
+        self.docs = {}       # product_id -> (termini, categoria, farmer_id)
+        self._vocab = None   # termini ordinati, per le ricerche per prefisso
+
+    def invalidate(self):
+        with self._lock:
+            self._built = False
+
+    def exists(self, conn):
+        return True
+
+    def create(self, conn):
+        pass
+
+    def _add(self, pid, doc, category, farmer_id):
+        weights = {}
+        for field, weight in FIELD_WEIGHTS.items():
+            for term in doc[field].split():
+                weights[term] = weights.get(term, 0.0) + weight
+        for term, w in weights.items():
+            self.postings.setdefault(term, {})[pid] = w
+        self.docs[pid] = (tuple(weights), category, farmer_id)
+        self._vocab = None
+
+    def _remove(self, pid):
+        terms, _, _ = self.docs.pop(pid, ((), None, None))
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(pid, None)
+                if not posting:
+                    del self.postings[term]
+        self._vocab = None
+
+    def _build(self):
+        self.postings, self.docs, self._vocab = {}, {}, None
+        for pid, doc, category, farmer_id in _iter_documents(db.session.connection()):
+            self._add(pid, doc, category, farmer_id)
+        self._built = True
+
+    def ensure(self):
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    self._build()
+        return self
+
+    def apply(self, ops):
+        with self._lock:
+            if not self._built:
+                return
+            for op in ops:
+                if op[0] == 'upsert':
+                    _, pid, doc, category, farmer_id = op
+                    self._remove(pid)
+                    self._add(pid, doc, category, farmer_id)
+                else:
+                    self._remove(op[1])
+
+    # Le scritture vengono registrate nella sessione e applicate dopo il commit
+    def upsert(self, conn, docs, session=None, extra=None):
+        for pid, doc in docs:
+            category, farmer_id = extra[pid]
+            _record(session, ('upsert', pid, doc, category, farmer_id))
+
+    def delete(self, conn, ids, session=None):
+        for pid in ids:
+            _record(session, ('delete', pid))
+
+    def clear(self, conn):
+        self.invalidate()
+
+    def _expand(self, term, prefix):
+        if not prefix:
+            if term in self.postings:
+                yield term
+            return
+        if self._vocab is None:
+            self._vocab = sorted(self.postings)
+        i = bisect_left(self._vocab, term)
+        while i < len(self._vocab) and self._vocab[i].startswith(term):
+            yield self._vocab[i]
+            i += 1
+
+    def search(self, conn, terms, filters, limit, offset):
+        facet_index.ensure()
+        with self._lock:
+            self.ensure()
+            n_docs = max(len(self.docs), 1)
+            scores = None
+            for i, term in enumerate(terms):
+                term_scores = {}
+                for match in self._expand(term, is_prefix(terms, i)):
+                    posting = self.postings[match]
+                    idf = math.log(1 + n_docs / len(posting))
+                    for pid, w in posting.items():
+                        term_scores[pid] = max(term_scores.get(pid, 0.0), w * idf)
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {pid: s + term_scores[pid] for pid, s in scores.items() if pid in term_scores}
+                if not scores:
+                    return [], 0
+            hits = [(pid, s) for pid, s in scores.items() if self._matches(pid, filters)]
+        hits.sort(key=lambda h: (-h[1], h[0]))
+        return hits[offset:offset + limit], len(hits)
+
+    def _matches(self, pid, filters):
+        _, category, farmer_id = self.docs[pid]
+        location = facet_index.farmers.get(farmer_id)
+        if location is None:
+            return False
+        if filters.get('category') and category != filters['category']:
+            return False
+        if filters.get('province') and location[0] != filters['province']:
+            return False
+        return not filters.get('city') or location[1] == filters['city']
+
+
+memory_backend = MemoryBackend()
+
+# Indice mancante: ricontrollato dalle letture al massimo ogni tanti secondi
+INDEX_RECHECK = 60
+
+# Backend con indice pronto per database (url dell'engine); momento dell'ultimo controllo negativo
+_backends = {}
+_missing = {}
+_chosen = {}
+_backends_lock = threading.Lock()
+
+
+def _sqlite_has_fts5(conn):
+    try:
+        conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS temp.fts5_probe USING fts5(x)"))
+        conn.execute(text("DROP TABLE temp.fts5_probe"))
+    except Exception:
+        return False
+    return True
+
+
+def _backend_class(conn):
+    """Backend adatto al database (con o senza indice); la prova di FTS5 si fa una volta sola"""
+    key = str(conn.engine.url)
+    backend = _chosen.get(key)
+    if backend is None:
+        dialect = conn.dialect.name
+        if dialect == 'postgresql':
+            backend = PostgresBackend()
+        elif dialect == 'sqlite' and _sqlite_has_fts5(conn):
+            backend = SqliteBackend()
+        else:
+            backend = memory_backend
+        _chosen[key] = backend
+    return backend
+
+
+def backend_for(conn, recheck=False):
+    """Backend del database della connessione, oppure None se il suo indice non è ancora stato creato.
+
+    L'indice si crea e si riempie solo con run_search_reindex.py (o la migrazione):
+    mai dentro una richiesta. Finché manca le scritture non lo aggiornano e la
+    ricerca usa LIKE. recheck=True (hook sulle scritture) ignora il controllo
+    negativo in cache, così un indice appena creato non perde aggiornamenti.
+    """
+    key = str(conn.engine.url)
+    backend = _backends.get(key)
+    if backend is not None:
+        return backend
+    checked = _missing.get(key)
+    if not recheck and checked is not None and time.monotonic() - checked < INDEX_RECHECK:
+        return None
+    with _backends_lock:
+        backend = _backends.get(key)
+        if backend is None:
+            backend = _backend_class(conn)
+            if not backend.exists(conn):
+                _missing[key] = time.monotonic()
+                return None
+            _backends[key] = backend
+            _missing.pop(key, None)
+    return backend
+
+
+def reset():
+    """Dimentica i backend già verificati e svuota l'indice in memoria (test, reindex)"""
+    with _backends_lock:
+        _backends.clear()
+        _missing.clear()
+        _chosen.clear()
+    memory_backend.invalidate()
+
+
+# --- documenti dal database -----------------------------------------------------
+
+def _document_query():
+    return select(Product.id, Product.name, Product.description, Product.category, Product.user_id,
+                  User.company_name, User.username) \
+        .join(User, Product.user_id == User.id)
+
+
+def _iter_documents(conn, where=None, chunk_size=1000):
+    """(product_id, documento, categoria, farmer_id) letti a blocchi ordinati per id"""
+    last_id = 0
+    while True:
+        query = _document_query().where(Product.id > last_id)
+        if where is not None:
+            query = query.where(where)
+        rows = conn.execute(query.order_by(Product.id).limit(chunk_size)).all()
+        if not rows:
+            return
+        for r in rows:
+            yield r.id, product_document(r.name, r.description, r.category, r.company_name or r.username), \
+                r.category, r.user_id
+        last_id = rows[-1].id
+
+
+def _index_all(conn, backend, chunk_size=1000):
+    """Ricostruisce l'indice del backend leggendo tutti i prodotti; ritorna quanti ne ha indicizzati"""
+    if backend is memory_backend:
+        backend.invalidate()
+        return 0
+    backend.clear(conn)
+    batch, count = [], 0
+    for pid, doc, _, _ in _iter_documents(conn, chunk_size=chunk_size):
+        batch.append((pid, doc))
+        if len(batch) >= chunk_size:
+            backend.insert(conn, batch)
+            count += len(batch)
+            batch = []
+    backend.insert(conn, batch)
+    return count + len(batch)
+
+
+def reindex():
+    """Crea (se manca) e ricostruisce l'indice di ricerca (script di manutenzione)"""
+    conn = db.session.connection()
+    backend = _backend_class(conn)
+    backend.create(conn)
+    count = _index_all(conn, backend)
+    db.session.commit()
+    reset()
+    return backend.name, count
+
+
+def _write(conn, session, where):
+    """Reindicizza i prodotti che soddisfano `where` sulla connessione del flush"""
+    backend = backend_for(conn, recheck=True)
+    if backend is None:
+        return
+    rows = list(_iter_documents(conn, where))
+    docs = [(pid, doc) for pid, doc, _, _ in rows]
+    if backend is memory_backend:
+        backend.upsert(conn, docs, session, {pid: (category, fid) for pid, _, category, fid in rows})
+    else:
+        backend.upsert(conn, docs)
+
+
+# --- ricerca -----------------------------------------------------------------------
+
+def search_products(q, page=1, per_page=12, province='', city='', category=''):
+    """Prodotti che contengono tutti i termini della query (l'ultimo anche come prefisso).
+
+    Ritorna ([(product_id, score)], totale) ordinati per rilevanza.
+    """
+    terms = query_terms(q)
+    if not terms:
+        return [], 0
+    conn = db.session.connection()
+    filters = {'province': province, 'city': city, 'category': category}
+    backend = backend_for(conn)
+    if backend is None:
+        return _like_search(conn, terms, filters, per_page, (max(1, page) - 1) * per_page)
+    return backend.search(conn, terms, filters, per_page, (max(1, page) - 1) * per_page)
+
+
+def _like_search(conn, terms, filters, limit, offset):
+    """Ricerca senza indice (prima di run_search_reindex.py): ogni radice cercata con LIKE.
+
+    Legge tutta la tabella dei prodotti: va bene solo come ripiego temporaneo.
+    I risultati sono in ordine di nome, con punteggio 0.
+    """
+    query = select(Product.id).join(User, Product.user_id == User.id)
+    for term in terms:
+        pattern = f'%{term}%'
+        query = query.where(Product.name.ilike(pattern) | Product.description.ilike(pattern)
+                            | User.company_name.ilike(pattern) | User.username.ilike(pattern))
+    for key, column in (('province', User.province), ('city', User.city), ('category', Product.category)):
+        if filters.get(key):
+            query = query.where(column == filters[key])
+    total = conn.execute(select(func.count()).select_from(query.subquery())).scalar()
+    rows = conn.execute(query.order_by(Product.name, Product.id).limit(limit).offset(offset)).all()
+    return [(r[0], 0.0) for r in rows], total
+
+
+# --- hook sulle scritture ---------------------------------------------------------
+
+_PRODUCT_ATTRS = ('name', 'description', 'category', 'user_id')
+_FARMER_ATTRS = ('company_name', 'username')
+
+
+def _record(session, op):
+    if session is not None:
+        session.info.setdefault('search_ops', []).append(op)
+
+
+@event.listens_for(Product, 'after_insert')
+def _product_inserted(mapper, connection, target):
+    _write(connection, object_session(target), Product.id == target.id)
+
+
+@event.listens_for(Product, 'after_update')
+def _product_updated(mapper, connection, target):
+    state = sa_inspect(target)
+    if any(state.attrs[a].history.has_changes() for a in _PRODUCT_ATTRS):
+        _write(connection, object_session(target), Product.id == target.id)
+
+
+@event.listens_for(Product, 'after_delete')
+def _product_deleted(mapper, connection, target):
+    backend = backend_for(connection, recheck=True)
+    if backend is None:
+        return
+    if backend is memory_backend:
+        backend.delete(connection, [target.id], object_session(target))
+    else:
+        backend.delete(connection, [target.id])
+
+
+@event.listens_for(User, 'after_update')
+def _farmer_renamed(mapper, connection, target):
+    state = sa_inspect(target)
+    if any(state.attrs[a].history.has_changes() for a in _FARMER_ATTRS):
+        _write(connection, object_session(target), Product.user_id == target.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_after_commit(session):
+    ops = session.info.pop('search_ops', None)
+    if ops:
+        memory_backend.apply(ops)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_on_rollback(session, previous_transaction):
+    if session.info.pop('search_ops', None):
+        memory_backend.invalidate()
@@ -0,0 +1,53 @@
+import time
+from sqlalchemy import event, insert, update, inspect as sa_inspect
+from sqlalchemy.dialects import postgresql, sqlite
+
+# Tabella di riepilogo mancante: ricontrollata al massimo ogni tanti secondi (quando c'è, vale per sempre)
+READY_RECHECK = 60
+
+_UPSERT = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+# (url del database, tabella) -> True, oppure il momento dell'ultimo controllo negativo
+_ready = {}
+
+
+def upsert(conn, table, key, deltas, replace=None):
+    """Somma `deltas` alla riga `key` (creandola se manca); `replace` sovrascrive altri campi"""
+    replace = replace or {}
+    stmt_factory = _UPSERT.get(conn.dialect.name)
+    if stmt_factory is not None:
+        stmt = stmt_factory(table).values(**key, **deltas, **replace)
+        changes = {c: table.c[c] + stmt.excluded[c] for c in deltas}
+        changes.update({c: stmt.excluded[c] for c in replace})
+        conn.execute(stmt.on_conflict_do_update(index_elements=list(key), set_=changes))
+        return
+    where = [table.c[k] == v for k, v in key.items()]
+    changes = {c: table.c[c] + d for c, d in deltas.items()}
+    if not conn.execute(update(table).where(*where).values(**changes, **replace)).rowcount:
+        conn.execute(insert(table).values(**key, **deltas, **replace))
+
+
+def table_ready(bind, table):
+    """True se la tabella di riepilogo esiste (ed è quindi già riempita, vedi backfill_on_create)"""
+    key = (str(bind.engine.url), table.name)
+    checked = _ready.get(key)
+    if checked is True:
+        return True
+    if checked is None or time.monotonic() - checked > READY_RECHECK:
+        exists = sa_inspect(bind.engine).has_table(table.name)
+        _ready[key] = True if exists else time.monotonic()
+        return exists
+    return False
+
+
+def backfill_on_create(table, source, fill):
+    """Riempie `table` con fill(connection) appena viene creata (create_all), dai dati già in `source`.
+
+    Senza questo db.create_all() su un database esistente creerebbe un
+    riepilogo vuoto e le pagine mostrerebbero zero fino al ricalcolo manuale.
+    """
+    @event.listens_for(table, 'after_create')
+    def _backfill(target, connection, **kw):
+        if sa_inspect(connection).has_table(source.name):
+            fill(connection)
+        _ready[(str(connection.engine.url), table.name)] = True
@@ -0,0 +1,17 @@
+"""Configurazione gunicorn, letta automaticamente all'avvio (gunicorn main:app)"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+# Worker gevent: gli stream /events fermi non occupano un thread ciascuno
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('WEB_CONNECTIONS', 1000))
+timeout = 300
+graceful_timeout = 30
+loglevel = 'info'
+
+
+def post_fork(server, worker):
+    # psycopg2 cede il controllo agli altri greenlet mentre attende il database
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
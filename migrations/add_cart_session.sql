@@ -0,0 +1,11 @@
+-- Carrelli lato server: il cookie di sessione contiene solo cart_id
+-- data: JSON compatto {farmer_id: {product_id: [qty, price, min_qty, name, unit]}}
+
+CREATE TABLE IF NOT EXISTS cart_session (
+    id VARCHAR(32) PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at TIMESTAMP NOT NULL
+);
+
+-- Per eliminare i carrelli inattivi
+CREATE INDEX IF NOT EXISTS ix_cart_session_updated_at ON cart_session(updated_at);
@@ -0,0 +1,41 @@
+-- Riepilogo delle conversazioni per l'inbox (una riga per coppia di utenti, low_id < high_id)
+-- La tabella è riempita qui dai messaggi esistenti: l'app la usa appena la trova.
+-- python run_conversation_rebuild.py serve solo a ricalcolarla in seguito.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS conversation (
+    low_id INTEGER NOT NULL REFERENCES "user"(id),
+    high_id INTEGER NOT NULL REFERENCES "user"(id),
+    last_message_id INTEGER,
+    last_message_at TIMESTAMP,
+    last_sender_id INTEGER,
+    last_preview VARCHAR(100),
+    unread_low INTEGER NOT NULL DEFAULT 0,
+    unread_high INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (low_id, high_id)
+);
+
+CREATE INDEX IF NOT EXISTS ix_conversation_low_last ON conversation (low_id, last_message_at);
+CREATE INDEX IF NOT EXISTS ix_conversation_high_last ON conversation (high_id, last_message_at);
+
+INSERT INTO conversation (low_id, high_id, last_message_id, last_message_at, last_sender_id, last_preview,
+                          unread_low, unread_high)
+SELECT low_id, high_id, id, timestamp, sender_id, preview, unread_low, unread_high
+FROM (
+    SELECT LEAST(sender_id, recipient_id) AS low_id, GREATEST(sender_id, recipient_id) AS high_id,
+           id, timestamp, sender_id, substr(content, 1, 100) AS preview,
+           ROW_NUMBER() OVER w_last AS rn,
+           SUM(CASE WHEN recipient_id = LEAST(sender_id, recipient_id) AND NOT COALESCE(read, FALSE) THEN 1 ELSE 0 END)
+               OVER w_pair AS unread_low,
+           SUM(CASE WHEN recipient_id = GREATEST(sender_id, recipient_id) AND NOT COALESCE(read, FALSE) THEN 1 ELSE 0 END)
+               OVER w_pair AS unread_high
+    FROM message
+    WHERE sender_id <> recipient_id
+    WINDOW w_pair AS (PARTITION BY LEAST(sender_id, recipient_id), GREATEST(sender_id, recipient_id)),
+           w_last AS (w_pair ORDER BY timestamp DESC, id DESC)
+) ranked
+WHERE rn = 1
+ON CONFLICT (low_id, high_id) DO NOTHING;
+
+COMMIT;
@@ -0,0 +1,38 @@
+-- Indici per le query più frequenti: catalogo, pagine aziendali, ordini, messaggi, recensioni, link delle email
+-- CONCURRENTLY non blocca le scritture ma non può stare in una transazione:
+-- eseguire con psql -f (ogni statement in autocommit), non dentro BEGIN/COMMIT.
+-- Se un indice resta INVALID dopo un errore: DROP INDEX CONCURRENTLY e rieseguire il file.
+
+-- Elenco aziende, filtri per provincia/comune, pagina /c/<slug>
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_user_farmer_location ON "user" (is_farmer, province, city);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_user_company_slug ON "user" (company_slug);
+-- Verifica email e reset password: token quasi sempre NULL, indicizzate solo le righe che ne hanno uno
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_user_verification_token ON "user" (verification_token)
+    WHERE verification_token IS NOT NULL;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_user_reset_token ON "user" (reset_token)
+    WHERE reset_token IS NOT NULL;
+
+-- Prodotti di un'azienda, filtro per categoria, catalogo ordinato per nome
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_product_user_id ON product (user_id, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_product_category ON product (category, name, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_product_name ON product (name, id);
+
+-- Ordini ricevuti (tutti o per stato, export, azioni in blocco) e ordini inviati dal cliente
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_order_request_farmer_status ON order_request (farmer_id, status, created_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_order_request_farmer_created ON order_request (farmer_id, created_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_order_request_client_created ON order_request (client_id, created_at);
+
+-- Cronologia delle conversazioni e messaggi non letti
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_message_thread ON message (sender_id, recipient_id, timestamp);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_message_recipient_read ON message (recipient_id, read);
+
+-- Recensioni di un'azienda dalla più recente (sostituisce idx_review_farmer_id)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_review_farmer_created ON review (farmer_id, created_at);
+DROP INDEX CONCURRENTLY IF EXISTS idx_review_farmer_id;
+
+-- Statistiche aggiornate, così il planner usa subito i nuovi indici
+ANALYZE "user";
+ANALYZE product;
+ANALYZE order_request;
+ANALYZE message;
+ANALYZE review;
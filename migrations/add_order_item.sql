@@ -0,0 +1,16 @@
+-- Righe d'ordine normalizzate al posto del JSON in order_request.items_json
+-- Dopo la creazione eseguire: python run_order_items_backfill.py
+
+CREATE TABLE IF NOT EXISTS order_item (
+    id SERIAL PRIMARY KEY,
+    order_id INTEGER NOT NULL REFERENCES order_request(id),
+    product_id INTEGER REFERENCES product(id) ON DELETE SET NULL,
+    name VARCHAR(150) NOT NULL,
+    unit VARCHAR(20),
+    price DOUBLE PRECISION NOT NULL DEFAULT 0,
+    qty INTEGER NOT NULL DEFAULT 1
+);
+
+-- Join con gli ordini e aggregati per prodotto
+CREATE INDEX IF NOT EXISTS ix_order_item_order_id ON order_item(order_id);
+CREATE INDEX IF NOT EXISTS ix_order_item_product_id ON order_item(product_id);
@@ -0,0 +1,17 @@
+-- Outbox delle notifiche: le email vengono scritte nella stessa transazione
+-- dell'ordine e inviate da worker.py, fuori dalle richieste web
+
+CREATE TABLE IF NOT EXISTS outbox_message (
+    id SERIAL PRIMARY KEY,
+    kind VARCHAR(20) NOT NULL DEFAULT 'email',
+    payload TEXT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP
+);
+
+-- Il worker legge solo i messaggi in attesa e già scaduti
+CREATE INDEX IF NOT EXISTS ix_outbox_message_due ON outbox_message(status, available_at);
@@ -0,0 +1,13 @@
+-- Contatore denormalizzato degli ordini in attesa per agricoltore (badge in navbar)
+-- Mantenuto dalle scritture su order_request, riallineato da run_reconcile_pending_orders.py
+
+ALTER TABLE "user"
+ADD COLUMN IF NOT EXISTS pending_orders_count INTEGER NOT NULL DEFAULT 0;
+
+-- Valore iniziale dagli ordini esistenti
+UPDATE "user" u
+SET pending_orders_count = (
+    SELECT COUNT(*) FROM order_request o
+    WHERE o.farmer_id = u.id AND o.status = 'pending'
+)
+WHERE u.is_farmer = TRUE;
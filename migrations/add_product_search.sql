@@ -0,0 +1,10 @@
+-- Migration: indice di ricerca full-text sui prodotti (PostgreSQL)
+-- Il testo è già normalizzato dall'applicazione (minuscole, senza accenti, radici),
+-- per questo si usa la configurazione 'simple'. Popolare con run_search_reindex.py.
+
+CREATE TABLE IF NOT EXISTS product_search (
+    product_id INTEGER PRIMARY KEY REFERENCES product(id) ON DELETE CASCADE,
+    document TSVECTOR NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_product_search_document ON product_search USING GIN (document);
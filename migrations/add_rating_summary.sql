@@ -0,0 +1,31 @@
+-- Valutazioni per azienda (numero, somma e istogramma delle stelle), aggiornate a ogni recensione
+-- La tabella è riempita qui dalle recensioni esistenti: l'app la usa appena la trova.
+-- python run_rating_rebuild.py serve solo a ricalcolarla in seguito.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS rating_summary (
+    farmer_id INTEGER PRIMARY KEY REFERENCES "user"(id),
+    review_count INTEGER NOT NULL DEFAULT 0,
+    rating_sum INTEGER NOT NULL DEFAULT 0,
+    stars_1 INTEGER NOT NULL DEFAULT 0,
+    stars_2 INTEGER NOT NULL DEFAULT 0,
+    stars_3 INTEGER NOT NULL DEFAULT 0,
+    stars_4 INTEGER NOT NULL DEFAULT 0,
+    stars_5 INTEGER NOT NULL DEFAULT 0,
+    last_review_id INTEGER,
+    updated_at TIMESTAMP
+);
+
+INSERT INTO rating_summary (farmer_id, review_count, rating_sum, stars_1, stars_2, stars_3, stars_4, stars_5,
+                            last_review_id, updated_at)
+SELECT farmer_id, COUNT(*), SUM(rating),
+       SUM(CASE WHEN rating = 1 THEN 1 ELSE 0 END), SUM(CASE WHEN rating = 2 THEN 1 ELSE 0 END),
+       SUM(CASE WHEN rating = 3 THEN 1 ELSE 0 END), SUM(CASE WHEN rating = 4 THEN 1 ELSE 0 END),
+       SUM(CASE WHEN rating = 5 THEN 1 ELSE 0 END), MAX(id), CURRENT_TIMESTAMP
+FROM review
+WHERE rating BETWEEN 1 AND 5
+GROUP BY farmer_id
+ON CONFLICT (farmer_id) DO NOTHING;
+
+COMMIT;
@@ -0,0 +1,22 @@
+-- Riepiloghi giornalieri delle vendite per la dashboard degli agricoltori
+-- Dopo la creazione eseguire: python run_sales_rollup_rebuild.py
+
+CREATE TABLE IF NOT EXISTS sales_daily (
+    farmer_id INTEGER NOT NULL REFERENCES "user"(id),
+    day DATE NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    orders INTEGER NOT NULL DEFAULT 0,
+    revenue DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (farmer_id, day, status)
+);
+
+-- product_id 0 = prodotto eliminato
+CREATE TABLE IF NOT EXISTS product_sales_daily (
+    farmer_id INTEGER NOT NULL REFERENCES "user"(id),
+    day DATE NOT NULL,
+    product_id INTEGER NOT NULL,
+    name VARCHAR(150),
+    qty INTEGER NOT NULL DEFAULT 0,
+    revenue DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (farmer_id, day, product_id)
+);
@@ -0,0 +1,12 @@
+-- Eventi dello stream /events tra processi, usati solo con EVENTS_TRANSPORT=poll
+-- (su PostgreSQL gli eventi passano da LISTEN/NOTIFY e la tabella resta vuota)
+
+CREATE TABLE IF NOT EXISTS server_event (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    kind VARCHAR(20) NOT NULL,
+    data TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS ix_server_event_created_at ON server_event (created_at);
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Genera app/data/comuni.tsv (gazetteer dei comuni italiani).
+
+Fonti:
+  - elenco dei comuni attivi con sigla di provincia: municipalities.json del
+    pacchetto python-codicefiscale (dati ISTAT / Agenzia delle Entrate)
+  - coordinate del centro abitato: cities500.json del pacchetto geonamescache
+    (GeoNames, CC-BY 4.0), abbinate per nome e regione
+
+Uso: python run_build_comuni.py <municipalities.json> <cities500.json>
+I comuni senza corrispondenza in GeoNames restano senza coordinate.
+"""
+import json
+import sys
+import unicodedata
+
+# Sigla -> (provincia, codice regione GeoNames)
+PROVINCES = {
+    'AQ': ("L'Aquila", '01'), 'CH': ('Chieti', '01'), 'PE': ('Pescara', '01'), 'TE': ('Teramo', '01'),
+    'MT': ('Matera', '02'), 'PZ': ('Potenza', '02'),
+    'CS': ('Cosenza', '03'), 'CZ': ('Catanzaro', '03'), 'KR': ('Crotone', '03'), 'RC': ('Reggio Calabria', '03'),
+    'VV': ('Vibo Valentia', '03'),
+    'AV': ('Avellino', '04'), 'BN': ('Benevento', '04'), 'CE': ('Caserta', '04'), 'NA': ('Napoli', '04'),
+    'SA': ('Salerno', '04'),
+    'BO': ('Bologna', '05'), 'FC': ('Forlì-Cesena', '05'), 'FE': ('Ferrara', '05'), 'MO': ('Modena', '05'),
+    'PC': ('Piacenza', '05'), 'PR': ('Parma', '05'), 'RA': ('Ravenna', '05'), 'RE': ('Reggio Emilia', '05'),
+    'RN': ('Rimini', '05'),
+    'GO': ('Gorizia', '06'), 'PN': ('Pordenone', '06'), 'TS': ('Trieste', '06'), 'UD': ('Udine', '06'),
+    'FR': ('Frosinone', '07'), 'LT': ('Latina', '07'), 'RI': ('Rieti', '07'), 'RM': ('Roma', '07'),
+    'VT': ('Viterbo', '07'),
+    'GE': ('Genova', '08'), 'IM': ('Imperia', '08'), 'SP': ('La Spezia', '08'), 'SV': ('Savona', '08'),
+    'BG': ('Bergamo', '09'), 'BS': ('Brescia', '09'), 'CO': ('Como', '09'), 'CR': ('Cremona', '09'),
+    'LC': ('Lecco', '09'), 'LO': ('Lodi', '09'), 'MB': ('Monza e della Brianza', '09'), 'MI': ('Milano', '09'),
+    'MN': ('Mantova', '09'), 'PV': ('Pavia', '09'), 'SO': ('Sondrio', '09'), 'VA': ('Varese', '09'),
+    'AN': ('Ancona', '10'), 'AP': ('Ascoli Piceno', '10'), 'FM': ('Fermo', '10'), 'MC': ('Macerata', '10'),
+    'PU': ('Pesaro e Urbino', '10'),
+    'CB': ('Campobasso', '11'), 'IS': ('Isernia', '11'),
+    'AL': ('Alessandria', '12'), 'AT': ('Asti', '12'), 'BI': ('Biella', '12'), 'CN': ('Cuneo', '12'),
+    'NO': ('Novara', '12'), 'TO': ('Torino', '12'), 'VB': ('Verbano-Cusio-Ossola', '12'), 'VC': ('Vercelli', '12'),
+    'BA': ('Bari', '13'), 'BR': ('Brindisi', '13'), 'BT': ('Barletta-Andria-Trani', '13'), 'FG': ('Foggia', '13'),
+    'LE': ('Lecce', '13'), 'TA': ('Taranto', '13'),
+    'CA': ('Cagliari', '14'), 'NU': ('Nuoro', '14'), 'OR': ('Oristano', '14'), 'SS': ('Sassari', '14'),
+    'SU': ('Sud Sardegna', '14'),
+    'AG': ('Agrigento', '15'), 'CL': ('Caltanissetta', '15'), 'CT': ('Catania', '15'), 'EN': ('Enna', '15'),
+    'ME': ('Messina', '15'), 'PA': ('Palermo', '15'), 'RG': ('Ragusa', '15'), 'SR': ('Siracusa', '15'),
+    'TP': ('Trapani', '15'),
+    'AR': ('Arezzo', '16'), 'FI': ('Firenze', '16'), 'GR': ('Grosseto', '16'), 'LI': ('Livorno', '16'),
+    'LU': ('Lucca', '16'), 'MS': ('Massa-Carrara', '16'), 'PI': ('Pisa', '16'), 'PO': ('Prato', '16'),
+    'PT': ('Pistoia', '16'), 'SI': ('Siena', '16'),
+    'BZ': ('Bolzano', '17'), 'TN': ('Trento', '17'),
+    'PG': ('Perugia', '18'), 'TR': ('Terni', '18'),
+    'AO': ('Aosta', '19'),
+    'BL': ('Belluno', '20'), 'PD': ('Padova', '20'), 'RO': ('Rovigo', '20'), 'TV': ('Treviso', '20'),
+    'VE': ('Venezia', '20'), 'VI': ('Vicenza', '20'), 'VR': ('Verona', '20'),
+}
+
+REGIONS = {
+    '01': 'Abruzzo', '02': 'Basilicata', '03': 'Calabria', '04': 'Campania', '05': 'Emilia-Romagna',
+    '06': 'Friuli-Venezia Giulia', '07': 'Lazio', '08': 'Liguria', '09': 'Lombardia', '10': 'Marche',
+    '11': 'Molise', '12': 'Piemonte', '13': 'Puglia', '14': 'Sardegna', '15': 'Sicilia', '16': 'Toscana',
+    '17': 'Trentino-Alto Adige', '18': 'Umbria', '19': "Valle d'Aosta", '20': 'Veneto',
+}
+
+
+def _key(name):
+    decomposed = unicodedata.normalize('NFKD', name.lower())
+    folded = ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return ''.join(ch for ch in folded if ch.isalnum())
+
+
+# Particelle in minuscolo dentro il nome ("Baia E Latina" -> "Baia e Latina")
+PARTICLES = {'di', 'de', 'del', 'della', 'delle', 'dei', 'degli', 'dello', 'e', 'ed', 'in', 'sul', 'sulla',
+             'al', 'alla', 'ai', 'a', 'da', 'dal', 'nel', 'nella', 'nelle', 'con', 'sopra', 'sotto'}
+APOSTROPHE_PARTICLES = ("d'", "dell'", "sull'", "all'", "nell'", "dall'")
+
+
+def _display_name(name):
+    words = name.split(' ')
+    for i, word in enumerate(words[1:], 1):
+        lower = word.lower()
+        if lower in PARTICLES:
+            words[i] = lower
+        for prefix in APOSTROPHE_PARTICLES:
+            if lower.startswith(prefix):
+                words[i] = prefix + word[len(prefix):]
+    return ' '.join(words)
+
+
+def main(municipalities_path, cities_path, out_path='app/data/comuni.tsv'):
+    municipalities = [m for m in json.load(open(municipalities_path, encoding='utf-8')) if m['active']]
+    places = [c for c in json.load(open(cities_path, encoding='utf-8')).values() if c['countrycode'] == 'IT']
+
+    # (regione, nome normalizzato) -> luogo più popoloso con quel nome
+    by_name = {}
+    for place in places:
+        for name in {place['name'], *place.get('alternatenames', [])}:
+            key = (place['admin1code'], _key(name))
+            best = by_name.get(key)
+            if best is None or place['population'] > best['population']:
+                by_name[key] = place
+
+    rows, missing = [], 0
+    for m in municipalities:
+        province, region_code = PROVINCES[m['province']]
+        place = None
+        for name in (m['name'], *m['name'].split('/'), m.get('name_alt') or ''):
+            if name:
+                place = by_name.get((region_code, _key(name)))
+                if place:
+                    break
+        if place is None:
+            missing += 1
+        lat = f"{place['latitude']:.4f}" if place else ''
+        lng = f"{place['longitude']:.4f}" if place else ''
+        # Grafia GeoNames (maiuscole corrette) quando il nome coincide
+        name = place['name'] if place and _key(place['name']) == _key(m['name']) else _display_name(m['name'])
+        rows.append((REGIONS[region_code], province, m['province'], name, m['code'], lat, lng))
+
+    rows.sort(key=lambda r: (r[0], r[1], _key(r[3])))
+    with open(out_path, 'w', encoding='utf-8', newline='\n') as out:
+        out.write('# Comuni italiani attivi: regione, provincia, sigla, comune, codice catastale, lat, lng\n')
+        out.write('# Fonti: ISTAT/Agenzia delle Entrate (via python-codicefiscale), coordinate GeoNames (CC-BY 4.0)\n')
+        for row in rows:
+            out.write('\t'.join(row) + '\n')
+    print(f"✓ {len(rows)} comuni scritti in {out_path} ({missing} senza coordinate)")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    main(sys.argv[1], sys.argv[2])
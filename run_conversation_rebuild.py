@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+"""Ricalcola la tabella di riepilogo delle conversazioni (conversation) dai messaggi.
+
+Uso: python run_conversation_rebuild.py
+Il riepilogo è riempito quando la tabella viene creata (migrazione o
+db.create_all()) e aggiornato a ogni messaggio inviato e letto: questo
+comando serve per correggere modifiche fatte a mano.
+"""
+import argparse
+from app import create_app
+from app.conversations import rebuild
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.parse_args()
+
+app = create_app()
+
+with app.app_context():
+    print("💬 Ricalcolo riepilogo conversazioni...")
+    total = rebuild()
+    print(f"✅ {total} conversazioni aggiornate")
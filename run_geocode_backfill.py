@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""Assegna latitude/longitude agli agricoltori che non le hanno, dal gazetteer dei comuni (offline).
+
+Uso: python run_geocode_backfill.py [--chunk-size 500] [--start-id 0] [--dry-run] [--clear-province-centroids]
+Lo script è riprendibile: ogni blocco viene confermato subito e al riavvio
+si ripartono solo gli agricoltori ancora senza coordinate.
+Con --clear-province-centroids toglie prima le coordinate salvate come centro
+della provincia (comune non riconosciuto), che oggi non vengono più assegnate.
+"""
+import argparse
+from app import create_app
+from app.geocoding import backfill, clear_province_centroids
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--chunk-size', type=int, default=500)
+parser.add_argument('--start-id', type=int, default=0)
+parser.add_argument('--dry-run', action='store_true')
+parser.add_argument('--clear-province-centroids', action='store_true')
+args = parser.parse_args()
+
+app = create_app()
+
+with app.app_context():
+    prefix = "(dry run) " if args.dry_run else ""
+    if args.clear_province_centroids:
+        cleared = clear_province_centroids(args.dry_run)
+        print(f"🧹 {prefix}{cleared} agricoltori con il solo centro della provincia")
+    print("📍 Geocodifica agricoltori senza coordinate...")
+    updated, unresolved = backfill(args.chunk_size, args.start_id, args.dry_run)
+    print(f"✅ {prefix}{updated} agricoltori aggiornati, {unresolved} senza località riconoscibile")
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""Allinea provincia/comune degli utenti al gazetteer (comuni passati ad altra provincia).
+
+Uso: python run_location_remap.py [--chunk-size 500] [--dry-run]
+Da eseguire dopo ogni aggiornamento di app/data/comuni.tsv: senza, i profili
+con la vecchia provincia non passano la validazione del form di modifica.
+Si può rilanciare: gli utenti già allineati non vengono modificati.
+"""
+import argparse
+from app import create_app
+from app.geocoding import remap_locations
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--chunk-size', type=int, default=500)
+parser.add_argument('--dry-run', action='store_true')
+args = parser.parse_args()
+
+app = create_app()
+
+with app.app_context():
+    print("🗺️  Allineamento province e comuni degli utenti...")
+    updated = remap_locations(args.chunk_size, args.dry_run)
+    prefix = "(dry run) " if args.dry_run else ""
+    print(f"✅ {prefix}{updated} utenti aggiornati")
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+"""Crea le righe order_item degli ordini esistenti a partire da order_request.items_json.
+
+Uso: python run_order_items_backfill.py [--chunk-size 500] [--start-id 0]
+Lo script è riprendibile: ogni blocco viene confermato subito e al riavvio
+si ripartono solo gli ordini ancora senza righe. Gli items_json illeggibili
+non vengono modificati: sono stampati con l'id dell'ordine, da correggere a mano.
+"""
+import argparse
+from app import create_app
+from app.orders import backfill_order_items
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--chunk-size', type=int, default=500)
+parser.add_argument('--start-id', type=int, default=0)
+args = parser.parse_args()
+
+app = create_app()
+
+with app.app_context():
+    print("🧾 Conversione items_json in righe d'ordine...")
+    converted, created, unreadable = backfill_order_items(args.chunk_size, args.start_id)
+    print(f"✅ {converted} ordini convertiti, {created} righe create, {unreadable} JSON illeggibili (invariati, vedi sopra)")
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+"""Ricalcola il riepilogo delle valutazioni per azienda (rating_summary) dalle recensioni.
+
+Uso: python run_rating_rebuild.py
+Il riepilogo è riempito quando la tabella viene creata (migrazione o
+db.create_all()) e aggiornato a ogni recensione inserita, modificata o
+eliminata dall'app: questo comando serve dopo modifiche fatte in SQL.
+"""
+import argparse
+from app import create_app
+from app.ratings import rebuild
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.parse_args()
+
+app = create_app()
+
+with app.app_context():
+    print("⭐ Ricalcolo valutazioni delle aziende...")
+    total = rebuild()
+    print(f"✅ {total} aziende aggiornate")
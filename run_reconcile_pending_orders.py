@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+"""Riallinea user.pending_orders_count al numero reale di ordini in attesa.
+
+Uso: python run_reconcile_pending_orders.py
+Da schedulare periodicamente (es. Heroku Scheduler ogni ora): corregge
+eventuali derive dovute a modifiche fatte fuori dall'applicazione.
+"""
+from app import create_app
+from app.orders import reconcile_pending_counts
+
+app = create_app()
+
+with app.app_context():
+    print("🔄 Riallineamento contatori ordini in attesa...")
+    fixed = reconcile_pending_counts()
+    print(f"✅ {fixed} agricoltori corretti")
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+"""Ricalcola le tabelle di riepilogo vendite (sales_daily, product_sales_daily) dagli ordini.
+
+Uso: python run_sales_rollup_rebuild.py [--farmer-id ID]
+I riepiloghi sono aggiornati a ogni cambio di stato degli ordini: questo
+comando serve dopo la migrazione o per correggere modifiche fatte a mano.
+"""
+import argparse
+from app import create_app
+from app.rollups import rebuild
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--farmer-id', type=int, help='solo questo agricoltore')
+args = parser.parse_args()
+
+app = create_app()
+
+with app.app_context():
+    print("📊 Ricalcolo riepiloghi vendite...")
+    rebuild(args.farmer_id)
+    print("✅ Riepiloghi aggiornati")
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+"""Crea e ricostruisce l'indice di ricerca dei prodotti (FTS5 su SQLite, tsvector su PostgreSQL).
+
+Da eseguire dopo il deploy (e dopo migrations/add_product_search.sql su PostgreSQL):
+finché l'indice non esiste la ricerca usa LIKE e le scritture non lo aggiornano.
+"""
+import time
+from app import create_app
+from app.search import reindex
+
+app = create_app()
+
+with app.app_context():
+    start = time.perf_counter()
+    backend, count = reindex()
+    print(f"✓ Indice '{backend}' ricostruito: {count} prodotti in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,76 @@
+"""
+Fixture condivise: app Flask su un database SQLite temporaneo e isolato
+"""
+
+import pytest
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import create_app, db
+from sqlalchemy import event
+
+
+def _reset_memory_indexes():
+    """Gli indici in memoria sono globali al processo: vanno svuotati tra un database e l'altro"""
+    from app.geo import farmer_index
+    from app.facets import facet_index
+    from app.claims import claim_index
+    from app.principal import _principal_cache
+    from app import search
+    farmer_index.invalidate()
+    claim_index.invalidate()
+    _principal_cache.clear()
+    facet_index.invalidate()
+    search.reset()
+
+
+@pytest.fixture
+def db_app(tmp_path, monkeypatch):
+    """App Flask con database SQLite vuoto creato per il singolo test"""
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.delenv('DB_INIT_ON_START', raising=False)
+    app = create_app()
+    app.config['TESTING'] = True
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        db.create_all()
+        _reset_memory_indexes()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def db_client(db_app):
+    """Test client legato al database temporaneo"""
+    return db_app.test_client()
+
+
+class QueryCounter:
+    """Conta gli statement SQL eseguiti sull'engine"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+@pytest.fixture
+def count_queries(db_app):
+    """Context manager che conta le query eseguite nel blocco"""
+    return lambda: QueryCounter(db.engine)
@@ -0,0 +1,78 @@
+"""
+Test del carrello lato server (nel cookie resta solo cart_id)
+"""
+
+import time
+from datetime import datetime, timedelta
+from app import db
+from app.models import User, Product, CartSession
+from app.cart_store import pack, unpack, MemoryCartStore, SqlCartStore
+
+
+def _shop():
+    farmer = User(username='agricoltore', email='a@example.com', is_farmer=True, company_name='Orto Bello')
+    farmer.set_password('pw')
+    db.session.add(farmer)
+    db.session.commit()
+    product = Product(name='Pomodori cuore di bue', price=3.5, unit='kg', user_id=farmer.id,
+                      minimum_order_quantity=2)
+    db.session.add(product)
+    db.session.commit()
+    return farmer, product
+
+
+class TestCartStore:
+
+    def test_pack_roundtrip_is_compact(self):
+        cart = {'1': {'7': {'name': 'Olio', 'unit': 'l', 'price': 9.0, 'qty': 2, 'min_qty': 1}}}
+        raw = pack(cart)
+        assert unpack(raw) == cart
+        assert '"name"' not in raw and ' ' not in raw
+
+    def test_cookie_holds_only_cart_id(self, db_client):
+        farmer, product = _shop()
+        db_client.post(f'/cart/add/{product.id}', data={'qty': '3'})
+        with db_client.session_transaction() as sess:
+            assert set(sess.keys()) - {'_flashes'} == {'cart_id'}
+            cart_id = sess['cart_id']
+        row = db.session.get(CartSession, cart_id)
+        assert unpack(row.data) == {str(farmer.id): {str(product.id): {
+            'qty': 3, 'price': 3.5, 'min_qty': 2, 'name': 'Pomodori cuore di bue', 'unit': 'kg'}}}
+
+        db_client.post(f'/cart/update/{product.id}', data={'action': 'increment'})
+        page = db_client.get('/c/orto-bello').get_data(as_text=True)
+        assert '14.00 €' in page  # 4 x 3.50, letto dal carrello nello store
+
+        db_client.post(f'/cart/clear/{farmer.id}')
+        with db_client.session_transaction() as sess:
+            assert 'cart_id' not in sess
+        db.session.expire_all()
+        assert CartSession.query.count() == 0
+
+    def test_legacy_cookie_cart_is_migrated(self, db_client):
+        farmer, product = _shop()
+        with db_client.session_transaction() as sess:
+            sess['cart'] = {str(farmer.id): {str(product.id): {
+                'name': 'Pomodori', 'unit': 'kg', 'price': 3.5, 'qty': 4, 'min_qty': 2}}}
+        db_client.post(f'/cart/update/{product.id}', data={'action': 'decrement'})
+        with db_client.session_transaction() as sess:
+            assert 'cart' not in sess
+            cart_id = sess['cart_id']
+        assert unpack(db.session.get(CartSession, cart_id).data)[str(farmer.id)][str(product.id)]['qty'] == 3
+
+    def test_idle_carts_expire(self, db_app):
+        store = SqlCartStore(ttl=60)
+        store.save('fresco', '{}')
+        store.save('vecchio', '{}')
+        db.session.query(CartSession).filter_by(id='vecchio').update(
+            {'updated_at': datetime.utcnow() - timedelta(seconds=120)})
+        db.session.commit()
+        assert store.load('vecchio') is None
+        assert store.load('fresco') == '{}'
+        assert store.purge_expired() == 1
+
+        memory = MemoryCartStore(ttl=60)
+        memory.save('a', '{}')
+        memory._data['a'] = ('{}', time.time() - 120)
+        assert memory.load('a') is None
+        assert memory.purge_expired() == 1
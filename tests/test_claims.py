@@ -0,0 +1,109 @@
+"""
+Test della ricerca a trigrammi sui profili da rivendicare
+"""
+
+import random
+import time
+import pytest
+from sqlalchemy import update
+
+from app import db
+from app.models import User
+from app.claims import ClaimIndex, trigrams, claim_index
+
+
+def _seed():
+    profiles = [('agri_sole', 'Azienda Agricola Su Sole', 'Cabras', 'Oristano'),
+                ('cantina_mare', 'Cantina del Mare', 'Alghero', 'Sassari'),
+                ('caseificio_pinna', 'Caseificio Pinna', 'Thiesi', 'Sassari')]
+    for username, name, city, province in profiles:
+        u = User(username=username, email=f'{username}@example.com', is_farmer=True, is_scraped=True,
+                 is_claimed=False, company_name=name, city=city, province=province)
+        u.set_password('x')
+        db.session.add(u)
+    claimed = User(username='gia_mio', email='mio@example.com', is_farmer=True, is_scraped=True,
+                   is_claimed=True, company_name='Cantina del Monte', city='Alghero')
+    claimed.set_password('x')
+    db.session.add(claimed)
+    db.session.commit()
+
+
+class TestTrigrams:
+
+    def test_padding_and_accents(self):
+        assert trigrams('Città') == {'  c', ' ci', 'cit', 'itt', 'tta', 'ta '}
+
+    def test_typo_tolerant_ranking(self):
+        index = ClaimIndex()
+        index.load([(1, 'Caseificio Pinna Thiesi'), (2, 'Cantina del Mare Alghero'), (3, 'Cantina Pinna Dolianova')])
+        assert [uid for uid, _ in index.search('caseifcio pina')] == [1, 3]
+        assert index.search('xyz') == []
+
+
+class TestClaimSearch:
+
+    def test_page_results(self, db_client):
+        _seed()
+        html = db_client.get('/rivendica-azienda?q=cantna').get_data(as_text=True)
+        assert 'Cantina del Mare' in html
+        # I profili già rivendicati non compaiono
+        assert 'Cantina del Monte' not in html
+
+    def test_autocomplete_and_claim(self, db_client):
+        _seed()
+        data = db_client.get('/api/claim-search?q=pinna').get_json()
+        assert [d['username'] for d in data] == ['caseificio_pinna']
+        assert data[0]['url'].endswith('/rivendica/caseificio_pinna')
+        assert db_client.get('/api/claim-search?q=p').get_json() == []
+
+        u = User.query.filter_by(username='caseificio_pinna').one()
+        u.is_claimed = True
+        db.session.commit()
+        assert db_client.get('/api/claim-search?q=pinna').get_json() == []
+
+    def test_index_changes_wait_for_commit(self, db_client):
+        _seed()
+        assert len(db_client.get('/api/claim-search?q=pinna').get_json()) == 1
+        u = User.query.filter_by(username='caseificio_pinna').one()
+        u.is_claimed = True
+        db.session.flush()
+        db.session.rollback()
+        # Rivendicazione annullata: il profilo resta suggerito
+        assert len(db_client.get('/api/claim-search?q=pinna').get_json()) == 1
+
+    def test_claimed_by_another_worker_is_not_suggested(self, db_client, count_queries):
+        _seed()
+        claim_index.ensure()
+        # Scrittura di un altro processo: l'indice di questo worker non lo sa
+        db.session.execute(update(User).where(User.username == 'caseificio_pinna').values(is_claimed=True))
+        db.session.commit()
+        with count_queries() as q:
+            assert db_client.get('/api/claim-search?q=pinna').get_json() == []
+        assert len([s for s in q.statements if 'is_claimed' in s]) == 1
+
+
+@pytest.mark.slow
+class TestClaimBenchmark:
+    """Autocompletamento su 50k profili: pytest -m slow -s"""
+
+    def test_benchmark_50k(self):
+        rnd = random.Random(3)
+        syllables = ['ca', 'ro', 'mi', 'sa', 'ne', 'lu', 'ter', 'bo', 'gi', 'fra', 'ta', 'po', 'ven', 'sol', 'nu']
+        prefixes = ['Azienda Agricola', 'Cantina', 'Caseificio', 'Oleificio', 'Fattoria', 'Agriturismo']
+        rows = [(i, f"{rnd.choice(prefixes)} {''.join(rnd.choices(syllables, k=4)).capitalize()} "
+                    f"{''.join(rnd.choices(syllables, k=3)).capitalize()}") for i in range(50_000)]
+        index = ClaimIndex()
+        start = time.perf_counter()
+        index.load(rows)
+        build_time = time.perf_counter() - start
+
+        queries = ['azienda agricola', 'cantna', rows[123][1].split()[-1], rows[4567][1][:12]]
+        runs = 20
+        start = time.perf_counter()
+        for _ in range(runs):
+            for q in queries:
+                index.search(q, 8)
+        query_time = (time.perf_counter() - start) / (runs * len(queries))
+
+        print(f"\n50000 profiles: build {build_time:.2f}s | query {query_time * 1000:.2f} ms")
+        assert index.search(rows[4567][1], 1)[0][0] == 4567
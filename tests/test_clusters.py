@@ -0,0 +1,79 @@
+"""
+Test dei cluster per livello di zoom usati dalle mappe
+"""
+
+import json
+import random
+from app import db
+from app.models import User
+from app.geo import FarmerIndex
+from app.clusters import ClusterIndex, MAX_ZOOM, MIN_ZOOM
+
+
+def _index(n, seed=7):
+    rnd = random.Random(seed)
+    index = FarmerIndex()
+    lats = [rnd.uniform(38.8, 41.3) for _ in range(n)]
+    lngs = [rnd.uniform(8.1, 9.8) for _ in range(n)]
+    index.load(range(n), lats, lngs, [(f'az{i}', f'az{i}', 'x', 'y') for i in range(n)])
+    return index
+
+
+class TestClusterIndex:
+
+    def test_every_zoom_keeps_all_points(self):
+        index = _index(5000)
+        clusters = ClusterIndex(index, range(5000))
+        for zoom in range(MIN_ZOOM, MAX_ZOOM + 1):
+            assert sum(c[0] for c in clusters.query(None, zoom)) == 5000
+        # Pochi cluster a zoom regionale, quasi tutti punti singoli a zoom massimo
+        assert len(clusters.query(None, 7)) < 50
+        assert len(clusters.query(None, MAX_ZOOM)) > 4900
+
+    def test_bbox_query_matches_full_scan(self):
+        index = _index(3000)
+        clusters = ClusterIndex(index, range(3000))
+        bbox = (39.5, 40.0, 8.4, 8.9)
+        got = clusters.query(bbox, MAX_ZOOM)
+        def count_inside(min_lat, max_lat, min_lng, max_lng):
+            return sum(1 for p in range(3000)
+                       if min_lat <= index.lats[p] <= max_lat and min_lng <= index.lngs[p] <= max_lng)
+        # Tutti i punti del rettangolo, più al massimo quelli delle celle di bordo
+        total = sum(c[0] for c in got)
+        assert count_inside(*bbox) <= total <= count_inside(39.49, 40.01, 8.39, 8.91)
+
+    def test_geojson_centroids_and_counts(self):
+        index = FarmerIndex()
+        index.load([1, 2, 3], [40.0, 40.001, 41.0], [9.0, 9.001, 9.5],
+                   [('A', 'a', 'X', 'P'), ('B', 'b', 'X', 'P'), ('C', 'c', 'Y', 'P')])
+        clusters = ClusterIndex(index, range(3))
+        features = json.loads(clusters.geojson(None, 10))['features']
+        by_kind = {bool(f['properties'].get('cluster')): f for f in features}
+        assert by_kind[True]['properties']['count'] == 2
+        assert by_kind[True]['geometry']['coordinates'] == [9.0005, 40.0005]
+        assert by_kind[False]['properties']['slug'] == 'c'
+
+
+class TestClusterEndpoint:
+
+    def _seed(self):
+        for i in range(20):
+            u = User(username=f'az{i}', email=f'az{i}@example.com', is_farmer=True, company_name=f'AZ{i}',
+                     province='Oristano' if i < 15 else 'Sassari', city='c', latitude=39.9 + i * 0.001,
+                     longitude=8.5 + i * 0.001)
+            u.set_password('x')
+            db.session.add(u)
+        db.session.commit()
+
+    def test_zoom_returns_clusters(self, db_client):
+        self._seed()
+        data = db_client.get('/api/farmers.geojson?zoom=8').get_json(force=True)
+        assert len(data['features']) == 1
+        assert data['features'][0]['properties'] == {'cluster': True, 'count': 20}
+
+        data = db_client.get('/api/farmers.geojson?zoom=8&province=Sassari').get_json(force=True)
+        assert data['features'][0]['properties']['count'] == 5
+
+        # Oltre lo zoom massimo arrivano i singoli punti
+        data = db_client.get('/api/farmers.geojson?zoom=18').get_json(force=True)
+        assert len(data['features']) == 20
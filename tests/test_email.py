@@ -0,0 +1,176 @@
+"""
+Test del trasporto email: connessione SMTP riusata e invio a blocchi su SendGrid
+"""
+
+import socketserver
+import smtplib
+import threading
+import time
+import pytest
+from app import email_utils
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    """Server SMTP minimale: accetta tutto e conta connessioni e messaggi"""
+
+    def _reply(self, line):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self._reply('220 stub')
+        in_data = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if in_data:
+                if line == b'.\r\n':
+                    in_data = False
+                    server.messages += 1
+                    self._reply('250 OK')
+                    if server.drop_after and server.messages % server.drop_after == 0:
+                        return
+                continue
+            cmd = line[:4].upper()
+            if cmd == b'EHLO':
+                self._reply('250-stub\r\n250 AUTH PLAIN')
+            elif cmd == b'AUTH':
+                server.logins += 1
+                self._reply('235 OK')
+            elif cmd == b'DATA':
+                in_data = True
+                self._reply('354 go')
+            elif cmd == b'QUIT':
+                server.quits += 1
+                self._reply('221 bye')
+                return
+            else:
+                self._reply('250 OK')
+
+
+class _SmtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _SmtpHandler)
+        self.connections = self.messages = self.logins = self.quits = 0
+        self.drop_after = 0
+        # Ritardo simulato per ogni risposta (rete reale, non loopback)
+        self.latency = 0
+
+
+@pytest.fixture
+def smtp_server(monkeypatch):
+    """Server SMTP locale al posto del provider; l'app lo usa come SMTP configurato"""
+    server = _SmtpServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(email_utils, 'EMAIL_PROVIDER', 'smtp')
+    monkeypatch.setattr(email_utils, 'SENDGRID_API_KEY', None)
+    monkeypatch.setattr(email_utils, 'SMTP_HOST', '127.0.0.1')
+    monkeypatch.setattr(email_utils, 'SMTP_PORT', server.server_address[1])
+    monkeypatch.setattr(email_utils, 'SMTP_USER', 'user')
+    monkeypatch.setattr(email_utils, 'SMTP_PASS', 'pass')
+    monkeypatch.setattr(email_utils, 'SMTP_STARTTLS', False)
+    monkeypatch.setattr(email_utils, 'smtp_transport', email_utils.SmtpTransport())
+    yield server
+    email_utils.smtp_transport.close()
+    server.shutdown()
+    server.server_close()
+
+
+def _messages(n, body='<p>Ordine</p>'):
+    return [(f'cliente{i}@example.com', f'Ordine {i}', body) for i in range(n)]
+
+
+class _FakeResponse:
+    status_code = 202
+    text = ''
+
+
+class _FakeSession:
+    def __init__(self):
+        self.posts = []
+
+    def post(self, url, headers=None, json=None, timeout=None):
+        self.posts.append(json)
+        return _FakeResponse()
+
+
+class TestEmailTransport:
+
+    def test_smtp_connection_is_reused(self, smtp_server):
+        assert email_utils.send_many(_messages(25), fallback=False) == [True] * 25
+        assert email_utils.send_email('x@example.com', 'Ciao', '<p>ciao</p>', fallback=False)
+        assert (smtp_server.messages, smtp_server.connections, smtp_server.logins) == (26, 1, 1)
+
+    def test_smtp_reconnects_when_server_drops(self, smtp_server):
+        smtp_server.drop_after = 3
+        assert email_utils.send_many(_messages(7), fallback=False) == [True] * 7
+        assert smtp_server.messages == 7
+        assert smtp_server.connections == 3
+
+    def test_smtp_pool_is_shared_between_threads(self, smtp_server):
+        # Come i greenlet di gevent: tanti thread brevi, nessuna connessione lasciata aperta per thread
+        email_utils.smtp_transport.pool_size = 2
+        threads = [threading.Thread(target=email_utils.send_many, args=(_messages(3),), kwargs={'fallback': False})
+                   for _ in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert smtp_server.messages == 60
+        assert len(email_utils.smtp_transport._idle) <= 2
+        email_utils.smtp_transport.close()
+        deadline = time.time() + 2
+        while smtp_server.quits < smtp_server.connections and time.time() < deadline:
+            time.sleep(0.01)
+        assert smtp_server.quits == smtp_server.connections
+
+    def test_smtp_failure_is_reported_without_fallback(self, smtp_server, monkeypatch):
+        monkeypatch.setattr(email_utils, 'SMTP_PORT', 1)
+        assert email_utils.send_many(_messages(2), fallback=False) == [False, False]
+        assert email_utils.send_many(_messages(2)) == [True, True]
+
+    def test_sendgrid_batches_personalizations(self, monkeypatch):
+        session = _FakeSession()
+        monkeypatch.setattr(email_utils, 'EMAIL_PROVIDER', None)
+        monkeypatch.setattr(email_utils, 'SENDGRID_API_KEY', 'key')
+        monkeypatch.setattr(email_utils, 'SMTP_HOST', None)
+        monkeypatch.setattr(email_utils, '_http_session', lambda: session)
+        messages = _messages(2500) + _messages(3, body='<p>Altro</p>')
+        assert all(email_utils.send_many(messages, fallback=False))
+        assert [len(p['personalizations']) for p in session.posts] == [1000, 1000, 500, 3]
+        first = session.posts[0]['personalizations'][0]
+        assert first == {'to': [{'email': 'cliente0@example.com'}], 'subject': 'Ordine 0'}
+
+
+@pytest.mark.slow
+class TestEmailThroughput:
+
+    @pytest.mark.parametrize('latency', [0, 0.001])
+    def test_pooled_vs_connection_per_message(self, smtp_server, capsys, latency):
+        smtp_server.latency = latency
+
+        def per_message(messages):
+            for to_email, subject, html_content in messages:
+                with smtplib.SMTP(email_utils.SMTP_HOST, email_utils.SMTP_PORT, timeout=5) as server:
+                    server.login('user', 'pass')
+                    server.send_message(email_utils._build_message(to_email, subject, html_content))
+
+        for n in (100, 1000):
+            messages = _messages(n)
+            start = time.perf_counter()
+            per_message(messages)
+            single = time.perf_counter() - start
+            start = time.perf_counter()
+            assert all(email_utils.send_many(messages, fallback=False))
+            pooled = time.perf_counter() - start
+            with capsys.disabled():
+                print(f"\n{n} email, latenza {latency * 1000:.0f} ms: connessione per messaggio {n / single:.0f}/s, "
+                      f"connessione riusata {n / pooled:.0f}/s")
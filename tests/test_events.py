@@ -0,0 +1,215 @@
+"""
+Test dello stream /events: broker in memoria, eventi dopo il commit, trasporto a polling
+e prova di carico con 1000 connessioni ferme su gunicorn/gevent
+"""
+
+import json
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import time
+import pytest
+from flask import g
+from app import db, events
+from app.models import User, Message, OrderRequest
+from app.orders import bulk_transition
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def _user(name, farmer=False):
+    u = User(username=name, email=f'{name}@example.com', is_farmer=farmer)
+    u.set_password('pw')
+    db.session.add(u)
+    db.session.commit()
+    return u
+
+
+def _events(chunk):
+    """(tipo, dati) degli eventi SSE in un blocco di testo"""
+    found = []
+    for block in chunk.split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in block.split('\n') if line.startswith(('event', 'data')))
+        if 'event' in lines:
+            found.append((lines['event'], json.loads(lines['data'])))
+    return found
+
+
+class TestBroker:
+
+    def test_fan_out_and_slow_clients(self):
+        broker = events.Broker(queue_size=2)
+        a, b = broker.subscribe(1), broker.subscribe(1)
+        other = broker.subscribe(2)
+        for i in range(3):
+            broker.dispatch(1, 'message', {'id': i})
+        assert [a.get_nowait()[1]['id'] for _ in range(2)] == [0, 1]
+        assert b.qsize() == 2 and other.empty()
+        broker.unsubscribe(1, a)
+        broker.unsubscribe(1, b)
+        assert broker.listeners() == 1
+
+
+class TestEventStream:
+
+    def test_message_pushed_after_commit(self, db_client):
+        farmer, client = _user('agricoltore', True), _user('cliente')
+        db_client.post('/login', data={'email': farmer.email, 'password': 'pw'})
+        g.pop('_login_user', None)
+        resp = db_client.get('/events')
+        assert resp.mimetype == 'text/event-stream'
+        stream = iter(resp.response)
+        first = next(stream)
+        assert first.startswith(b'retry: ')
+        assert _events(first.decode()) == [('badges', {'unread': 0, 'pending': 0})]
+
+        # Annullato: nessun evento
+        db.session.add(Message(sender_id=client.id, recipient_id=farmer.id, content='Non inviato'))
+        db.session.flush()
+        db.session.rollback()
+        db.session.add(Message(sender_id=client.id, recipient_id=farmer.id, content='Avete uova?'))
+        db.session.add(OrderRequest(farmer_id=farmer.id, client_id=client.id, items_json='{}', status='pending'))
+        db.session.commit()
+        received = _events(next(stream).decode())
+        assert [kind for kind, _ in received] == ['message', 'order', 'badges']
+        assert received[0][1]['preview'] == 'Avete uova?' and received[0][1]['sender_id'] == client.id
+        assert received[-1][1] == {'unread': 1, 'pending': 1}
+        resp.close()
+        assert events.broker.listeners() == 0
+
+    def test_bulk_transition_notifies_clients(self, db_app):
+        farmer, client = _user('agricoltore', True), _user('cliente')
+        orders = [OrderRequest(farmer_id=farmer.id, client_id=client.id, items_json='{}', status='pending')
+                  for _ in range(3)]
+        db.session.add_all(orders)
+        db.session.commit()
+        q = events.broker.subscribe(client.id)
+        try:
+            bulk_transition(farmer.id, 'accept', [o.id for o in orders])
+            db.session.commit()
+            received = [q.get_nowait() for _ in range(q.qsize())]
+        finally:
+            events.broker.unsubscribe(client.id, q)
+        assert sorted(data['id'] for _, data in received) == sorted(o.id for o in orders)
+        assert {data['status'] for _, data in received} == {'confirmed'}
+
+    def test_polling_transport_between_processes(self, db_app):
+        farmer, client = _user('agricoltore', True), _user('cliente')
+        # Due worker: uno pubblica, l'altro legge la tabella con il proprio broker
+        publisher = events.PollingTransport(db.engine)
+        other_broker = events.Broker()
+        reader = events.PollingTransport(db.engine, broker=other_broker)
+        db_app.extensions['event_transport'] = publisher
+        reader.poll_once()
+        q = other_broker.subscribe(farmer.id)
+        db.session.add(Message(sender_id=client.id, recipient_id=farmer.id, content='Ciao'))
+        db.session.commit()
+        assert reader.poll_once() == 1
+        kind, data = q.get_nowait()
+        assert kind == 'message' and data['preview'] == 'Ciao'
+        assert reader.poll_once() == 0
+
+
+@pytest.mark.slow
+class TestEventStreamSoak:
+    """1000 stream aperti e fermi su un solo worker gevent: niente thread per connessione"""
+
+    LISTENERS = 1000
+
+    def _free_port(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            return s.getsockname()[1]
+
+    def _worker_pid(self, master_pid):
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            with open(f'/proc/{master_pid}/task/{master_pid}/children') as f:
+                children = f.read().split()
+            if children:
+                return int(children[0])
+            time.sleep(0.1)
+        raise RuntimeError('worker gunicorn non avviato')
+
+    def _proc_status(self, pid):
+        with open(f'/proc/{pid}/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(status['Threads']), int(status['VmRSS'].split()[0])
+
+    def _read_until(self, socks, marker, timeout):
+        """Legge da tutti i socket finché ognuno ha ricevuto `marker`; ritorna quanti ce l'hanno fatta"""
+        sel = selectors.DefaultSelector()
+        buffers = {}
+        for s in socks:
+            sel.register(s, selectors.EVENT_READ)
+            buffers[s] = b''
+        done = set()
+        deadline = time.time() + timeout
+        while len(done) < len(socks) and time.time() < deadline:
+            for key, _ in sel.select(timeout=1):
+                data = key.fileobj.recv(65536)
+                buffers[key.fileobj] += data
+                if marker in buffers[key.fileobj]:
+                    done.add(key.fileobj)
+                    sel.unregister(key.fileobj)
+                    buffers[key.fileobj] = b''
+        sel.close()
+        return len(done)
+
+    def test_thousand_idle_listeners(self, db_app, monkeypatch, capsys):
+        pytest.importorskip('gevent')
+        monkeypatch.setenv('EVENTS_TRANSPORT', 'poll')
+        farmer, client = _user('agricoltore', True), _user('cliente')
+        cookie = db_app.session_interface.get_signing_serializer(db_app).dumps(
+            {'_user_id': str(farmer.id), '_fresh': True})
+        port = self._free_port()
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', 'main:app', '--bind', f'127.0.0.1:{port}',
+             '--worker-connections', str(self.LISTENERS * 2), '--log-level', 'warning'],
+            cwd=ROOT, env=dict(os.environ), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        socks = []
+        try:
+            deadline = time.time() + 30
+            while True:
+                try:
+                    socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                    break
+                except OSError:
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(0.2)
+            worker = self._worker_pid(server.pid)
+            threads_before, _ = self._proc_status(worker)
+
+            request = (f"GET /events HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n"
+                       f"Cookie: session={cookie}\r\n\r\n").encode()
+            start = time.perf_counter()
+            for _ in range(self.LISTENERS):
+                s = socket.create_connection(('127.0.0.1', port))
+                s.sendall(request)
+                socks.append(s)
+            assert self._read_until(socks, b'event: badges', timeout=120) == self.LISTENERS
+            connected = time.perf_counter() - start
+            threads, rss = self._proc_status(worker)
+            # Le connessioni sono greenlet: i thread del sistema restano quelli dell'avvio
+            assert threads <= threads_before + 10
+
+            # Scritto da questo processo: il worker lo riceve tramite server_event
+            start = time.perf_counter()
+            db.session.add(Message(sender_id=client.id, recipient_id=farmer.id, content='Prova di carico'))
+            db.session.commit()
+            assert self._read_until(socks, b'event: message', timeout=120) == self.LISTENERS
+            delivered = time.perf_counter() - start
+            with capsys.disabled():
+                print(f"\n{self.LISTENERS} stream: collegati in {connected:.1f}s, thread del worker {threads}, "
+                      f"RSS {rss / 1024:.0f} MB, evento consegnato a tutti in {delivered:.1f}s")
+        finally:
+            for s in socks:
+                s.close()
+            # Arresto immediato: quello normale aspetta la chiusura degli stream
+            server.send_signal(signal.SIGINT)
+            server.wait(timeout=30)
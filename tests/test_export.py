@@ -0,0 +1,157 @@
+"""
+Test dell'esportazione ordini: CSV/XLSX in streaming, filtri e memoria costante
+"""
+
+import csv
+import io
+import json
+import tracemalloc
+import zipfile
+from datetime import datetime, timedelta
+import pytest
+from flask import g
+from app import db, exports
+from app.models import User, OrderRequest, OrderItem
+
+
+def _farmer(name='agricoltore'):
+    u = User(username=name, email=f'{name}@example.com', is_farmer=True, company_name=name.title())
+    u.set_password('pw')
+    db.session.add(u)
+    db.session.commit()
+    return u
+
+
+def _order(farmer, status='pending', created_at=None, lines=(), **fields):
+    fields.setdefault('items_json', json.dumps({}))
+    fields.setdefault('client_name', 'Mario')
+    order = OrderRequest(farmer_id=farmer.id, client_email='c@example.com', status=status,
+                         total_price=sum(price * qty for _, price, qty in lines),
+                         created_at=created_at or datetime.utcnow(), **fields)
+    order.items = [OrderItem(name=name, unit='kg', price=price, qty=qty) for name, price, qty in lines]
+    db.session.add(order)
+    db.session.commit()
+    return order
+
+
+def _login(client):
+    client.post('/login', data={'email': 'agricoltore@example.com', 'password': 'pw'})
+    g.pop('_login_user', None)
+
+
+def _csv(resp):
+    text = resp.get_data(as_text=True)
+    assert text.startswith('\ufeff')
+    return list(csv.reader(io.StringIO(text[1:])))
+
+
+class TestOrdersExport:
+
+    def test_csv_with_filters(self, db_client):
+        farmer, other = _farmer(), _farmer('altro')
+        day = datetime(2024, 6, 1, 10, 0)
+        _order(farmer, 'completed', day, [('Olio', 9.0, 2), ('Miele', 12.0, 1)])
+        _order(farmer, 'accepted', day + timedelta(days=1), [('Uova', 0.5, 6)])
+        _order(farmer, 'pending', day + timedelta(days=5), [('Olio', 9.0, 1)])
+        _order(other, 'completed', day, [('Vino', 8.0, 1)])
+        _login(db_client)
+
+        resp = db_client.get('/my-orders/export')
+        assert resp.is_streamed
+        assert resp.mimetype == 'text/csv'
+        assert 'attachment; filename="ordini-' in resp.headers['Content-Disposition']
+        rows = _csv(resp)
+        assert rows[0] == exports.COLUMNS
+        assert len(rows) == 4
+        assert rows[-1][1:4] == ['2024-06-01 10:00', 'Completato', 'Mario']
+        assert rows[-1][8] == 'Olio x2 kg; Miele x1 kg' and rows[-1][9] == '30.0'
+
+        g.pop('_login_user', None)
+        rows = _csv(db_client.get('/my-orders/export?date_from=2024-06-01&date_to=2024-06-02'))
+        assert [r[2] for r in rows[1:]] == ['Confermato', 'Completato']
+        g.pop('_login_user', None)
+        rows = _csv(db_client.get('/my-orders/export?status=confirmed'))
+        assert [r[8] for r in rows[1:]] == ['Uova x6 kg']
+
+    def test_csv_does_not_emit_formulas(self, db_client):
+        farmer = _farmer()
+        _order(farmer, 'completed', lines=[('@SUM(1+1)', 2.0, 1)], client_name='=HYPERLINK("http://x")',
+               client_phone='+39 070 123', delivery_requested=True, delivery_address='-Via Roma')
+        _login(db_client)
+        row = _csv(db_client.get('/my-orders/export'))[1]
+        assert row[3] == '\'=HYPERLINK("http://x")' and row[5] == "'+39 070 123"
+        assert row[7] == "'-Via Roma" and row[8] == "'@SUM(1+1) x1 kg"
+        # I numeri restano numeri
+        assert row[9] == '2.0'
+
+    def test_legacy_orders_use_items_json(self, db_app):
+        farmer = _farmer()
+        _order(farmer, items_json=json.dumps({'3': {'name': 'Farina', 'unit': 'kg', 'price': 2, 'qty': 4}}))
+        rows = list(exports.order_rows(farmer.id))
+        assert rows[0][8] == 'Farina x4 kg'
+
+    def test_xlsx_is_a_valid_workbook(self, db_client):
+        farmer = _farmer()
+        _order(farmer, 'completed', lines=[('Olio & aceto <bio>', 9.0, 2)])
+        _login(db_client)
+        resp = db_client.get('/my-orders/export?format=xlsx')
+        assert resp.mimetype == exports.FORMATS['xlsx'][1]
+        with zipfile.ZipFile(io.BytesIO(resp.get_data())) as zf:
+            assert zf.testzip() is None
+            assert '[Content_Types].xml' in zf.namelist()
+            sheet = zf.read('xl/worksheets/sheet1.xml').decode()
+        assert sheet.count('<row>') == 2
+        assert 'Olio &amp; aceto &lt;bio&gt; x2 kg' in sheet and '<v>18.0</v>' in sheet
+
+    def test_only_farmers_and_valid_params(self, db_client):
+        _farmer()
+        client = User(username='cliente', email='cliente@example.com')
+        client.set_password('pw')
+        db.session.add(client)
+        db.session.commit()
+        _login(db_client)
+        assert db_client.get('/my-orders/export?format=pdf').status_code == 302
+        g.pop('_login_user', None)
+        assert db_client.get('/my-orders/export?status=boh').status_code == 302
+        g.pop('_login_user', None)
+        db_client.get('/logout')
+        db_client.post('/login', data={'email': 'cliente@example.com', 'password': 'pw'})
+        g.pop('_login_user', None)
+        assert db_client.get('/my-orders/export').status_code == 302
+
+
+@pytest.mark.slow
+class TestOrdersExportMemory:
+
+    def _fill(self, farmer, n):
+        start = datetime(2020, 1, 1)
+        db.session.execute(OrderRequest.__table__.insert(), [
+            {'farmer_id': farmer.id, 'client_name': f'Cliente {i}', 'client_email': f'c{i}@example.com',
+             'items_json': '{}', 'total_price': 12.5, 'status': 'completed',
+             'created_at': start + timedelta(minutes=i)} for i in range(n)
+        ])
+        db.session.execute(OrderItem.__table__.insert().from_select(
+            ['order_id', 'name', 'unit', 'price', 'qty'],
+            db.select(OrderRequest.id, db.literal('Olio'), db.literal('l'), db.literal(12.5), db.literal(1))
+        ))
+        db.session.commit()
+
+    def _peak(self, farmer, fmt):
+        writer = exports.FORMATS[fmt][0]
+        tracemalloc.start()
+        size = sum(len(chunk) for chunk in writer(exports.order_rows(farmer.id)))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return size, peak
+
+    @pytest.mark.parametrize('fmt', ['csv', 'xlsx'])
+    def test_memory_does_not_grow_with_orders(self, db_app, fmt):
+        small, big = _farmer(), _farmer('grande')
+        self._fill(small, 10_000)
+        self._fill(big, 100_000)
+        small_size, small_peak = self._peak(small, fmt)
+        big_size, big_peak = self._peak(big, fmt)
+        assert big_size > 5 * small_size
+        # Dieci volte gli ordini, picco di memoria quasi invariato
+        assert big_peak < small_peak * 1.5
+        assert big_peak < 20 * 1024 * 1024
@@ -0,0 +1,81 @@
+"""
+Test dell'indice dei filtri (province, comuni, categorie) in memoria
+"""
+
+from sqlalchemy import insert
+from app import db, facets
+from app.models import User, Product
+from app.facets import facet_index, FacetIndex
+
+
+def _farmer(name, province, city, is_farmer=True):
+    u = User(username=name, email=f'{name}@example.com', is_farmer=is_farmer, province=province, city=city)
+    u.set_password('x')
+    db.session.add(u)
+    db.session.flush()
+    return u
+
+
+def _snapshot(index):
+    return (index.province_counts(), {p['name']: index.city_counts(p['name']) for p in index.province_counts()},
+            index.category_counts(), index.cities())
+
+
+class TestFacetIndex:
+
+    def test_incremental_updates_match_rebuild(self, db_app):
+        a = _farmer('a', 'Oristano', 'Cabras')
+        b = _farmer('b', 'Sassari', 'Alghero')
+        db.session.add_all([Product(name='p1', category='vino', user_id=a.id),
+                            Product(name='p2', category='olio', user_id=b.id)])
+        db.session.commit()
+        facet_index.ensure()
+
+        # Scritture dopo la costruzione: applicate in modo incrementale
+        c = _farmer('c', 'Oristano', 'Milis')
+        p3 = Product(name='p3', category='frutta', user_id=c.id)
+        db.session.add(p3)
+        client = _farmer('cliente', 'Nuoro', 'Nuoro', is_farmer=False)
+        db.session.commit()
+        b.province, b.city = 'Oristano', 'Bosa'
+        p3.category = 'verdura'
+        db.session.delete(Product.query.filter_by(name='p1').one())
+        db.session.commit()
+
+        fresh = FacetIndex()
+        assert _snapshot(facet_index) == _snapshot(fresh)
+        assert facet_index.provinces() == ['Oristano']
+        assert facet_index.cities('Oristano') == ['Bosa', 'Cabras', 'Milis']
+        counts = {c['name']: c['products'] for c in facet_index.category_counts()}
+        assert counts['olio'] == 1 and counts['verdura'] == 1 and counts['vino'] == 0
+
+    def test_rollback_discards_pending_changes(self, db_app):
+        _farmer('a', 'Oristano', 'Cabras')
+        db.session.commit()
+        facet_index.ensure()
+        _farmer('b', 'Cagliari', 'Pula')
+        db.session.rollback()
+        assert facet_index.provinces() == ['Oristano']
+
+    def test_rebuilt_after_max_age_for_other_processes(self, db_app, monkeypatch):
+        _farmer('a', 'Oristano', 'Cabras')
+        db.session.commit()
+        assert facet_index.provinces() == ['Oristano']
+        # Scrittura di un altro processo: nessun evento in questo
+        db.session.execute(insert(User).values(username='b', email='b@example.com', password_hash='x',
+                                               is_farmer=True, province='Sassari', city='Alghero'))
+        db.session.commit()
+        assert facet_index.provinces() == ['Oristano']
+        # Indice più vecchio di INDEX_MAX_AGE: ricostruito alla lettura successiva
+        monkeypatch.setattr(facets, 'INDEX_MAX_AGE', -1)
+        assert facet_index.provinces() == ['Oristano', 'Sassari']
+
+    def test_listing_filters_need_no_user_scans(self, db_client, count_queries):
+        a = _farmer('a', 'Oristano', 'Cabras')
+        db.session.add(Product(name='p1', price=3.0, unit='kg', category='vino', user_id=a.id))
+        db.session.commit()
+        db_client.get('/products')
+        with count_queries() as q:
+            html = db_client.get('/products?province=Oristano').get_data(as_text=True)
+        assert 'Oristano (1)' in html
+        assert not [s for s in q.statements if 'FROM user' in s and 'JOIN' not in s and 'count' not in s.lower()]
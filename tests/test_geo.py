@@ -0,0 +1,158 @@
+"""
+Test del motore di ricerca per prossimità (indice a griglia + haversine)
+"""
+
+import random
+import time
+import pytest
+from geopy.distance import geodesic
+
+from app import db
+from app.models import User
+from app.geo import FarmerIndex, farmer_index, nearby_farmers, haversine_km, bounding_box
+
+ORISTANO = (39.9062, 8.5884)
+
+
+def _random_points(n, seed=42):
+    rnd = random.Random(seed)
+    lats = [rnd.uniform(38.8, 41.3) for _ in range(n)]
+    lngs = [rnd.uniform(8.1, 9.8) for _ in range(n)]
+    return list(range(n)), lats, lngs
+
+
+def _geodesic_loop(lat, lng, lats, lngs, radius):
+    nearby = []
+    for fid, (plat, plng) in enumerate(zip(lats, lngs)):
+        dist = geodesic((lat, lng), (plat, plng)).km
+        if dist <= radius:
+            nearby.append((fid, dist))
+    nearby.sort(key=lambda h: h[1])
+    return nearby
+
+
+class TestDistanceEngine:
+
+    def test_haversine_close_to_geodesic(self):
+        cagliari = (39.2238, 9.1217)
+        expected = geodesic(ORISTANO, cagliari).km
+        got = float(haversine_km(ORISTANO[0], ORISTANO[1], [cagliari[0]], [cagliari[1]])[0])
+        assert abs(got - expected) / expected < 0.005
+
+    def test_bounding_box_contains_radius(self):
+        min_lat, max_lat, min_lng, max_lng = bounding_box(ORISTANO[0], ORISTANO[1], 50)
+        north = geodesic(kilometers=50).destination(ORISTANO, 0)
+        east = geodesic(kilometers=50).destination(ORISTANO, 90)
+        assert min_lat < ORISTANO[0] < north.latitude <= max_lat
+        assert min_lng < ORISTANO[1] < east.longitude <= max_lng
+
+    def test_index_matches_geodesic_loop(self):
+        ids, lats, lngs = _random_points(2000)
+        index = FarmerIndex()
+        index.load(ids, lats, lngs)
+        expected = _geodesic_loop(ORISTANO[0], ORISTANO[1], lats, lngs, 50)
+        got = index.nearby(ORISTANO[0], ORISTANO[1], 50)
+        # Ai bordi del raggio haversine e geodetica possono differire di pochi metri
+        expected_ids = {fid for fid, d in expected if d < 49.8}
+        assert expected_ids <= {fid for fid, _ in got}
+        assert [d for _, d in got] == sorted(d for _, d in got)
+
+
+class TestSearchEndpoint:
+
+    def test_results_ordered_by_distance(self, db_client):
+        coords = [('lontano', 40.72, 8.56), ('vicino', 39.93, 8.53), ('medio', 40.1, 8.6), ('nessuna', None, None)]
+        for name, lat, lng in coords:
+            u = User(username=name, email=f'{name}@example.com', is_farmer=True, latitude=lat, longitude=lng)
+            u.set_password('x')
+            db.session.add(u)
+        client = User(username='cliente', email='cliente@example.com')
+        client.set_password('pw')
+        db.session.add(client)
+        db.session.commit()
+
+        assert [f.username for f, _ in nearby_farmers(ORISTANO[0], ORISTANO[1], 50)] == ['vicino', 'medio']
+
+        db_client.post('/login', data={'email': 'cliente@example.com', 'password': 'pw'})
+        resp = db_client.post('/search', data={'lat': ORISTANO[0], 'lng': ORISTANO[1]})
+        html = resp.get_data(as_text=True)
+        assert resp.status_code == 200
+        assert html.index('vicino') < html.index('medio')
+        assert 'lontano' not in html
+
+    def test_index_invalidated_on_farmer_change(self, db_app):
+        u = User(username='spostato', email='s@example.com', is_farmer=True, latitude=40.72, longitude=8.56)
+        u.set_password('x')
+        db.session.add(u)
+        db.session.commit()
+        assert nearby_farmers(ORISTANO[0], ORISTANO[1], 20) == []
+
+        u.latitude, u.longitude = 39.91, 8.59
+        db.session.commit()
+        assert [f.username for f, _ in nearby_farmers(ORISTANO[0], ORISTANO[1], 20)] == ['spostato']
+
+
+@pytest.mark.slow
+class TestSearchBenchmark:
+    """Confronto con il vecchio ciclo geodesic: pytest -m slow -s"""
+
+    @pytest.mark.parametrize('n', [1_000, 10_000, 100_000])
+    def test_benchmark(self, n):
+        ids, lats, lngs = _random_points(n)
+
+        start = time.perf_counter()
+        _geodesic_loop(ORISTANO[0], ORISTANO[1], lats, lngs, 50)
+        loop_time = time.perf_counter() - start
+
+        index = FarmerIndex()
+        start = time.perf_counter()
+        index.load(ids, lats, lngs)
+        build_time = time.perf_counter() - start
+
+        runs = 20
+        start = time.perf_counter()
+        for _ in range(runs):
+            index.nearby(ORISTANO[0], ORISTANO[1], 50)
+        query_time = (time.perf_counter() - start) / runs
+
+        print(f"\n{n:>7} farmers: geodesic loop {loop_time * 1000:9.1f} ms | "
+              f"index build {build_time * 1000:8.1f} ms | index query {query_time * 1000:7.2f} ms")
+
+
+class TestFarmersGeoJSON:
+
+    def _seed(self):
+        for name, lat, lng, province in [('cabras', 39.93, 8.53, 'Oristano'), ('sassari', 40.72, 8.56, 'Sassari'),
+                                         ('nocoords', None, None, 'Oristano')]:
+            u = User(username=name, email=f'{name}@example.com', is_farmer=True, company_name=name.upper(),
+                     province=province, city=name, latitude=lat, longitude=lng)
+            u.set_password('x')
+            db.session.add(u)
+        db.session.commit()
+
+    def test_filters_and_compact_output(self, db_client):
+        self._seed()
+        data = db_client.get('/api/farmers.geojson').get_json(force=True)
+        assert data['type'] == 'FeatureCollection'
+        assert sorted(f['properties']['slug'] for f in data['features']) == ['cabras', 'sassari']
+
+        data = db_client.get('/api/farmers.geojson?province=Oristano').get_json(force=True)
+        assert [f['properties']['name'] for f in data['features']] == ['CABRAS']
+
+        data = db_client.get('/api/farmers.geojson?bbox=8.0,40.5,9.0,41.0').get_json(force=True)
+        assert [f['geometry']['coordinates'] for f in data['features']] == [[8.56, 40.72]]
+
+    def test_conditional_requests(self, db_client):
+        self._seed()
+        first = db_client.get('/api/farmers.geojson')
+        assert first.headers['ETag'] and first.headers['Last-Modified']
+        again = db_client.get('/api/farmers.geojson', headers={'If-None-Match': first.headers['ETag']})
+        assert again.status_code == 304
+
+        # Una modifica cambia l'ETag
+        u = User.query.filter_by(username='cabras').one()
+        u.latitude = 39.95
+        db.session.commit()
+        changed = db_client.get('/api/farmers.geojson', headers={'If-None-Match': first.headers['ETag']})
+        assert changed.status_code == 200
+        assert changed.headers['ETag'] != first.headers['ETag']
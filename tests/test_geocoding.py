@@ -0,0 +1,104 @@
+"""
+Test della geocodifica offline (gazetteer dei comuni) e del backfill a blocchi
+"""
+
+from flask import g
+from app import db
+from app.models import User
+from app.geocoding import geocode, geocode_user, backfill, remap_locations, clear_province_centroids
+
+
+def _farmer(name, province=None, city=None, address=None, lat=None, lng=None):
+    u = User(username=name, email=f'{name}@example.com', is_farmer=True, province=province, city=city,
+             address=address, latitude=lat, longitude=lng)
+    u.set_password('pw')
+    db.session.add(u)
+    return u
+
+
+class TestGeocode:
+
+    def test_comune_address_and_province(self):
+        lat, lng, precision = geocode('Oristano', 'Cabras')
+        assert precision == 'comune' and abs(lat - 39.93) < 0.05 and abs(lng - 8.53) < 0.05
+        assert geocode(None, None, 'Via Roma 3, 09072 Cabras (OR)')[:2] == (lat, lng)
+        # Comune sconosciuto: centro della provincia
+        assert geocode('Sud Sardegna', 'Comune Inventato')[2] == 'provincia'
+        assert geocode(None, 'Comune Inventato') is None
+
+    def test_comune_moved_to_other_province(self):
+        # Teulada: prima in provincia di Cagliari, ora Sud Sardegna
+        assert geocode('Cagliari', 'Teulada') == geocode('Sud Sardegna', 'Teulada')
+        assert geocode('Cagliari', 'Teulada')[2] == 'comune'
+
+
+class TestBackfill:
+
+    def test_chunked_and_resumable(self, db_app):
+        for i in range(5):
+            _farmer(f'az{i}', 'Oristano', 'Cabras')
+        _farmer('ignota', city='Atlantide')
+        _farmer('gia_ok', 'Sassari', 'Alghero', lat=1.0, lng=2.0)
+        # Solo la provincia: niente centro della provincia come posizione
+        _farmer('provincia', 'Oristano', 'Comune Inventato')
+        db.session.commit()
+
+        logs = []
+        assert backfill(chunk_size=2, log=logs.append) == (5, 2)
+        assert len(logs) == 4
+        assert User.query.filter(User.latitude.is_(None)).count() == 2
+        assert User.query.filter_by(username='gia_ok').one().latitude == 1.0
+        # Rilancio: solo gli agricoltori non risolti vengono riletti
+        assert backfill(chunk_size=2, log=logs.append) == (0, 2)
+
+    def test_clear_province_centroids(self, db_app):
+        lat, lng = geocode('Oristano', 'Comune Inventato')[:2]
+        _farmer('centro', 'Oristano', 'Comune Inventato', lat=lat, lng=lng)
+        # Coordinate arrotondate (es. rilette da un altro database): sono ancora il centro
+        _farmer('arrotondato', 'Oristano', 'Comune Inventato', lat=round(lat, 6), lng=round(lng, 6))
+        _farmer('esatta', 'Oristano', 'Cabras', lat=39.93, lng=8.53)
+        db.session.commit()
+        assert clear_province_centroids(dry_run=True) == 2
+        assert clear_province_centroids() == 2
+        assert {u.username for u in User.query.filter(User.latitude.is_(None))} == {'centro', 'arrotondato'}
+        assert clear_province_centroids() == 0
+
+    def test_remap_moved_comuni(self, db_app):
+        _farmer('teulada', 'Cagliari', 'Teulada')
+        _farmer('pula', 'Sud Sardegna', 'pula')
+        _farmer('cabras', 'Oristano', 'Cabras')
+        _farmer('ignota', 'Cagliari', 'Atlantide')
+        db.session.commit()
+
+        assert remap_locations(chunk_size=2, dry_run=True, log=lambda msg: None) == 2
+        assert remap_locations(chunk_size=2, log=lambda msg: None) == 2
+        located = {u.username: (u.province, u.city) for u in User.query}
+        assert located['teulada'] == ('Sud Sardegna', 'Teulada')
+        assert located['pula'] == ('Cagliari', 'Pula')
+        assert located['cabras'] == ('Oristano', 'Cabras')
+        assert located['ignota'] == ('Cagliari', 'Atlantide')
+        assert remap_locations(log=lambda msg: None) == 0
+
+    def _save(self, client, **fields):
+        g.pop('_login_user', None)
+        client.post('/profile', data={'username': 'mio', 'company_name': 'Mio', **fields})
+
+    def test_profile_save_hook(self, db_client):
+        _farmer('mio', 'Oristano', 'Cabras', lat=39.93, lng=8.53)
+        db.session.commit()
+        db_client.post('/login', data={'email': 'mio@example.com', 'password': 'pw'})
+        db_client.post('/profile', data={'username': 'mio', 'company_name': 'Mio', 'province': 'Sassari',
+                                         'city': 'Alghero'})
+        u = User.query.filter_by(username='mio').one()
+        db.session.refresh(u)
+        assert u.city == 'Alghero' and abs(u.latitude - 40.56) < 0.05
+
+        # Coordinate precise (es. dalla mappa): cambiare solo l'indirizzo non le sovrascrive
+        u.latitude, u.longitude = 40.5612, 8.3123
+        db.session.commit()
+        self._save(db_client, province='Sassari', city='Alghero', address='Via Roma 1, Alghero')
+        db.session.refresh(u)
+        assert (u.latitude, u.longitude) == (40.5612, 8.3123)
+        # Comune non riconosciuto: nessuna coordinata, non il centro della provincia
+        u.city, u.address, u.latitude, u.longitude = 'Comune Inventato', None, None, None
+        assert not geocode_user(u) and u.latitude is None
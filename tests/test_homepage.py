@@ -0,0 +1,57 @@
+"""
+Test del caricamento dati della homepage (numero di query costante)
+"""
+
+from app import db
+from app.models import User, Product
+
+
+def _seed_catalog(n_farmers, products_per_farmer, start=0):
+    for i in range(start, start + n_farmers):
+        farmer = User(
+            username=f'farmer{i}',
+            email=f'farmer{i}@example.com',
+            is_farmer=True,
+            company_name=f'Azienda {i}',
+            province='Oristano',
+            city='Cabras',
+            latitude=39.93,
+            longitude=8.53
+        )
+        farmer.set_password('x')
+        db.session.add(farmer)
+        db.session.flush()
+        for j in range(products_per_farmer):
+            db.session.add(Product(name=f'Prodotto {i}-{j}', price=1.5, unit='kg', user_id=farmer.id))
+    db.session.commit()
+
+
+class TestHomepageQueries:
+    """La homepage non deve fare una query per prodotto o per azienda"""
+
+    def test_query_count_constant_as_catalog_grows(self, db_client, count_queries):
+        _seed_catalog(3, 2)
+        # Il primo accesso costruisce gli indici in memoria (filtri)
+        db_client.get('/')
+        with count_queries() as small:
+            assert db_client.get('/').status_code == 200
+
+        _seed_catalog(25, 20, start=3)
+        with count_queries() as large:
+            assert db_client.get('/').status_code == 200
+
+        assert large.count == small.count
+        assert large.count <= 3
+
+    def test_products_bounded_per_farmer(self, db_app):
+        from app.homepage import load_homepage_data
+        _seed_catalog(2, 10)
+        data = load_homepage_data(products_per_farmer=4)
+        assert len(data['products_data']) == 8
+        assert {p['farmer_slug'] for p in data['products_data']} == {'azienda-0', 'azienda-1'}
+
+    def test_province_filter(self, db_app):
+        from app.homepage import load_homepage_data
+        _seed_catalog(2, 1)
+        assert load_homepage_data(province='Sassari')['products_data'] == []
+        assert len(load_homepage_data(province='Oristano')['farmers']) == 2
@@ -0,0 +1,41 @@
+"""
+Test del gazetteer dei comuni e dell'endpoint /api/cities
+"""
+
+from app.locations import gazetteer, get_provinces, get_cities, _key
+
+
+class TestGazetteer:
+
+    def test_nationwide_data(self):
+        assert len(gazetteer.ensure().comuni) > 7800
+        assert len(get_provinces()) == 107
+        assert 'Sud Sardegna' in get_provinces() and 'Milano' in get_provinces()
+        # Nessun doppione all'interno di una provincia (prima: Macomer, Seneghe)
+        for province in get_provinces():
+            cities = get_cities(province)
+            assert len(cities) == len(set(cities))
+            assert list(cities) == sorted(cities, key=_key)
+
+    def test_lookup_and_prefix(self):
+        cabras = gazetteer.lookup('CABRAS')
+        assert (cabras.province, cabras.region) == ('Oristano', 'Sardegna')
+        assert abs(cabras.lat - 39.93) < 0.05 and abs(cabras.lng - 8.53) < 0.05
+        assert gazetteer.lookup('Tortoli').name == 'Tortolì'
+        assert [c.name for c in gazetteer.complete('cabr')] == ['Cabras']
+        assert all(c.province == 'Oristano' for c in gazetteer.complete('s', province='Oristano'))
+        assert gazetteer.complete('') == []
+
+
+class TestCitiesEndpoint:
+
+    def test_cacheable_response(self, db_client):
+        res = db_client.get('/api/cities?province=Oristano')
+        assert 'Cabras' in res.get_json()
+        assert res.cache_control.max_age == 86400 and res.headers['ETag']
+        again = db_client.get('/api/cities?province=Oristano', headers={'If-None-Match': res.headers['ETag']})
+        assert again.status_code == 304
+
+    def test_prefix(self, db_client):
+        assert db_client.get('/api/cities?q=cabr').get_json() == ['Cabras']
+        assert db_client.get('/api/cities?province=Nessuna').get_json() == []
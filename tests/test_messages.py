@@ -0,0 +1,149 @@
+"""
+Test dei messaggi: riepilogo delle conversazioni e inbox a query costanti
+"""
+
+from datetime import datetime, timedelta
+from flask import g
+from app import db, conversations
+from app.models import User, Message, Conversation
+
+
+def _user(name, farmer=False):
+    u = User(username=name, email=f'{name}@example.com', is_farmer=farmer)
+    u.set_password('pw')
+    db.session.add(u)
+    db.session.commit()
+    return u
+
+
+def _send(sender, recipient, content, minutes=0):
+    db.session.add(Message(sender_id=sender.id, recipient_id=recipient.id, content=content,
+                           timestamp=datetime(2024, 6, 1, 9, 0) + timedelta(minutes=minutes)))
+    db.session.commit()
+
+
+def _login(client, user):
+    client.post('/login', data={'email': user.email, 'password': 'pw'})
+    g.pop('_login_user', None)
+
+
+def _summary():
+    return {(c.low_id, c.high_id): (c.last_message_id, c.last_sender_id, c.last_preview, c.unread_low, c.unread_high)
+            for c in Conversation.query.all()}
+
+
+class TestConversationSummary:
+
+    def test_maintained_on_send_and_read(self, db_client):
+        farmer, anna, luca = _user('agricoltore', True), _user('anna'), _user('luca')
+        _send(anna, farmer, 'Avete uova?')
+        _send(anna, farmer, 'Anche sabato?', 1)
+        _send(farmer, luca, 'x' * 150, 2)
+        assert len(db.session.get(Conversation, conversations.pair(farmer.id, luca.id)).last_preview) == 100
+        _send(luca, farmer, 'Grazie', 3)
+
+        c = db.session.get(Conversation, conversations.pair(farmer.id, anna.id))
+        assert (c.unread_for(farmer.id), c.unread_for(anna.id)) == (2, 0)
+        assert c.last_preview == 'Anche sabato?' and c.last_message_at == datetime(2024, 6, 1, 9, 1)
+
+        _login(db_client, farmer)
+        db_client.get(f'/conversation/{anna.id}')
+        db.session.expire_all()
+        assert db.session.get(Conversation, conversations.pair(farmer.id, anna.id)).unread_for(farmer.id) == 0
+        assert Message.query.filter_by(recipient_id=farmer.id, read=False).count() == 1
+
+        incremental = _summary()
+        assert conversations.rebuild() == 2
+        assert _summary() == incremental
+
+    def test_inbox_query_count_does_not_grow(self, db_client, count_queries):
+        farmer = _user('agricoltore', True)
+        clients = [_user(f'cliente{i}') for i in range(30)]
+        for i, client in enumerate(clients):
+            _send(client, farmer, f'Ordine {i}', i)
+        _login(db_client, farmer)
+        db_client.get('/faq')
+        g.pop('_login_user', None)
+        with count_queries() as q:
+            page = db_client.get('/messages').get_data(as_text=True)
+        assert len([s for s in q.statements if 'message' in s or 'conversation' in s]) == 1
+        assert page.index('Ordine 29') < page.index('Ordine 0')
+        assert page.count('badge badge-success badge-pill') == 30
+
+    def test_window_fallback_matches_summary(self, db_app, monkeypatch):
+        farmer, anna, luca = _user('agricoltore', True), _user('anna'), _user('luca')
+        _send(anna, farmer, 'Ciao', 0)
+        _send(farmer, anna, 'Buongiorno', 5)
+        _send(luca, farmer, 'Prezzi?', 2)
+        _send(luca, farmer, 'Ancora lì?', 3)
+
+        def view(rows):
+            return [(r['user'].id, r['last_message'].content, r['last_message'].sender_id, r['unread_count'])
+                    for r in rows]
+
+        summary = view(conversations.inbox_conversations(farmer.id))
+        monkeypatch.setattr(conversations, 'summary_ready', lambda bind: False)
+        assert view(conversations.inbox_conversations(farmer.id)) == summary
+        assert summary == [(anna.id, 'Buongiorno', farmer.id, 1), (luca.id, 'Ancora lì?', luca.id, 2)]
+
+
+    def test_backfilled_when_created_on_existing_database(self, db_client):
+        farmer, anna = _user('agricoltore', True), _user('anna')
+        _send(anna, farmer, 'Avete uova?')
+        _send(anna, farmer, 'Anche sabato?', 1)
+        expected = _summary()
+        # Database precedente alla migrazione: create_all crea il riepilogo e lo riempie dai messaggi
+        Conversation.__table__.drop(db.engine)
+        db.create_all()
+        assert _summary() == expected
+        assert conversations.unread_total(farmer.id) == 2
+
+
+class TestConversationHistory:
+
+    def _thread(self, farmer, client, n):
+        # Tre messaggi per minuto: l'ordine a parità di orario lo decide l'id
+        for i in range(n):
+            sender, recipient = (client, farmer) if i % 2 else (farmer, client)
+            db.session.add(Message(sender_id=sender.id, recipient_id=recipient.id, content=f'msg-{i:03d}',
+                                   timestamp=datetime(2024, 6, 1, 9, 0) + timedelta(minutes=i // 3)))
+        db.session.commit()
+
+    def test_pages_from_newest(self, db_client):
+        farmer, client = _user('agricoltore', True), _user('cliente')
+        self._thread(farmer, client, 120)
+        _login(db_client, farmer)
+        page = db_client.get(f'/conversation/{client.id}').get_data(as_text=True)
+        assert 'msg-119' in page and 'msg-070' in page and 'msg-069' not in page
+        assert 'id="loadEarlier"' in page and 'd-none" id="loadEarlier"' not in page
+
+        seen = []
+        before = Message.query.filter_by(content='msg-070').one().id
+        while before:
+            g.pop('_login_user', None)
+            data = db_client.get(f'/conversation/{client.id}/earlier?before={before}').get_json()
+            seen = [m['content'] for m in data['messages']] + seen
+            before = data['messages'][0]['id'] if data['has_earlier'] else None
+        assert seen == [f'msg-{i:03d}' for i in range(70)]
+
+    def test_since_and_json_post(self, db_client):
+        farmer, client = _user('agricoltore', True), _user('cliente')
+        self._thread(farmer, client, 4)
+        last = Message.query.order_by(Message.id.desc()).first().id
+        _login(db_client, farmer)
+        resp = db_client.post(f'/conversation/{client.id}', data={'content': 'Arrivo alle 10'},
+                              headers={'Accept': 'application/json'})
+        assert resp.status_code == 201
+        assert resp.get_json()['message']['content'] == 'Arrivo alle 10' and resp.get_json()['message']['mine']
+        g.pop('_login_user', None)
+        assert db_client.post(f'/conversation/{client.id}', data={'content': ''},
+                              headers={'Accept': 'application/json'}).status_code == 400
+
+        _send(client, farmer, 'Perfetto')
+        g.pop('_login_user', None)
+        data = db_client.get(f'/conversation/{client.id}/since?after={last}').get_json()
+        assert [(m['content'], m['mine']) for m in data['messages']] == [('Arrivo alle 10', True), ('Perfetto', False)]
+        assert Message.query.filter_by(content='Perfetto').one().read
+        g.pop('_login_user', None)
+        assert db_client.get(f'/conversation/{client.id}/since?after={data["messages"][-1]["id"]}').get_json() == \
+            {'messages': []}
@@ -0,0 +1,190 @@
+"""
+Test degli ordini: contatore in attesa, transizioni in blocco e righe d'ordine
+"""
+
+import json
+from datetime import datetime, timedelta
+from flask import g
+from app import db
+from app.models import User, Product, OrderRequest, OrderItem, Message, OutboxMessage
+from app.orders import reconcile_pending_counts, bulk_transition, backfill_order_items
+
+
+def _farmer(name='agricoltore'):
+    u = User(username=name, email=f'{name}@example.com', is_farmer=True, company_name=name.title())
+    u.set_password('pw')
+    db.session.add(u)
+    db.session.commit()
+    return u
+
+
+def _order(farmer, status='pending', **fields):
+    fields.setdefault('items_json', json.dumps({}))
+    order = OrderRequest(farmer_id=farmer.id, client_email='c@example.com', status=status,
+                         total_price=10.0, **fields)
+    db.session.add(order)
+    db.session.commit()
+    return order
+
+
+def _count(farmer):
+    return db.session.query(User.pending_orders_count).filter(User.id == farmer.id).scalar()
+
+
+class TestPendingOrdersCounter:
+
+    def test_maintained_on_order_writes(self, db_app):
+        farmer, other = _farmer(), _farmer('altro')
+        orders = [_order(farmer) for _ in range(3)]
+        _order(farmer, status='completed')
+        assert _count(farmer) == 3
+
+        orders[0].status = 'confirmed'
+        db.session.commit()
+        assert _count(farmer) == 2
+
+        orders[1].farmer_id = other.id
+        db.session.commit()
+        assert (_count(farmer), _count(other)) == (1, 1)
+
+        db.session.delete(orders[2])
+        db.session.commit()
+        assert _count(farmer) == 0
+
+        orders[0].status = 'pending'
+        db.session.rollback()
+        assert _count(farmer) == 0
+
+    def test_create_and_bulk_routes(self, db_client):
+        farmer = _farmer()
+        db_client.post('/orders/create/%d' % farmer.id, data={'email': 'c@example.com'})
+        with db_client.session_transaction() as sess:
+            sess['cart'] = {str(farmer.id): {'1': {'name': 'Olio', 'unit': 'l', 'price': 9.0, 'qty': 2}}}
+        db_client.post('/orders/create/%d' % farmer.id, data={'email': 'c@example.com'})
+        assert _count(farmer) == 1
+
+        db_client.post('/login', data={'email': 'agricoltore@example.com', 'password': 'pw'})
+        ids = [str(o.id) for o in OrderRequest.query.all()]
+        g.pop('_login_user', None)
+        db_client.post('/orders/bulk', data={'order_ids': ids, 'action': 'accept'})
+        assert _count(farmer) == 0
+
+    def test_badge_costs_no_queries(self, db_client, count_queries):
+        farmer = _farmer()
+        _order(farmer)
+        _order(farmer)
+        db_client.post('/login', data={'email': 'agricoltore@example.com', 'password': 'pw'})
+        g.pop('_login_user', None)
+        db_client.get('/faq')
+        g.pop('_login_user', None)
+        with count_queries() as q:
+            resp = db_client.get('/faq')
+        assert 'id="pendingBadge">2</span>' in resp.get_data(as_text=True)
+        assert not [s for s in q.statements if 'order_request' in s]
+
+    def test_reconcile_fixes_drift(self, db_app):
+        farmer = _farmer()
+        _order(farmer)
+        _order(farmer)
+        db.session.execute(db.text('UPDATE "user" SET pending_orders_count = 7'))
+        db.session.commit()
+        assert reconcile_pending_counts() == 1
+        assert _count(farmer) == 2
+        assert reconcile_pending_counts() == 0
+
+
+class TestBulkTransition:
+
+    def test_single_update_with_outcomes(self, db_app, count_queries):
+        farmer, other = _farmer(), _farmer('altro')
+        pending = [_order(farmer) for _ in range(200)]
+        done = _order(farmer, status='completed')
+        foreign = _order(other)
+        ids = [o.id for o in pending] + [done.id, foreign.id, 99999]
+        with count_queries() as q:
+            rows, outcomes = bulk_transition(farmer.id, 'accept', ids)
+        assert len([s for s in q.statements if s.startswith('UPDATE order_request')]) == 1
+        db.session.commit()
+        assert len(rows) == 200
+        assert outcomes[pending[0].id] == {'outcome': 'updated', 'status': 'confirmed'}
+        assert outcomes[done.id] == {'outcome': 'invalid_status', 'status': 'completed'}
+        assert outcomes[foreign.id]['outcome'] == outcomes[99999]['outcome'] == 'not_found'
+        assert pending[0].status == 'confirmed'
+        assert _count(farmer) == 0 and _count(other) == 1
+
+    def test_complete_by_date_range(self, db_app):
+        farmer = _farmer()
+        day = datetime(2024, 6, 1, 8, 0)
+        market = [_order(farmer, status='confirmed', created_at=day + timedelta(hours=h)) for h in range(3)]
+        later = _order(farmer, status='confirmed', created_at=day + timedelta(days=1))
+        waiting = _order(farmer, created_at=day)
+        rows, _ = bulk_transition(farmer.id, 'complete', date_from=day.replace(hour=0),
+                                  date_to=day.replace(hour=0) + timedelta(days=1))
+        db.session.commit()
+        assert sorted(r.id for r in rows) == [o.id for o in market]
+        assert all(o.status == 'completed' and o.completed_at for o in market)
+        assert later.status == 'confirmed' and waiting.status == 'pending'
+
+    def test_bulk_route_notifies_and_reports(self, db_client):
+        farmer = _farmer()
+        client = User(username='cliente', email='cliente@example.com')
+        client.set_password('pw')
+        db.session.add(client)
+        db.session.commit()
+        orders = [_order(farmer, client_id=client.id) for _ in range(3)]
+        db_client.post('/login', data={'email': 'agricoltore@example.com', 'password': 'pw'})
+        g.pop('_login_user', None)
+        resp = db_client.post('/orders/bulk', headers={'Accept': 'application/json'},
+                              data={'action': 'reject', 'order_ids': [str(o.id) for o in orders[:2]]})
+        assert resp.get_json()['updated'] == 2
+        g.pop('_login_user', None)
+        resp = db_client.post('/orders/bulk', headers={'Accept': 'application/json'},
+                              data={'action': 'reject', 'order_ids': [str(orders[0].id)]})
+        assert resp.get_json()['orders'] == {str(orders[0].id): {'outcome': 'invalid_status', 'status': 'rejected'}}
+        assert Message.query.filter_by(recipient_id=client.id).count() == 2
+        assert OutboxMessage.query.count() == 2
+        g.pop('_login_user', None)
+        assert db_client.post('/orders/bulk', headers={'Accept': 'application/json'},
+                              data={'action': 'reject'}).status_code == 400
+
+
+class TestOrderItems:
+
+    def test_create_order_writes_items(self, db_client):
+        farmer = _farmer()
+        client = User(username='cliente', email='cliente@example.com')
+        client.set_password('pw')
+        olio = Product(name='Olio', price=9.0, unit='l', user_id=farmer.id)
+        db.session.add_all([client, olio])
+        db.session.commit()
+        db_client.post('/login', data={'email': 'cliente@example.com', 'password': 'pw'})
+        g.pop('_login_user', None)
+        db_client.post(f'/cart/add/{olio.id}', data={'qty': '3'})
+        g.pop('_login_user', None)
+        db_client.post(f'/orders/create/{farmer.id}', data={'email': 'cliente@example.com'})
+        item = OrderItem.query.one()
+        assert (item.product_id, item.name, item.unit, item.price, item.qty) == (olio.id, 'Olio', 'l', 9.0, 3)
+        assert item.order.total_price == 27.0
+        g.pop('_login_user', None)
+        page = db_client.get('/my-client-orders').get_data(as_text=True)
+        assert 'Olio x3 l' in page
+
+    def test_backfill_from_items_json(self, db_app):
+        farmer = _farmer()
+        olio = Product(name='Olio', price=9.0, unit='l', user_id=farmer.id)
+        db.session.add(olio)
+        db.session.commit()
+        for qty in (1, 2, 3):
+            _order(farmer, items_json=json.dumps({str(olio.id): {'name': 'Olio', 'unit': 'l', 'price': 9.0, 'qty': qty}}))
+        # Prodotto non più esistente e JSON rovinato
+        _order(farmer, items_json=json.dumps({'999': {'name': 'Miele', 'unit': 'kg', 'price': 12, 'qty': 1}}))
+        _order(farmer, items_json='non json')
+        _order(farmer, items_json='{}')
+        logged = []
+        assert backfill_order_items(chunk_size=2, log=logged.append) == (4, 4, 1)
+        assert len(logged) == 4 and "'non json'" in logged[2]
+        assert OrderItem.query.filter_by(product_id=None).one().name == 'Miele'
+        # Rilanciato non duplica; il JSON rovinato resta com'era
+        assert backfill_order_items(log=logged.append) == (0, 0, 1)
+        assert OrderRequest.query.filter(~OrderRequest.items.any()).count() == 2
+        assert OrderRequest.query.filter_by(items_json='non json').count() == 1
@@ -0,0 +1,81 @@
+"""
+Test dell'outbox delle notifiche e del worker che la svuota
+"""
+
+import json
+from datetime import datetime, timedelta
+from flask import g
+from app import db, outbox
+from app.models import User, Product, OrderRequest, OutboxMessage, Message
+
+
+def _shop():
+    farmer = User(username='agricoltore', email='a@example.com', is_farmer=True, company_name='Orto Bello')
+    farmer.set_password('pw')
+    db.session.add(farmer)
+    db.session.commit()
+    product = Product(name='Olio', price=9.0, unit='l', user_id=farmer.id)
+    db.session.add(product)
+    db.session.commit()
+    return farmer, product
+
+
+class TestOutbox:
+
+    def test_order_request_enqueues_without_sending(self, db_client, monkeypatch):
+        sent = []
+        monkeypatch.setattr(outbox, 'send_many', lambda messages, **kw: [sent.append(m) or True for m in messages])
+        farmer, product = _shop()
+        db_client.post(f'/cart/add/{product.id}', data={'qty': '2'})
+        resp = db_client.post(f'/orders/create/{farmer.id}', data={'email': 'cliente@example.com'})
+        assert resp.status_code == 302
+        assert sent == []
+        queued = OutboxMessage.query.order_by(OutboxMessage.id).all()
+        assert [json.loads(m.payload)['to'] for m in queued] == ['a@example.com', 'cliente@example.com']
+        assert OrderRequest.query.count() == 1
+
+        assert outbox.drain() == 2
+        assert [a[0] for a in sent] == ['a@example.com', 'cliente@example.com']
+        assert {m.status for m in OutboxMessage.query.all()} == {'sent'}
+        assert outbox.drain() == 0
+
+    def test_accept_flow_commits_message_and_email_together(self, db_client):
+        farmer, _ = _shop()
+        client = User(username='cliente', email='c@example.com')
+        client.set_password('pw')
+        db.session.add(client)
+        db.session.commit()
+        order = OrderRequest(farmer_id=farmer.id, client_id=client.id, client_email='c@example.com',
+                             items_json='{}', total_price=9.0)
+        db.session.add(order)
+        db.session.commit()
+        db_client.post('/login', data={'email': 'a@example.com', 'password': 'pw'})
+        g.pop('_login_user', None)
+        db_client.post(f'/orders/accept/{order.id}')
+        assert Message.query.filter_by(recipient_id=client.id).count() == 1
+        msg = OutboxMessage.query.one()
+        assert json.loads(msg.payload)['subject'] == 'Ordine confermato'
+
+    def test_failures_are_retried_with_backoff(self, db_app, monkeypatch):
+        monkeypatch.setattr(outbox, 'send_many', lambda messages, **kw: [False] * len(messages))
+        outbox.enqueue_email('x@example.com', 'Oggetto', '<p>ciao</p>')
+        db.session.commit()
+        assert outbox.drain() == 1
+        msg = OutboxMessage.query.one()
+        assert (msg.status, msg.attempts) == ('pending', 1)
+        assert msg.available_at > datetime.utcnow() + timedelta(seconds=outbox.BACKOFF_BASE - 5)
+        # Non ancora scaduto: il worker non lo riprende subito
+        assert outbox.drain() == 0
+
+        msg.attempts = outbox.MAX_ATTEMPTS - 1
+        msg.available_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        logged = []
+        assert outbox.drain(log=logged.append) == 1
+        assert OutboxMessage.query.one().status == 'failed'
+        assert logged
+
+    def test_backoff_is_capped(self):
+        assert outbox.backoff(1) == outbox.BACKOFF_BASE
+        assert outbox.backoff(3) == outbox.BACKOFF_BASE * 4
+        assert outbox.backoff(50) == outbox.BACKOFF_MAX
@@ -0,0 +1,85 @@
+"""
+Test dell'identità in cache usata dal user_loader di Flask-Login
+"""
+
+from flask import g
+from app import db
+from app.models import User
+from app.principal import load_principal, CachedPrincipal, _principal_cache
+
+
+def _login(client, name='cliente', **fields):
+    u = User(username=name, email=f'{name}@example.com', bio='Testo lungo', **fields)
+    u.set_password('pw')
+    db.session.add(u)
+    db.session.commit()
+    client.post('/login', data={'email': f'{name}@example.com', 'password': 'pw'})
+    return u
+
+
+def _get(client, url):
+    # Il test tiene aperto l'app context: senza questo g conserverebbe l'utente della richiesta precedente
+    g.pop('_login_user', None)
+    return client.get(url)
+
+
+def _user_queries(statements):
+    return [s for s in statements if 'FROM "user"' in s or 'FROM user' in s]
+
+
+class TestCachedPrincipal:
+
+    def test_no_user_query_when_cached(self, db_client, count_queries):
+        _login(db_client)
+        with count_queries() as q:
+            _get(db_client, '/faq')
+        assert len(_user_queries(q.statements)) == 1
+        with count_queries() as q:
+            resp = _get(db_client, '/faq')
+        assert resp.status_code == 200
+        assert _user_queries(q.statements) == []
+
+    def test_lazy_fallback_and_writes(self, db_app):
+        u = _login(db_app.test_client())
+        principal = load_principal(u.id)
+        assert isinstance(principal, CachedPrincipal)
+        assert principal.get_id() == str(u.id) and principal.username == 'cliente'
+        # Campo non in cache: carica l'User completo
+        assert principal.bio == 'Testo lungo'
+        assert principal.check_password('pw')
+        principal.display_name = 'Nuovo nome'
+        db.session.commit()
+        assert load_principal(u.id).display_name == 'Nuovo nome'
+        assert load_principal(12345) is None
+
+    def test_invalidated_on_profile_edit_and_logout(self, db_client):
+        u = _login(db_client, 'agricoltore', is_farmer=True, company_name='Vecchio', province='Oristano',
+                   city='Cabras')
+        _get(db_client, '/faq')
+        assert _principal_cache.get(u.id)['company_name'] == 'Vecchio'
+        g.pop('_login_user', None)
+        db_client.post('/profile', data={'username': 'agricoltore', 'company_name': 'Nuovo nome',
+                                         'province': 'Oristano', 'city': 'Cabras'})
+        assert _principal_cache.get(u.id) is None
+        _get(db_client, '/faq')
+        assert _principal_cache.get(u.id)['company_name'] == 'Nuovo nome'
+
+        _get(db_client, '/logout')
+        assert _principal_cache.get(u.id) is None
+
+    def test_forgotten_after_commit_not_at_flush(self, db_app):
+        u = _login(db_app.test_client(), 'agricoltore', is_farmer=True, company_name='Vecchio')
+        old = dict(load_principal(u.id).__dict__)
+        old.pop('_user')
+        u.company_name = 'Nuovo nome'
+        db.session.flush()
+        # Un'altra richiesta tra flush e commit legge ancora il valore vecchio e lo mette in cache
+        _principal_cache.set(u.id, old)
+        db.session.commit()
+        assert _principal_cache.get(u.id) is None
+        assert load_principal(u.id).company_name == 'Nuovo nome'
+
+        u.company_name = 'Annullato'
+        db.session.flush()
+        db.session.rollback()
+        assert load_principal(u.id).company_name == 'Nuovo nome'
@@ -0,0 +1,165 @@
+"""
+Test della lista prodotti: ordinamento per distanza e paginazione
+"""
+
+import re
+from app import db
+from app.models import User, Product
+from app.geo import haversine_km
+
+ORISTANO = (39.9062, 8.5884)
+
+
+def _seed_farmers(spec):
+    """spec: lista di (username, lat, lng, n_prodotti)"""
+    farmers = []
+    for name, lat, lng, n in spec:
+        farmer = User(username=name, email=f'{name}@example.com', is_farmer=True,
+                      company_name=name.capitalize(), company_slug=name,
+                      latitude=lat, longitude=lng)
+        farmer.set_password('x')
+        db.session.add(farmer)
+        db.session.flush()
+        for j in range(n):
+            db.session.add(Product(name=f'{name}-{j}', price=2.0, unit='kg', category='verdura', user_id=farmer.id))
+        farmers.append(farmer)
+    db.session.commit()
+    return farmers
+
+
+class TestProximitySort:
+
+    SPEC = [
+        ('sassari', 40.7259, 8.5557, 5),
+        ('cabras', 39.9333, 8.5333, 7),
+        ('nuoro', 40.3210, 9.3297, 9),
+        ('senzacoord', None, None, 3),
+        ('milis', 39.9500, 8.6333, 4),
+    ]
+
+    def _expected_order(self):
+        with_coords = [s for s in self.SPEC if s[1] is not None]
+        dist = {s[0]: float(haversine_km(ORISTANO[0], ORISTANO[1], [s[1]], [s[2]])[0]) for s in with_coords}
+        names = []
+        for s in sorted(with_coords, key=lambda s: dist[s[0]]):
+            names += [f'{s[0]}-{j}' for j in range(s[3])]
+        names += [f'senzacoord-{j}' for j in range(3)]
+        return names
+
+    def test_pages_follow_farmer_distance(self, db_app):
+        from app.products import _proximity_page
+        _seed_farmers(self.SPEC)
+        expected = self._expected_order()
+
+        seen = []
+        page = 1
+        while True:
+            rows, total = _proximity_page(ORISTANO[0], ORISTANO[1], '', '', '', page, 5)
+            if not rows:
+                break
+            seen += [r['name'] for r in rows]
+            page += 1
+        assert total == len(expected)
+        assert seen == expected
+
+    def test_distance_shown_on_cards(self, db_client):
+        _seed_farmers(self.SPEC)
+        resp = db_client.get(f'/products?sort=distance&lat={ORISTANO[0]}&lng={ORISTANO[1]}')
+        html = resp.get_data(as_text=True)
+        assert resp.status_code == 200
+        assert ' km</span>' in html
+        assert html.index('cabras-0') < html.index('milis-0')
+
+    def test_category_filter_respected(self, db_app):
+        from app.products import _proximity_page
+        farmers = _seed_farmers(self.SPEC)
+        db.session.add(Product(name='vino-sassari', price=9.0, unit='bottiglia', category='vino', user_id=farmers[0].id))
+        db.session.commit()
+        rows, total = _proximity_page(ORISTANO[0], ORISTANO[1], '', '', 'vino', 1, 12)
+        assert total == 1
+        assert [r['name'] for r in rows] == ['vino-sassari']
+
+    def test_counts_follow_farmer_changes(self, db_app):
+        from app.products import _proximity_page
+        farmers = _seed_farmers(self.SPEC)
+        assert _proximity_page(ORISTANO[0], ORISTANO[1], 'Oristano', '', '', 1, 12)[1] == 0
+        # Località e stato dell'azienda cambiano senza toccare i prodotti
+        farmers[1].province = 'Oristano'
+        db.session.commit()
+        rows, total = _proximity_page(ORISTANO[0], ORISTANO[1], 'Oristano', '', '', 1, 12)
+        assert total == 7 and rows[0]['name'] == 'cabras-0'
+        farmers[1].is_farmer = False
+        db.session.commit()
+        assert _proximity_page(ORISTANO[0], ORISTANO[1], 'Oristano', '', '', 1, 12)[1] == 0
+
+
+class TestKeysetPagination:
+
+    def _walk(self, query, sort_col, key_fn, per_page):
+        from app.pagination import keyset_paginate
+        pages = []
+        result = keyset_paginate(query, sort_col, Product.id, key_fn, per_page)
+        pages.append(result)
+        while result.next_cursor:
+            result = keyset_paginate(query, sort_col, Product.id, key_fn, per_page, cursor=result.next_cursor)
+            pages.append(result)
+        return pages
+
+    def test_cursor_walk_matches_full_ordering(self, db_app):
+        from app.pagination import keyset_paginate
+        _seed_farmers([('a', None, None, 9), ('b', None, None, 8)])
+        # Nomi duplicati per verificare lo spareggio su id
+        db.session.add(Product(name='a-1', price=1.0, unit='kg', user_id=1))
+        db.session.commit()
+
+        query = Product.query
+        key_fn = lambda p: (p.name, p.id)
+        expected = [p.id for p in query.order_by(Product.name, Product.id).all()]
+        pages = self._walk(query, Product.name, key_fn, 4)
+        assert [p.id for page in pages for p in page.rows] == expected
+        assert [page.page for page in pages] == list(range(1, len(pages) + 1))
+
+        # A ritroso con i cursori "prev" si riottengono le stesse pagine
+        back = keyset_paginate(query, Product.name, Product.id, key_fn, 4, cursor=pages[-1].prev_cursor)
+        assert [p.id for p in back.rows] == [p.id for p in pages[-2].rows]
+
+        # ?page=N e cursore danno la stessa pagina
+        by_offset = keyset_paginate(query, Product.name, Product.id, key_fn, 4, page=3)
+        assert [p.id for p in by_offset.rows] == [p.id for p in pages[2].rows]
+
+    def test_invalid_cursor_falls_back_to_first_page(self, db_app):
+        from app.pagination import keyset_paginate, encode_cursor, decode_cursor
+        _seed_farmers([('a', None, None, 3)])
+        result = keyset_paginate(Product.query, Product.name, Product.id, lambda p: (p.name, p.id), 2, cursor='!!nonvalido')
+        assert result.page == 1
+        assert len(result.rows) == 2
+        for bad in ({'a': 1}, [1, 2], None, True):
+            cursor = encode_cursor(bad, 1, 'n', 2)
+            assert decode_cursor(cursor) is None
+            result = keyset_paginate(Product.query, Product.name, Product.id, lambda p: (p.name, p.id), 2, cursor=cursor)
+            assert result.page == 1
+
+    def test_companies_cursor_with_empty_company_names(self, db_client):
+        # Profili importati con company_name '': ordinati per username come nella chiave del cursore
+        for i in range(30):
+            u = User(username=f'u{i:02d}', email=f'u{i}@example.com', is_farmer=True,
+                     company_name='' if i % 2 else f'm{i:02d}')
+            u.set_password('x')
+            db.session.add(u)
+        db.session.commit()
+        seen, url = [], '/companies'
+        while url:
+            html = db_client.get(url).get_data(as_text=True)
+            seen += re.findall(r'<h6 class="m-0">(.*?)</h6>', html)
+            link = re.search(r'href="([^"]*cursor=[^"]*)">\s*Successivo', html)
+            url = link.group(1).replace('&amp;', '&') if link else None
+        assert seen == sorted(f'u{i:02d}' if i % 2 else f'm{i:02d}' for i in range(30))
+
+    def test_listing_pages_render_cursor_links(self, db_client):
+        from app.pagination import encode_cursor
+        _seed_farmers([('a', None, None, 30)])
+        html = db_client.get('/products').get_data(as_text=True)
+        assert 'cursor=' in html
+        assert db_client.get('/products?page=2').status_code == 200
+        assert db_client.get('/companies?page=1').status_code == 200
+        assert db_client.get('/products?cursor=' + encode_cursor({'x': 1}, 1, 'n', 2)).status_code == 200
@@ -0,0 +1,192 @@
+"""
+Piani delle query: le pagine principali di ogni blueprint, eseguite su dati di prova,
+non devono leggere per intero le tabelle grandi (EXPLAIN su ogni statement eseguito)
+"""
+
+import os
+import random
+import re
+from datetime import datetime, timedelta
+from flask import g
+from sqlalchemy import event, insert, text
+from werkzeug.security import generate_password_hash
+from app import db, conversations, events, pagination, ratings
+from app.models import User, Product, OrderRequest, OrderItem, Message, Review
+from app.geo import farmer_index
+from app.facets import facet_index
+from app.claims import claim_index
+
+MIGRATION = os.path.join(os.path.dirname(__file__), '..', 'migrations', 'add_hot_path_indexes.sql')
+
+# Tabelle che in produzione crescono con gli utenti: qui una lettura completa è un errore
+LARGE_TABLES = {'user', 'product', 'order_request', 'order_item', 'message', 'review', 'conversation'}
+
+PROVINCES = [f'Provincia {i}' for i in range(20)]
+CATEGORIES = ['frutta', 'verdura', 'vino', 'olio', 'latticini', 'altro']
+STATUSES = ['pending', 'confirmed', 'completed', 'cancelled']
+
+
+def _seed(farmers=500, clients=2000, products=8000, orders=20000, messages=20000, reviews=4000):
+    """Dati di prova inseriti in blocco; ritorna un agricoltore e un cliente con ordini e messaggi tra loro"""
+    rnd = random.Random(0)
+    password = generate_password_hash('pw')
+    start = datetime(2024, 1, 1)
+    users = []
+    for i in range(farmers):
+        province = rnd.choice(PROVINCES)
+        users.append({'username': f'azienda{i}', 'email': f'azienda{i}@example.com', 'password_hash': password,
+                      'is_farmer': True, 'province': province, 'city': f'{province} comune {i % 5}',
+                      'company_name': f'Azienda {i}', 'company_slug': f'azienda-{i}',
+                      'latitude': 39 + rnd.random(), 'longitude': 8 + rnd.random()})
+    for i in range(clients):
+        users.append({'username': f'cliente{i}', 'email': f'cliente{i}@example.com', 'password_hash': password,
+                      'is_farmer': False, 'verification_token': f'verifica-{i}'})
+    db.session.execute(insert(User), users)
+    farmer_ids = list(range(1, farmers + 1))
+    client_ids = list(range(farmers + 1, farmers + clients + 1))
+
+    db.session.execute(insert(Product), [
+        {'name': f'Prodotto {i}', 'price': 2.5, 'unit': 'kg', 'category': rnd.choice(CATEGORIES),
+         'user_id': rnd.choice(farmer_ids)} for i in range(products)])
+    db.session.execute(insert(OrderRequest), [
+        {'farmer_id': rnd.choice(farmer_ids), 'client_id': rnd.choice(client_ids), 'items_json': '{}',
+         'total_price': 10.0, 'status': rnd.choice(STATUSES), 'created_at': start + timedelta(minutes=i)}
+        for i in range(orders)])
+    db.session.execute(insert(OrderItem), [
+        {'order_id': i, 'product_id': rnd.randint(1, products), 'name': 'Prodotto', 'price': 2.5, 'qty': 4}
+        for i in range(1, orders + 1)])
+    pairs = [(rnd.choice(client_ids), rnd.choice(farmer_ids)) for _ in range(messages)]
+    db.session.execute(insert(Message), [
+        {'sender_id': pair[i % 2], 'recipient_id': pair[1 - i % 2], 'content': f'Messaggio {i}',
+         'read': rnd.random() < 0.7, 'timestamp': start + timedelta(minutes=i)} for i, pair in enumerate(pairs)])
+    db.session.execute(insert(Review), [
+        {'farmer_id': rnd.choice(farmer_ids), 'client_id': rnd.choice(client_ids), 'rating': rnd.randint(1, 5),
+         'comment': 'Ottimo', 'created_at': start + timedelta(hours=i)} for i in range(reviews)])
+
+    # Una coppia con una storia in comune, per le pagine di ordini e conversazione
+    farmer, client = farmer_ids[0], client_ids[0]
+    db.session.execute(insert(OrderRequest), [
+        {'farmer_id': farmer, 'client_id': client, 'items_json': '{}', 'status': 'pending',
+         'created_at': start + timedelta(days=i)} for i in range(5)])
+    db.session.execute(insert(Message), [
+        {'sender_id': (farmer, client)[i % 2], 'recipient_id': (client, farmer)[i % 2], 'content': f'Ciao {i}',
+         'read': False, 'timestamp': start + timedelta(days=400, minutes=i)} for i in range(80)])
+    db.session.commit()
+    conversations.rebuild()
+    ratings.rebuild()
+    db.session.execute(text('ANALYZE'))
+    db.session.commit()
+    return db.session.get(User, farmer), db.session.get(User, client)
+
+
+def full_scans(conn, statement, parameters):
+    """Tabelle grandi lette per intero nel piano di `statement`"""
+    if conn.dialect.name == 'postgresql':
+        plan = conn.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+        found, nodes = set(), [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in LARGE_TABLES:
+                found.add(node['Relation Name'])
+            nodes.extend(node.get('Plans', ()))
+        return found
+    # SQLite: "SCAN tabella" senza indice; "SCAN tabella USING INDEX" legge l'indice nell'ordine richiesto
+    rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+    found = set()
+    for row in rows:
+        match = re.fullmatch(r'SCAN (\w+)', row[-1])
+        if match and match.group(1) in LARGE_TABLES:
+            found.add(match.group(1))
+    return found
+
+
+class StatementLog:
+    """Statement eseguiti sull'engine con i loro parametri, uno per testo SQL"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = {}
+        self.url = None
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'WITH')):
+            self.statements.setdefault(statement, (parameters, self.url))
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+
+class TestQueryPlans:
+
+    def _visit(self, client, log, user, urls):
+        if user is not None:
+            client.post('/login', data={'email': user.email, 'password': 'pw'})
+        for url in urls:
+            # Stringa per le GET, (url, dati del form) per le POST
+            url, data = url if isinstance(url, tuple) else (url, None)
+            g.pop('_login_user', None)
+            log.url = url
+            resp = client.post(url, data=data) if data else client.get(url)
+            assert resp.status_code < 500, url
+        g.pop('_login_user', None)
+        client.get('/logout')
+
+    def test_hot_paths_use_indexes(self, db_client):
+        farmer, client = _seed()
+        province, city = farmer.province, farmer.city
+        # Indici in memoria costruiti una volta per processo: non fanno parte delle pagine
+        farmer_index.ensure()
+        facet_index.ensure()
+        claim_index.ensure()
+        pagination._count_cache.clear()
+        order = OrderRequest.query.filter_by(farmer_id=farmer.id, client_id=client.id).first()
+        thread = [m.id for m in conversations.history(farmer.id, client.id)[0]]
+
+        pages = {
+            None: [
+                '/', f'/?province={province}',
+                '/products', f'/products?province={province}', f'/products?province={province}&city={city}',
+                '/products?category=verdura', '/products?sort=distance&lat=39.5&lng=8.5',
+                f'/api/cities?province={province}', '/api/farmers.geojson?bbox=8.2,39.2,8.4,39.4',
+                '/companies', f'/companies?province={province}', f'/c/{farmer.company_slug}',
+                f'/u/{farmer.username}', f'/farmer/{farmer.id}/reviews',
+                '/verify/verifica-7', '/reset-password/sconosciuto',
+            ],
+            farmer: [
+                '/my-orders', '/my-orders/export?status=pending', '/dashboard', '/messages',
+                f'/conversation/{client.id}', f'/conversation/{client.id}/earlier?before={thread[0]}',
+                f'/conversation/{client.id}/since?after={thread[-5]}',
+                ('/orders/bulk', {'action': 'accept', 'order_ids': [str(order.id)]}),
+            ],
+            client: ['/my-client-orders', '/messages'],
+        }
+        with StatementLog(db.engine) as log:
+            for user, urls in pages.items():
+                self._visit(db_client, log, user, urls)
+            log.url = 'badge'
+            with db_client.application.app_context():
+                events.badge_counts(farmer.id)
+
+        failures = []
+        with db.engine.connect() as conn:
+            for statement, (parameters, url) in log.statements.items():
+                scans = full_scans(conn, statement, parameters)
+                if scans:
+                    failures.append(f"{url}: {', '.join(sorted(scans))}\n{statement}")
+        assert len(log.statements) > 30
+        assert not failures, '\n\n'.join(failures)
+
+
+class TestIndexMigration:
+
+    def test_migration_matches_models(self):
+        with open(MIGRATION) as f:
+            created = set(re.findall(r'CREATE INDEX CONCURRENTLY IF NOT EXISTS (\w+) ON "?(\w+)"?', f.read()))
+        declared = {(index.name, model.__tablename__)
+                    for model in (User, Product, OrderRequest, Message, Review)
+                    for index in model.__table__.indexes}
+        assert created == declared
@@ -0,0 +1,135 @@
+"""
+Test delle recensioni: riepilogo delle valutazioni per azienda e API a pagine con ETag
+"""
+
+from flask import g
+from app import db, ratings
+from app.models import User, OrderRequest, Review, RatingSummary
+
+
+def _user(name, farmer=False):
+    u = User(username=name, email=f'{name}@example.com', is_farmer=farmer)
+    if farmer:
+        u.company_slug = name
+    u.set_password('pw')
+    db.session.add(u)
+    db.session.commit()
+    return u
+
+
+def _login(client, user):
+    client.post('/login', data={'email': user.email, 'password': 'pw'})
+    g.pop('_login_user', None)
+
+
+def _reviews(farmer, ratings_):
+    db.session.add_all([Review(farmer_id=farmer.id, client_name=f'cliente{i}', rating=r, comment=f'Commento {i}')
+                        for i, r in enumerate(ratings_)])
+    db.session.commit()
+
+
+def _stats(farmer_id):
+    s = ratings.summary(farmer_id)
+    return s.review_count, s.rating_sum, s.histogram(), s.average
+
+
+class TestRatingSummary:
+
+    def test_updated_by_submit_review(self, db_client):
+        farmer, client = _user('agricoltore', True), _user('cliente')
+        orders = [OrderRequest(farmer_id=farmer.id, client_id=client.id, items_json='{}', status='completed')
+                  for _ in range(2)]
+        db.session.add_all(orders)
+        db.session.commit()
+        _login(db_client, client)
+        for order, rating in zip(orders, (5, 3)):
+            resp = db_client.post(f'/submit-review/{farmer.id}', data={'rating': rating, 'order_id': order.id})
+            assert resp.get_json()['success']
+            g.pop('_login_user', None)
+        # Ordine già recensito: il riepilogo non cambia
+        assert db_client.post(f'/submit-review/{farmer.id}',
+                              data={'rating': 1, 'order_id': orders[0].id}).status_code == 400
+
+        db.session.expire_all()
+        assert _stats(farmer.id) == (2, 8, [0, 0, 1, 0, 1], 4.0)
+        assert ratings.rebuild() == 1
+        assert _stats(farmer.id) == (2, 8, [0, 0, 1, 0, 1], 4.0)
+
+    def test_aggregate_fallback_matches_summary(self, db_app, monkeypatch):
+        farmer, other = _user('agricoltore', True), _user('altra', True)
+        _reviews(farmer, [5, 4, 4, 1])
+        _reviews(other, [2])
+        summary = _stats(farmer.id)
+        assert summary == (4, 14, [1, 0, 0, 2, 1], 3.5)
+        monkeypatch.setattr(ratings, 'summary_ready', lambda bind: False)
+        assert _stats(farmer.id) == summary
+        assert _stats(_user('nuova', True).id) == (0, 0, [0, 0, 0, 0, 0], 0)
+
+    def test_follows_edits_and_deletions(self, db_app):
+        farmer, other = _user('agricoltore', True), _user('altra', True)
+        _reviews(farmer, [5, 4, 2])
+        first, second, third = Review.query.order_by(Review.id).all()
+        first.rating = 1
+        second.farmer_id = other.id
+        db.session.delete(third)
+        db.session.commit()
+        assert _stats(farmer.id) == (1, 1, [1, 0, 0, 0, 0], 1.0)
+        assert _stats(other.id) == (1, 4, [0, 0, 0, 1, 0], 4.0)
+        incremental = (_stats(farmer.id), _stats(other.id))
+        ratings.rebuild()
+        assert (_stats(farmer.id), _stats(other.id)) == incremental
+
+    def test_backfilled_when_created_on_existing_database(self, db_app):
+        farmer = _user('agricoltore', True)
+        _reviews(farmer, [5, 3])
+        # Database precedente alla migrazione: create_all crea il riepilogo e lo riempie dalle recensioni
+        RatingSummary.__table__.drop(db.engine)
+        db.create_all()
+        assert _stats(farmer.id) == (2, 8, [0, 0, 1, 0, 1], 4.0)
+
+
+class TestReviewsApi:
+
+    def test_pages_and_etag(self, db_client, count_queries):
+        farmer = _user('agricoltore', True)
+        _reviews(farmer, [(i % 5) + 1 for i in range(25)])
+        data = db_client.get(f'/farmer/{farmer.id}/reviews').get_json()
+        assert (data['total'], data['avg_rating'], data['histogram']) == (25, 3.0, [5, 5, 5, 5, 5])
+        seen = [r['id'] for r in data['reviews']]
+        while data['has_more']:
+            data = db_client.get(f'/farmer/{farmer.id}/reviews?before={seen[-1]}').get_json()
+            seen += [r['id'] for r in data['reviews']]
+        assert len(data['reviews']) == 5
+        assert seen == [r.id for r in Review.query.order_by(Review.created_at.desc(), Review.id.desc())]
+
+        first = db_client.get(f'/farmer/{farmer.id}/reviews')
+        etag = first.headers['ETag']
+        with count_queries() as q:
+            resp = db_client.get(f'/farmer/{farmer.id}/reviews', headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+        assert not [s for s in q.statements if 'FROM review' in s]
+
+        # Commento modificato: stesso numero di recensioni, ETag diverso
+        review = Review.query.order_by(Review.id.desc()).first()
+        review.comment = 'Aggiornato'
+        db.session.commit()
+        resp = db_client.get(f'/farmer/{farmer.id}/reviews', headers={'If-None-Match': etag})
+        assert resp.status_code == 200 and resp.headers['ETag'] != etag
+        assert resp.get_json()['reviews'][0]['comment'] == 'Aggiornato'
+
+        etag = resp.headers['ETag']
+        _reviews(farmer, [5])
+        resp = db_client.get(f'/farmer/{farmer.id}/reviews', headers={'If-None-Match': etag})
+        assert resp.status_code == 200 and resp.headers['ETag'] != etag
+        assert resp.get_json()['reviews'][0]['rating'] == 5
+
+    def test_profile_shows_average_without_loading_reviews(self, db_client, count_queries):
+        farmer = _user('agricoltore', True)
+        _reviews(farmer, [5, 4, 4])
+        db_client.get('/faq')
+        with count_queries() as q:
+            page = db_client.get(f'/c/{farmer.company_slug}').get_data(as_text=True)
+        assert '4.3 <i class="fas fa-star text-warning"></i>' in page and '3 recensioni' in page
+        assert 'id="reviewList"' in page
+        assert not [s for s in q.statements if 'FROM review' in s]
+        assert db.session.get(RatingSummary, farmer.id).last_review_id == Review.query.count()
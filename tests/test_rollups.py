@@ -0,0 +1,106 @@
+"""
+Test dei riepiloghi vendite: aggiornamento incrementale, ricostruzione e dashboard
+"""
+
+import json
+from datetime import datetime, timedelta
+from flask import g
+from app import db, rollups
+from app.models import User, Product, OrderRequest, OrderItem, SalesDaily, ProductSalesDaily
+from app.orders import bulk_transition
+
+
+def _farmer(name='agricoltore'):
+    u = User(username=name, email=f'{name}@example.com', is_farmer=True, company_name=name.title())
+    u.set_password('pw')
+    db.session.add(u)
+    db.session.commit()
+    return u
+
+
+def _order(farmer, lines, status='pending', created_at=None):
+    order = OrderRequest(farmer_id=farmer.id, status=status, items_json=json.dumps({}),
+                         total_price=sum(price * qty for _, price, qty in lines),
+                         created_at=created_at or datetime.utcnow())
+    order.items = [OrderItem(product_id=p.id if p else None, name=p.name if p else 'Eliminato', price=price, qty=qty)
+                   for p, price, qty in lines]
+    db.session.add(order)
+    db.session.commit()
+    return order
+
+
+def _snapshot():
+    sales = {(r.farmer_id, r.day, r.status): (r.orders, round(r.revenue, 2))
+             for r in SalesDaily.query.all() if r.orders}
+    products = {(r.farmer_id, r.day, r.product_id): (r.qty, round(r.revenue, 2))
+                for r in ProductSalesDaily.query.all() if r.qty}
+    return sales, products
+
+
+class TestSalesRollups:
+
+    def test_incremental_matches_rebuild(self, db_app):
+        farmer, other = _farmer(), _farmer('altro')
+        olio, miele = Product(name='Olio', user_id=farmer.id), Product(name='Miele', user_id=farmer.id)
+        db.session.add_all([olio, miele])
+        db.session.commit()
+        yesterday = datetime.utcnow() - timedelta(days=1)
+
+        a = _order(farmer, [(olio, 9.0, 2), (miele, 12.0, 1)])
+        b = _order(farmer, [(olio, 9.0, 1)], created_at=yesterday)
+        c = _order(farmer, [(miele, 12.0, 3)])
+        d = _order(farmer, [(None, 5.0, 2)], status='completed', created_at=yesterday)
+        e = _order(farmer, [(olio, 9.0, 4)])
+
+        a.status = 'confirmed'
+        db.session.commit()
+        bulk_transition(farmer.id, 'accept', [b.id, c.id])
+        db.session.commit()
+        bulk_transition(farmer.id, 'complete', [a.id, b.id])
+        db.session.commit()
+        c.status = 'rejected'
+        e.farmer_id = other.id
+        db.session.commit()
+        db.session.delete(d)
+        db.session.commit()
+        db.session.add(OrderItem(order_id=a.id, name='Miele', product_id=miele.id, price=12.0, qty=1))
+        db.session.commit()
+
+        incremental = _snapshot()
+        today = datetime.utcnow().date()
+        sales, products = incremental
+        assert sales[(farmer.id, today, 'completed')] == (1, 30.0)
+        assert sales[(farmer.id, today, 'rejected')] == (1, 36.0)
+        assert (farmer.id, today, 'confirmed') not in sales
+        assert products[(farmer.id, today, miele.id)] == (2, 24.0)
+        rollups.rebuild()
+        rebuilt = _snapshot()
+        assert incremental[1] == rebuilt[1]
+        assert incremental[0] == rebuilt[0]
+
+    def test_dashboard_reads_only_rollups(self, db_client, count_queries):
+        farmer = _farmer()
+        olio = Product(name='Olio extravergine', user_id=farmer.id)
+        db.session.add(olio)
+        db.session.commit()
+        _order(farmer, [(olio, 9.0, 3)], status='completed')
+        _order(farmer, [(olio, 9.0, 1)])
+        db_client.post('/login', data={'email': 'agricoltore@example.com', 'password': 'pw'})
+        g.pop('_login_user', None)
+        db_client.get('/faq')
+        g.pop('_login_user', None)
+        with count_queries() as q:
+            page = db_client.get('/dashboard').get_data(as_text=True)
+        assert 'Olio extravergine' in page and '27.00 €' in page
+        assert not [s for s in q.statements if 'order_request' in s or 'order_item' in s]
+
+    def test_dashboard_weeks(self, db_app):
+        farmer = _farmer()
+        today = datetime(2024, 6, 12)  # mercoledì
+        _order(farmer, [(None, 10.0, 1)], status='completed', created_at=today - timedelta(days=7))
+        _order(farmer, [(None, 5.0, 1)], status='confirmed', created_at=today)
+        _order(farmer, [(None, 99.0, 1)], status='rejected', created_at=today)
+        data = rollups.dashboard(farmer.id, weeks=4, today=today.date())
+        assert data['start'].isoformat() == '2024-05-20'
+        assert [w['revenue'] for w in data['weekly']] == [0, 0, 10.0, 5.0]
+        assert data['by_status']['rejected'] == {'orders': 1, 'revenue': 99.0}
@@ -0,0 +1,233 @@
+"""
+Test della ricerca full-text sui prodotti (normalizzazione, FTS5, indice in memoria)
+"""
+
+import random
+import time
+import pytest
+from sqlalchemy import create_engine, insert, text
+
+from app import db
+from app.models import User, Product
+from app import search
+from app.search import tokenize, query_terms, product_document, MemoryBackend, SqliteBackend
+
+
+class TestNormalization:
+
+    def test_accents_and_stemming(self):
+        assert tokenize('Caffè della Città') == ['caff', 'citt']
+        assert tokenize('Pomodori')[0] == tokenize('pomodoro')[0]
+        assert tokenize('arance')[0] == tokenize('Arancia')[0]
+        assert tokenize('pesche')[0] == tokenize('pesca')[0]
+        assert tokenize('formaggi')[0] == tokenize('formaggio')[0]
+
+    def test_short_stems_are_not_prefixes(self):
+        assert [search.is_prefix(['ol', 'vermen'], i) for i in range(2)] == [False, True]
+        assert not search.is_prefix(['pan'], 0)
+
+    def test_query_terms_deduplicated(self):
+        assert query_terms('olio olio di oliva') == ['ol', 'oliv']
+        assert query_terms('  di la  ') == []
+
+
+def _seed(index=True):
+    if index:
+        search.reindex()
+    farmer = User(username='sole', email='sole@example.com', is_farmer=True, company_name='Orto del Sole',
+                  province='Oristano', city='Cabras')
+    other = User(username='mare', email='mare@example.com', is_farmer=True, company_name='Cantina Mare',
+                 province='Sassari', city='Alghero')
+    for u in (farmer, other):
+        u.set_password('x')
+        db.session.add(u)
+    db.session.flush()
+    products = [
+        Product(name='Pomodoro cuore di bue', description='Maturato al sole', category='verdura', price=3.5, user_id=farmer.id),
+        Product(name='Passata', description='Fatta con i nostri pomodori', category='verdura', price=4.0, user_id=farmer.id),
+        Product(name='Vermentino', description='Vino bianco', category='vino', price=9.0, user_id=other.id),
+        Product(name='Caffè di cicoria', description='', category='altro', price=6.0, user_id=other.id),
+    ]
+    db.session.add_all(products)
+    db.session.commit()
+    return farmer, other, products
+
+
+class TestFts5Search:
+
+    def test_stemmed_ranked_results(self, db_app):
+        _, _, products = _seed()
+        hits, total = search.search_products('pomodori')
+        assert total == 2
+        # Il nome pesa più della descrizione
+        assert [pid for pid, _ in hits] == [products[0].id, products[1].id]
+
+        hits, _ = search.search_products('caffe')
+        assert [pid for pid, _ in hits] == [products[3].id]
+        # Prefisso (solo l'ultimo termine) e nome dell'azienda
+        assert search.search_products('cantina vermen')[1] == 1
+
+    def test_filters_and_pagination(self, db_app):
+        _seed()
+        assert search.search_products('pomodoro', province='Sassari')[1] == 0
+        first, total = search.search_products('sole', page=1, per_page=1)
+        second, _ = search.search_products('sole', page=2, per_page=1)
+        assert total == 2 and first[0][0] != second[0][0]
+
+    def test_index_follows_writes(self, db_app):
+        farmer, _, products = _seed()
+        products[2].name = 'Cannonau'
+        farmer.company_name = 'Fattoria Luna'
+        db.session.delete(products[3])
+        db.session.commit()
+        assert search.search_products('vermentino')[1] == 0
+        assert search.search_products('cannonau')[1] == 1
+        assert search.search_products('luna')[1] == 2
+        assert search.search_products('cicoria')[1] == 0
+
+    def test_products_page(self, db_client):
+        _seed()
+        html = db_client.get('/products?q=pomodori').get_data(as_text=True)
+        assert 'Pomodoro cuore di bue' in html and 'Vermentino' not in html
+        html = db_client.get('/products?q=zucchine').get_data(as_text=True)
+        assert 'Nessun prodotto trovato' in html
+
+
+class TestPrefixMatching:
+
+    @pytest.mark.parametrize('backend', ['fts5', 'memory'])
+    def test_short_words_do_not_match_longer_ones(self, db_app, monkeypatch, backend):
+        farmer, _, _ = _seed()
+        if backend == 'memory':
+            monkeypatch.setitem(search._backends, str(db.engine.url), search.memory_backend)
+        names = ['Olio extravergine', 'Olive in salamoia', 'Pane carasau', 'Panna cotta', 'Pere', 'Perla di miele']
+        db.session.add_all([Product(name=n, category='altro', price=1.0, user_id=farmer.id) for n in names])
+        db.session.commit()
+
+        def found(q):
+            hits, _ = search.search_products(q, per_page=20)
+            return sorted(db.session.get(Product, pid).name for pid, _ in hits)
+        assert found('olio') == ['Olio extravergine']
+        assert found('pane') == ['Pane carasau']
+        assert found('pere') == ['Pere']
+        # L'ultimo termine abbastanza lungo resta un prefisso
+        assert found('oliv') == ['Olive in salamoia']
+        assert found('cotta pann') == ['Panna cotta']
+
+
+class TestMissingIndex:
+
+    def test_like_fallback_until_reindex(self, db_app, count_queries):
+        _, _, products = _seed(index=False)
+        # Nessun indice creato da una richiesta: le scritture lo saltano
+        assert search.backend_for(db.session.connection()) is None
+        products[2].name = 'Cannonau'
+        with count_queries() as q:
+            db.session.commit()
+        assert not [s for s in q.statements if 'product_search' in s.lower() and 'CREATE' in s.upper()]
+        hits, total = search.search_products('pomodori')
+        assert total == 2 and {pid for pid, _ in hits} == {products[0].id, products[1].id}
+        assert search.search_products('cannonau cantina')[1] == 1
+        assert search.search_products('pomodoro', province='Sassari')[1] == 0
+
+        assert search.reindex() == ('fts5', 4)
+        assert search.backend_for(db.session.connection()).name == 'fts5'
+        assert search.search_products('cannonau')[1] == 1
+        products[0].name = 'Melanzana'
+        db.session.commit()
+        assert search.search_products('melanzana')[1] == 1
+
+
+class TestMemoryBackend:
+
+    def test_matches_fts5_semantics(self, db_app, monkeypatch):
+        _, _, products = _seed()
+        monkeypatch.setitem(search._backends, str(db.engine.url), search.memory_backend)
+        hits, total = search.search_products('pomodori')
+        assert total == 2 and hits[0][0] == products[0].id
+        assert search.search_products('cantina vermen')[1] == 1
+        assert search.search_products('pomodoro', province='Sassari')[1] == 0
+
+        # Aggiornamenti applicati dopo il commit
+        products[2].name = 'Cannonau'
+        db.session.commit()
+        assert search.search_products('cannonau')[1] == 1
+        assert search.search_products('vermentino')[1] == 0
+
+
+SYLLABLES = ['ca', 'ro', 'mi', 'sa', 'ne', 'lu', 'ter', 'bo', 'gi', 'fra', 'ta', 'po', 'ven', 'sol']
+WORDS = ['pomodoro', 'arancia', 'pecorino', 'miele', 'olio', 'vino', 'carciofo', 'zucchina', 'pane',
+         'mirto', 'fregola', 'salsiccia', 'ricotta', 'limone', 'mandorla', 'fico', 'uva', 'pesca']
+
+
+@pytest.mark.slow
+class TestSearchBenchmark:
+    """Confronto LIKE / FTS5 / indice in memoria: pytest -m slow -s"""
+
+    def test_benchmark_100k(self, tmp_path):
+        n = 100_000
+        rnd = random.Random(1)
+        # Vocabolario realistico: poche parole frequenti e molte rare
+        rare = list({''.join(rnd.choices(SYLLABLES, k=4)) for _ in range(20_000)})
+        vocab = WORDS + rare
+
+        def words(k):
+            return ' '.join(rnd.choice(WORDS) if rnd.random() < 0.3 else rnd.choice(vocab) for _ in range(k))
+        engine = create_engine(f"sqlite:///{tmp_path / 'bench.db'}")
+        db.metadata.create_all(engine, tables=[User.__table__, Product.__table__])
+        with engine.begin() as conn:
+            conn.execute(insert(User.__table__), [
+                {'id': i, 'username': f'f{i}', 'email': f'f{i}@x.it', 'password_hash': 'x', 'is_farmer': True,
+                 'company_name': f'Azienda {rnd.choice(WORDS)} {i}'} for i in range(1, 1001)])
+            conn.execute(insert(Product.__table__), [
+                {'id': i, 'name': words(2), 'description': words(12),
+                 'category': 'altro', 'user_id': rnd.randint(1, 1000)} for i in range(1, n + 1)])
+
+            backend = SqliteBackend()
+            start = time.perf_counter()
+            backend.create(conn)
+            search._index_all(conn, backend, chunk_size=5000)
+            fts_build = time.perf_counter() - start
+
+            memory = MemoryBackend()
+            start = time.perf_counter()
+            for pid, doc, category, fid in search._iter_documents(conn, chunk_size=5000):
+                memory._add(pid, doc, category, fid)
+            memory._built = True
+            memory_build = time.perf_counter() - start
+
+            # Una parola comune, due parole comuni, una parola rara e un prefisso
+            queries = ['ricotta', 'mirto ricotta', rare[0], rare[1][:5]]
+            runs = 5
+            start = time.perf_counter()
+            for _ in range(runs):
+                for q in queries:
+                    like = '%' + '%'.join(q.split()) + '%'
+                    conn.execute(text("SELECT id FROM product WHERE name LIKE :q OR description LIKE :q "
+                                      "ORDER BY id LIMIT 12"), {'q': like}).all()
+                    conn.execute(text("SELECT count(*) FROM product WHERE name LIKE :q OR description LIKE :q"),
+                                 {'q': like}).scalar()
+            like_time = (time.perf_counter() - start) / (runs * len(queries))
+
+            start = time.perf_counter()
+            for _ in range(runs):
+                fts_hits = [backend.search(conn, query_terms(q), {}, 12, 0) for q in queries]
+            fts_time = (time.perf_counter() - start) / (runs * len(queries))
+
+        facet_farmers = {i: ('', '') for i in range(1, 1001)}
+        search.facet_index.farmers, saved = facet_farmers, search.facet_index.farmers
+        search.facet_index._built, was_built = True, search.facet_index._built
+        # Indice appena costruito: ensure() non deve ricostruirlo dal database (qui non c'è app context)
+        search.facet_index._built_at, built_at = time.time(), search.facet_index._built_at
+        try:
+            start = time.perf_counter()
+            for _ in range(runs):
+                memory_hits = [memory.search(None, query_terms(q), {}, 12, 0) for q in queries]
+            memory_time = (time.perf_counter() - start) / (runs * len(queries))
+        finally:
+            search.facet_index.farmers, search.facet_index._built = saved, was_built
+            search.facet_index._built_at = built_at
+
+        print(f"\n{n} products: LIKE {like_time * 1000:.1f} ms | FTS5 {fts_time * 1000:.1f} ms "
+              f"(build {fts_build:.1f}s) | memory {memory_time * 1000:.1f} ms (build {memory_build:.1f}s)")
+        assert [total for _, total in fts_hits] == [total for _, total in memory_hits]
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+"""Worker delle notifiche: invia le email accodate nella tabella outbox_message.
+
+Uso: python worker.py [--once] [--poll 5]
+Gira come processo separato (vedi Procfile), così le richieste web non
+aspettano SendGrid/SMTP. In caso di errore ritenta con attesa crescente.
+"""
+import argparse
+import logging
+from app import create_app
+from app.outbox import run_worker, POLL_INTERVAL
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--once', action='store_true', help='svuota la coda una volta ed esce')
+parser.add_argument('--poll', type=float, default=POLL_INTERVAL, help='attesa in secondi a coda vuota')
+args = parser.parse_args()
+
+app = create_app()
+logging.getLogger().setLevel(logging.INFO)
+
+with app.app_context():
+    print("📬 Worker notifiche avviato")
+    run_worker(args.poll, args.once)